@@ -0,0 +1,325 @@
+"""Capping templates.
+
+Capping a fragment (completion.run) is expensive, yet its result only depends
+on the fragment composition, which does not change between re-clusterings. A
+template records the layout of the capped fragment once and, for each capping
+atom, its coordinates in a local orthonormal frame built from the heavy atom
+it is attached to (parent) and two fragment atoms next to it. Caps are then
+re-placed from the current fragment coordinates with a few array operations.
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import iotbx.pdb
+from libtbx import group_args
+from scitbx.array_family import flex
+from cctbx.eltbx import distance_based_connectivity
+
+get_class = iotbx.pdb.common_residue_names_get_class
+
+bond_cutoff = 1.9
+
+def get_frames(p, a, b):
+  """
+  Orthonormal frames (e1, e2, e3) at sites p with e1 along p->a and e2 in the
+  (p, a, b) plane.
+  """
+  e1 = (a - p).each_normalize()
+  u = b - p
+  e2 = u - e1 * u.dot(e1)
+  norms = e2.norms()
+  if(norms.size()>0 and flex.min(norms)<1.e-3): return None
+  e2 = e2.each_normalize()
+  e3 = e1.cross(e2)
+  return e1, e2, e3
+
+class template(object):
+  """
+  Capping template of a fragment.
+
+  hierarchy        : fragment hierarchy (not capped)
+  capped_hierarchy : result of capping hierarchy with completion.run
+  neighbors        : bonded atoms of each fragment atom (bond_table), found
+                     by distance if None
+  Use get_template() to get None instead of an exception if the caps can not
+  be described in terms of fragment atoms.
+  """
+  def __init__(self, hierarchy, capped_hierarchy, neighbors=None):
+    self.neighbors = neighbors
+    self.hierarchy = capped_hierarchy.deep_copy()
+    source_atoms = hierarchy.atoms()
+    capped_atoms = self.hierarchy.atoms()
+    source_xyz = source_atoms.extract_xyz()
+    source_index = {}
+    for i, atom in enumerate(source_atoms):
+      key = atom.id_str()
+      assert key not in source_index, key
+      source_index[key] = i
+    copy_from, copy_to, cap_to = [], [], []
+    for i, atom in enumerate(capped_atoms):
+      j = source_index.get(atom.id_str())
+      if(j is None): cap_to.append(i)
+      else:
+        copy_from.append(j)
+        copy_to.append(i)
+    self.size = capped_atoms.size()
+    self.copy_from = flex.size_t(copy_from)
+    self.copy_to = flex.size_t(copy_to)
+    self.cap_to = flex.size_t(cap_to)
+    parents, refs_a, refs_b = [], [], []
+    for i in cap_to:
+      site = capped_atoms[i].xyz
+      d = source_xyz - site
+      parent = flex.min_index(d.norms())
+      bonded = self._bonded(source_xyz, parent)
+      assert len(bonded)>0, capped_atoms[i].id_str()
+      if(len(bonded)>1):
+        ref_a, ref_b = bonded[0], bonded[1]
+      else:
+        ref_a = bonded[0]
+        second = [j for j in self._bonded(source_xyz, ref_a) if j!=parent]
+        assert len(second)>0, capped_atoms[i].id_str()
+        ref_b = second[0]
+      parents.append(parent)
+      refs_a.append(ref_a)
+      refs_b.append(ref_b)
+    self.parents = flex.size_t(parents)
+    self.refs_a = flex.size_t(refs_a)
+    self.refs_b = flex.size_t(refs_b)
+    self.local = flex.vec3_double()
+    if(self.cap_to.size()>0):
+      p = source_xyz.select(self.parents)
+      frames = get_frames(p,
+        source_xyz.select(self.refs_a), source_xyz.select(self.refs_b))
+      assert frames is not None
+      caps = capped_atoms.extract_xyz().select(self.cap_to) - p
+      self.local = flex.vec3_double(*[caps.dot(e) for e in frames])
+
+  def _bonded(self, sites_cart, i):
+    if(self.neighbors is not None):
+      bonded = flex.size_t(self.neighbors[i])
+      d = (sites_cart.select(bonded) - sites_cart[i]).norms()
+      return list(bonded.select(flex.sort_permutation(d)))
+    d = (sites_cart - sites_cart[i]).norms()
+    sel = (d < bond_cutoff) & (d > 0)
+    bonded = sel.iselection()
+    order = flex.sort_permutation(d.select(bonded))
+    return list(bonded.select(order))
+
+  def get_cap_sites(self, sites_cart):
+    p = sites_cart.select(self.parents)
+    frames = get_frames(p,
+      sites_cart.select(self.refs_a), sites_cart.select(self.refs_b))
+    if(frames is None): return None
+    x, y, z = self.local.parts()
+    e1, e2, e3 = frames
+    return p + e1 * x + e2 * y + e3 * z
+
+  def rebuild(self, sites_cart):
+    """
+    Capped hierarchy for the fragment coordinates sites_cart (same atom order
+    as the fragment hierarchy used to make the template). Returns None if the
+    local frames degenerate.
+    """
+    xyz = flex.vec3_double(self.size)
+    xyz = xyz.set_selected(self.copy_to, sites_cart.select(self.copy_from))
+    if(self.cap_to.size()>0):
+      caps = self.get_cap_sites(sites_cart)
+      if(caps is None): return None
+      xyz = xyz.set_selected(self.cap_to, caps)
+    ph = self.hierarchy.deep_copy()
+    ph.atoms().set_xyz(xyz)
+    return ph
+
+def get_template(hierarchy, capped_hierarchy, neighbors=None):
+  try:
+    return template(hierarchy=hierarchy, capped_hierarchy=capped_hierarchy,
+      neighbors=neighbors)
+  except AssertionError:
+    return None
+
+#-------------------------------------------------------------------------------
+# Direct capping. completion.run caps a fragment by round trips through PDB
+# text and pdb_interpretation. Caps, however, only depend on the residue and
+# on how the capped atom is bonded, so they are learnt from completion results
+# once per residue type and site, then placed from local frames of the
+# residue's own atoms.
+
+# residue classes handled by capper; anything else goes to completion
+capped_classes = ["common_amino_acid"]
+passive_classes = ["common_water", "common_element"]
+# side-chain acid hydrogens that completion removes
+acid_hydrogens = {"GLU": ["HE2", "DE2"], "ASP": ["HD2", "DD2"]}
+
+def get_neighbors(atoms):
+  result = [[] for i in range(atoms.size())]
+  for i, j in distance_based_connectivity.build_edge_list(
+                sites_cart=atoms.extract_xyz(), elements=atoms.extract_element()):
+    result[i].append(j)
+    result[j].append(i)
+  return result
+
+class bond_table(object):
+  """
+  Bonds of the super-sphere hierarchy, found once per clustering. Bonds of a
+  fragment and bonds crossing its boundary are then sliced from the table.
+  """
+  def __init__(self, hierarchy):
+    self.neighbors = [sorted(n) for n in get_neighbors(hierarchy.atoms())]
+
+  def select(self, iselection):
+    """
+    Bonds of the atoms in iselection: neighbors in fragment indices and
+    crossing bonds as (fragment index, super index) pairs.
+    """
+    local = {}
+    for k, i in enumerate(iselection): local[i] = k
+    neighbors, crossing = [], []
+    for k, i in enumerate(iselection):
+      inside = []
+      for j in self.neighbors[i]:
+        if(j in local): inside.append(local[j])
+        else: crossing.append((k, j))
+      neighbors.append(inside)
+    return group_args(neighbors = neighbors, crossing = crossing)
+
+def is_open_site(atom, neighbors):
+  """
+  Sites completion may cap: backbone N and C not bonded to three atoms and
+  CYS SG without hydrogen or disulfide bond.
+  """
+  name = atom.name.strip()
+  if(name in ["N", "C"]): return len(neighbors) != 3
+  if(name == "SG" and atom.parent().resname == "CYS"):
+    return len(neighbors) < 2
+  return False
+
+class capper(object):
+  """
+  Library of caps by site: (residue name, atom name, names of the bonded
+  atoms, marked with * if in another residue). Each entry gives two reference
+  atoms of the residue and the capping atoms in the local frame of the site.
+  """
+  def __init__(self):
+    self.sites = {}
+
+  def get_key(self, atoms, neighbors, i):
+    atom = atoms[i]
+    rg_id = atom.parent().parent().memory_id()
+    names = []
+    for j in neighbors[i]:
+      name = atoms[j].name.strip()
+      if(atoms[j].parent().parent().memory_id() != rg_id): name = "*"+name
+      names.append(name)
+    return (atom.parent().resname, atom.name.strip(), tuple(sorted(names)))
+
+  def get_refs(self, atoms, neighbors, i):
+    # two atoms of the same residue next to site i, as in template
+    def same(j): return atoms[j].parent().memory_id()==atoms[i].parent().memory_id()
+    bonded = [j for j in neighbors[i] if same(j)]
+    if(len(bonded)>1): return bonded[0], bonded[1]
+    if(len(bonded)==1):
+      second = [j for j in neighbors[bonded[0]] if j!=i and same(j)]
+      if(len(second)>0): return bonded[0], second[0]
+    return None
+
+  def is_supported(self, hierarchy):
+    for ag in hierarchy.atom_groups():
+      if(ag.altloc.strip()): return False
+      cls = get_class(ag.resname)
+      if(cls not in capped_classes + passive_classes): return False
+      for name in acid_hydrogens.get(ag.resname, []):
+        if(ag.get_atom(name) is not None): return False
+    return True
+
+  def harvest(self, hierarchy, capped_hierarchy, bonds=None):
+    """
+    Learn the caps completion added to a fragment. bonds is the fragment slice
+    of a bond_table, bonds are found by distance if None.
+    """
+    if(not self.is_supported(hierarchy)): return
+    atoms = hierarchy.atoms()
+    sites_cart = atoms.extract_xyz()
+    source_ids = set([a.id_str() for a in atoms])
+    capped_ids = set([a.id_str() for a in capped_hierarchy.atoms()])
+    if(not source_ids.issubset(capped_ids)): return
+    caps = {}
+    for atom in capped_hierarchy.atoms():
+      if(atom.id_str() in source_ids): continue
+      parent = flex.min_index((sites_cart - atom.xyz).norms())
+      caps.setdefault(parent, []).append(atom)
+    if(bonds is None): neighbors = get_neighbors(atoms)
+    else:              neighbors = bonds.neighbors
+    for i, atom in enumerate(atoms):
+      if(i not in caps and not is_open_site(atom, neighbors[i])): continue
+      refs = self.get_refs(atoms, neighbors, i)
+      if(refs is None): continue
+      frames = get_frames(flex.vec3_double([sites_cart[i]]),
+        flex.vec3_double([sites_cart[refs[0]]]),
+        flex.vec3_double([sites_cart[refs[1]]]))
+      if(frames is None): continue
+      local = []
+      for cap in caps.get(i, []):
+        d = flex.vec3_double([cap.xyz]) - flex.vec3_double([sites_cart[i]])
+        local.append((cap.name, cap.element,
+          tuple([d.dot(e)[0] for e in frames])))
+      self.sites[self.get_key(atoms, neighbors, i)] = group_args(
+        refs = (atoms[refs[0]].name.strip(), atoms[refs[1]].name.strip()),
+        caps = local)
+
+  def cap(self, hierarchy, bonds=None):
+    """
+    Capped copy of hierarchy with caps appended at the end of the model, as
+    completion.run does, or None if any site needing caps is not known. With
+    bonds (fragment slice of a bond_table) atoms with crossing bonds are open
+    sites too.
+    """
+    if(not self.is_supported(hierarchy)): return None
+    atoms = hierarchy.atoms()
+    crossing = set()
+    if(bonds is None): neighbors = get_neighbors(atoms)
+    else:
+      neighbors = bonds.neighbors
+      crossing = set([i for i, j in bonds.crossing])
+    result = hierarchy.deep_copy()
+    new_atom_groups = []
+    for i, atom in enumerate(result.atoms()):
+      ag = atom.parent()
+      if(get_class(ag.resname) not in capped_classes): continue
+      site = self.sites.get(self.get_key(atoms, neighbors, i))
+      if(site is None):
+        if(i in crossing or is_open_site(atom, neighbors[i])): return None
+        continue
+      if(len(site.caps)==0): continue
+      ref_a, ref_b = [ag.get_atom(name) for name in site.refs]
+      if(ref_a is None or ref_b is None): return None
+      frames = get_frames(flex.vec3_double([atom.xyz]),
+        flex.vec3_double([ref_a.xyz]), flex.vec3_double([ref_b.xyz]))
+      if(frames is None): return None
+      e1, e2, e3 = [e[0] for e in frames]
+      if(len(new_atom_groups)==0 or
+         new_atom_groups[-1][0].memory_id()!=ag.parent().memory_id()):
+        new_atom_groups.append((ag.parent(), iotbx.pdb.hierarchy.atom_group(
+          resname=ag.resname, altloc=ag.altloc)))
+      for name, element, (x, y, z) in site.caps:
+        new_atom = iotbx.pdb.hierarchy.atom()
+        new_atom.set_name(name)
+        new_atom.set_element(element)
+        new_atom.set_xyz(tuple([atom.xyz[k] + e1[k]*x + e2[k]*y + e3[k]*z
+                                for k in range(3)]))
+        new_atom.set_occ(atom.occ)
+        new_atom.set_b(atom.b)
+        new_atom.set_hetero(atom.hetero)
+        new_atom_groups[-1][1].append_atom(new_atom)
+    model = result.only_model()
+    for rg, new_ag in new_atom_groups:
+      new_rg = iotbx.pdb.hierarchy.residue_group(
+        resseq=rg.resseq, icode=rg.icode)
+      new_rg.append_atom_group(new_ag)
+      new_chain = iotbx.pdb.hierarchy.chain(id=rg.parent().id)
+      new_chain.append_residue_group(new_rg)
+      model.append_chain(new_chain)
+    result.atoms_reset_serial()
+    result.atoms().reset_i_seq()
+    return result
@@ -2,13 +2,15 @@ from __future__ import print_function
 from __future__ import absolute_import
 import os
 import sys
+import math
+import weakref
 from libtbx.utils import Sorry
 import iotbx
 from mmtbx.chemical_components import get_cif_dictionary
-from mmtbx.monomer_library import server
 
 from .utils import hierarchy_utils
 from iotbx.pdb import amino_acid_codes as aac
+from scitbx.array_family import flex
 
 get_class = iotbx.pdb.common_residue_names_get_class
 
@@ -35,11 +37,7 @@ non_standard_amino_acids = { #"SAR" : None,
                             }
 
 def get_mon_lib_server(ligand_cif_file_names=None):
-  mon_lib_server = server.server()
-  if ligand_cif_file_names:
-    for fn in ligand_cif_file_names:
-      mon_lib_server.process_cif(file_name=fn)
-  return mon_lib_server
+  return hierarchy_utils.add_cif_objects(cif_file_names=ligand_cif_file_names)
 
 def get_cif_objects(ligand_cif_file_names=None):
   cif_objects = []
@@ -848,6 +846,75 @@ def calculate_residue_charge(rg,
     annot = 'non-polymer'
   return charge, rc, annot
 
+# (residue name, atom names and charges, covalently bonded) -> formal charge
+residue_charges = {}
+# residue classes with memoized charges, others are electron counted
+residue_charge_classes = ["common_amino_acid", "common_water", "common_element"]
+# coordination to these is not a covalent bond
+metal_elements = set(["LI", "NA", "K", "MG", "CA", "MN", "FE", "CO", "NI",
+  "CU", "ZN", "CD", "PT", "HG", "SR", "BA"])
+
+def get_covalent_i_seqs(pdb_hierarchy, bond_cutoff=2.1):
+  """
+  i_seqs of heavy atoms bonded to a heavy atom of another residue by other
+  than a peptide (C-N) bond, such as S-S bonds. Metals and ions are left
+  out: their coordination distances are in the same range.
+  """
+  result = set()
+  atoms = pdb_hierarchy.atoms()
+  i_seqs, residues = flex.size_t(), flex.size_t()
+  for i_rg, rg in enumerate(pdb_hierarchy.residue_groups()):
+    if get_class(rg.atom_groups()[0].resname)=="common_element": continue
+    for atom in rg.atoms():
+      if atom.element_is_hydrogen(): continue
+      if atom.element.strip().upper() in metal_elements: continue
+      i_seqs.append(atom.i_seq)
+      residues.append(i_rg)
+  sites_cart = atoms.extract_xyz().select(i_seqs)
+  for k in range(i_seqs.size()):
+    d = (sites_cart - sites_cart[k]).norms()
+    bonded = (d < bond_cutoff) & (residues != residues[k])
+    for l in bonded.iselection():
+      names = set([atoms[i_seqs[k]].name.strip(), atoms[i_seqs[l]].name.strip()])
+      if names == set(['C', 'N']): continue
+      result.add(i_seqs[k])
+  return result
+
+def get_formal_charge(pdb_hierarchy, hetero_charges=default_ion_charges):
+  """
+  Total charge of a (capped) hierarchy as a sum of residue charges. Residue
+  charges depend only on residue name, atom names (protonation, terminal
+  and capping atoms) and covalent bonds to other residues, so they are
+  memoized on these. Returns None if there are residues of other classes
+  (ligands, nucleic acids), their charges need electron counting.
+  """
+  ph = pdb_hierarchy.deep_copy()
+  ph.merge_atoms_at_end_to_residues()
+  ph.atoms().reset_i_seq()
+  for rg in ph.residue_groups():
+    for ag in rg.atom_groups():
+      if get_class(ag.resname) not in residue_charge_classes: return None
+  covalent = get_covalent_i_seqs(ph)
+  inter_residue_bonds = dict([(i_seq, True) for i_seq in covalent])
+  total = 0
+  for rg in ph.residue_groups():
+    atoms = rg.atoms()
+    resname = rg.atom_groups()[0].resname
+    is_covalent = len(covalent.intersection(atoms.extract_i_seq()))>0
+    key = (resname, tuple(sorted([a.name+a.charge for a in atoms])),
+           is_covalent)
+    charge = residue_charges.get(key, None)
+    if charge is None:
+      if get_class(resname)=="common_water":
+        charge = 0
+      else:
+        charge = calculate_residue_charge(rg,
+          hetero_charges      = hetero_charges,
+          inter_residue_bonds = inter_residue_bonds)[0]
+      residue_charges[key] = charge
+    total += charge
+  return total
+
 def _get_restraints_from_resname(resname, mon_lib_server):
   input_resname = resname
   restraints = mon_lib_server.get_comp_comp_id_direct(resname)
@@ -859,67 +926,89 @@ def _get_restraints_from_resname(resname, mon_lib_server):
     assert restraints, 'no restraints for "%s" found' % input_resname
   return restraints
 
+# need to handle HT1, HT2 and HXT
+v2_to_3 = {' HA3':' HA1',
+           ' HB3':' HB1',
+           ' HG3':' HG1',
+           'HG13':'HG11',
+           ' HD3':' HD1',
+           ' HE3':' HE1',
+           ' HT1':' HA1', #TODO check!
+           ' HT2':' HA2', #TODO check!
+           }
+misc = {' OXT' : ' O  ',
+        }
+
+class partial_charge_table(dict):
+  """
+  Partial charges of one residue type by atom name, filled on first use of
+  each name.
+  """
+  def __init__(self, resname, mon_lib_server):
+    restraints = _get_restraints_from_resname(resname, mon_lib_server)
+    self.atom_dict = restraints.atom_dict()
+
+  def __missing__(self, name):
+    atom_dict = self.atom_dict
+    cif = atom_dict.get(name.strip(), None)
+    if cif is None:
+      if name in [" H1 ", " H2 ", " H3 "]: # needs calculating...
+        self[name] = 0.26
+        return 0.26
+      elif name in [' HXT']: # zero charges for fake atoms
+        self[name] = 0.00
+        return 0.00
+      if name in v2_to_3:
+        cif = atom_dict.get(v2_to_3[name].strip())
+      elif name in misc:
+        cif = atom_dict.get(misc[name].strip())
+      elif name.find("'")>-1:
+        cif = atom_dict.get(name.replace("'", "*").strip(), None)
+    assert cif, "%s" % atom_dict
+    self[name] = cif.partial_charge
+    return cif.partial_charge
+
+# mon_lib_server -> {resname: partial_charge_table}
+_partial_charge_tables = weakref.WeakKeyDictionary()
+
+def get_partial_charge_table(resname, mon_lib_server):
+  tables = _partial_charge_tables.setdefault(mon_lib_server, {})
+  table = tables.get(resname, None)
+  if table is None:
+    table = partial_charge_table(resname, mon_lib_server)
+    tables[resname] = table
+  return table
+
 def get_partial_point_charges(rg,
                               mon_lib_server,
                               hetero_charges=None):
   """
   This function relies only on the residue group and monomer library server
   """
-  #assert 0
-  # need to handle HT1, HT2 and HXT
-  v2_to_3 = {' HA3':' HA1',
-             ' HB3':' HB1',
-             ' HG3':' HG1',
-             'HG13':'HG11',
-             ' HD3':' HD1',
-             ' HE3':' HE1',
-             ' HT1':' HA1', #TODO check!
-             ' HT2':' HA2', #TODO check!
-             }
-  misc = {' OXT' : ' O  ',
-          }
   tmp = []
   for ag in rg.atom_groups():
-    restraints = _get_restraints_from_resname(ag.resname, mon_lib_server)
-    atom_dict = restraints.atom_dict()
-    for atom in ag.atoms():
-      # ions
-      if get_class(ag.resname)=="common_element":
-        assert len(ag.atoms())==1
-        if not atom.charge.strip():
-          if hetero_charges:
-            key = atom.parent().resname
-            #print 'using hetero_charges for :%s' % key
-            charge = hetero_charges.get(key.strip(), None)
-            if charge:
-              tmp.append([charge]+list(atom.xyz))
-            else:
-              raise Sorry('no charge found in the model file or hetero_charges for "%s"' % atom.quote())
+    table = get_partial_charge_table(ag.resname, mon_lib_server)
+    atoms = ag.atoms()
+    # ions
+    if get_class(ag.resname)=="common_element":
+      assert len(atoms)==1
+      atom = atoms[0]
+      if not atom.charge.strip():
+        if hetero_charges:
+          key = atom.parent().resname
+          charge = hetero_charges.get(key.strip(), None)
+          if charge:
+            tmp.append([charge]+list(atom.xyz))
           else:
-            raise Sorry('no charge found in the model file for "%s"' % atom.quote())
+            raise Sorry('no charge found in the model file or hetero_charges for "%s"' % atom.quote())
         else:
-          tmp.append([atom.charge_as_int()]+list(atom.xyz))
-        continue
-      # other atoms
-      cif = atom_dict.get(atom.name.strip(), None)
-      # print 'cif',atom.name.strip(),cif #debug
-      if cif is None:
-        if atom.name in [" H1 ", " H2 ", " H3 "]: # needs calculating...
-          tmp.append([0.26]+list(atom.xyz))
-          continue
-        elif atom.name in [' HXT']: # zero charges for fake atoms
-          tmp.append([0.00]+list(atom.xyz))
-          continue
-        if atom.name in v2_to_3:
-          cif = atom_dict.get(v2_to_3[atom.name].strip())
-        elif atom.name in misc:
-          cif = atom_dict.get(misc[atom.name].strip())
-        elif atom.name.find("'")>-1:
-          name = atom.name.replace("'", "*")
-          cif = atom_dict.get(name.strip(), None)
-      # print 'cif-fixed',atom.name.strip(),cif #debug
-      assert cif, "%s" % atom_dict
-      tmp.append([cif.partial_charge]+list(atom.xyz))
+          raise Sorry('no charge found in the model file for "%s"' % atom.quote())
+      else:
+        tmp.append([atom.charge_as_int()]+list(atom.xyz))
+      continue
+    # other atoms
+    for name, xyz in zip(atoms.extract_name(), atoms.extract_xyz()):
+      tmp.append([table[name]]+list(xyz))
   return tmp
 
 def write_pdb_hierarchy_xyzq_file(hierarchy,
@@ -938,26 +1027,62 @@ def write_pdb_hierarchy_xyzq_file(hierarchy,
     charge_scaling_positions=charge_scaling_positions,
     scale=scale,
   )
+def write_point_charges(file_name, charges, sites_cart, qxyz_order='qxyz'):
+  """
+  Write point charges with their coordinates: 'qxyz' (with a header of atom
+  count and blank line) or 'xyzq'.
+  """
+  if qxyz_order=='qxyz':
+    header = "%d  \n  \n" % charges.size()
+    line = "%s  %s  %s  %s  \n"
+    columns = [charges] + list(sites_cart.parts())
+  elif qxyz_order=='xyzq':
+    header = ""
+    line = "%s  %s  %s  %s  \n"
+    columns = list(sites_cart.parts()) + [charges]
+  else:
+    raise Sorry('invalid qxyz_order parameter "%s"' % qxyz_order)
+  values = []
+  for row in zip(*[list(c) for c in columns]):
+    values.extend(row)
+  with open(file_name, "w") as f:
+    f.write(header + line*charges.size() % tuple(values))
+
+def match_positions(sites, positions, tolerance=1.0E-3):
+  """
+  Indices of sites that are within tolerance of any of positions in each
+  coordinate. Positions are hashed in cells of size tolerance, so each site
+  is compared only with the positions in its own and neighbouring cells.
+  """
+  def cell(xyz):
+    return tuple([int(math.floor(x/tolerance)) for x in xyz])
+  cells = {}
+  for xyz in positions:
+    cells.setdefault(cell(xyz), []).append(xyz)
+  if not cells: return []
+  shifts = [(i,j,k) for i in (-1,0,1) for j in (-1,0,1) for k in (-1,0,1)]
+  result = []
+  for i_site, site in enumerate(sites):
+    a, b, c = cell(site)
+    found = False
+    for i, j, k in shifts:
+      for xyz in cells.get((a+i, b+j, c+k), []):
+        if ( abs(xyz[0] - site[0]) < tolerance and
+             abs(xyz[1] - site[1]) < tolerance and
+             abs(xyz[2] - site[2]) < tolerance ):
+          found = True
+          break
+      if found: break
+    if found: result.append(i_site)
+  return result
+
 def scale_partial_point_charges(qxyz,
                                 charge_scaling_positions=None,
                                 scale=0):
-  def partial_charge_in_charge_scaling_positions(partial_charge,
-                                                 charge_scaling_positions):
-    scaling = False
-    for xyz in charge_scaling_positions:
-      same_point = ( abs(xyz[0] - partial_charge[1]) < 1.0E-3 and
-                     abs(xyz[1] - partial_charge[2]) < 1.0E-3 and
-                     abs(xyz[2] - partial_charge[3]) < 1.0E-3 )
-      if same_point:
-        scaling = True
-        break
-    return scaling
-  #####
   if charge_scaling_positions != None:
-    for item in qxyz:
-      if partial_charge_in_charge_scaling_positions(item,
-                                                    charge_scaling_positions):
-        item[0] =  item[0]*scale
+    for i in match_positions([item[1:4] for item in qxyz],
+                             charge_scaling_positions):
+      qxyz[i][0] = qxyz[i][0]*scale
 
 def get_hetero_charges_FORMUL(pdb_inp):
   # get the hetero charges from the FORMUL record
@@ -3,14 +3,19 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 import os
+import time
+import weakref
+import multiprocessing
 from libtbx import Auto
 from libtbx.utils import Sorry
 from libtbx import adopt_init_args
-from libtbx.easy_mp import parallel_map
+from libtbx.easy_mp import parallel_map, get_processes
 from scitbx.array_family import flex
-from .fragment import write_cluster_and_fragments_pdbs
-from .restraints import from_qm
+from .fragment import write_cluster_and_fragments_pdbs, write_pdb_file
+from .fragment import get_fragment_restraints
+from .restraints import from_qm, from_cctbx
 from libtbx import group_args
+from .utils import hierarchy_utils
 
 def check_no_altlocs(h, file_name):
   altlocs = []
@@ -26,9 +31,307 @@ def check_no_altlocs(h, file_name):
     if(len(a)==0): cntr+=1
   assert cntr==1, [file_name, altlocs]
 
+# Restraints manager and coordinates seen by the workers of worker_pool. Both
+# are set before the workers are forked, so every worker inherits the static
+# fragment data and QM engine without pickling; the coordinates live in shared
+# memory and are overwritten in place at each step.
+_pool_restraints_manager = None
+_pool_sites_cart = None
+
+def _pool_target_and_gradients(index):
+  rm = _pool_restraints_manager
+  sites_cart = flex.vec3_double(flex.double(_pool_sites_cart[:]))
+  rm.fragment_extracts.pdb_hierarchy_super.atoms().set_xyz(sites_cart)
+  t0 = time.time()
+  result = rm.target_and_gradients(
+    sites_cart = sites_cart,
+    selection  = rm.fragment_extracts.fragment_index.fragment_iselection(index),
+    index      = index)
+  return index, result, time.time()-t0
+
+def _pool_update(fragment_extracts, keep):
+  rm = _pool_restraints_manager
+  rm.fragment_extracts = fragment_extracts
+  if(hasattr(rm, "reset_states")):
+    rm.reset_states(keep=keep)
+  return os.getpid()
+
+class timed_call(object):
+  """
+  Wraps a restraints manager for parallel_map: returns the fragment index,
+  the result and the time spent.
+  """
+  def __init__(self, func):
+    self.func = func
+
+  def __call__(self, selection_and_sites_cart):
+    t0 = time.time()
+    result = self.func(selection_and_sites_cart)
+    return selection_and_sites_cart[2], result, time.time()-t0
+
+# Cost of a fragment grows as (number of capped atoms)**p: about cubic for
+# HF/DFT, quadratic for semi-empirical and tight-binding, linear for ML
+# potentials and cctbx restraints (engine None).
+cost_exponents = {
+  None          : 1,
+  "torchani"    : 1,
+  "aimnet2"     : 1,
+  "aimnet2-old" : 1,
+  "mopac"       : 2,
+  "xtb"         : 2}
+
+class fragment_scheduler(object):
+  """
+  Orders fragments by estimated cost, largest first. Estimates are
+  size**p scaled by the ratio of measured to estimated times; fragments
+  already timed at this clustering use their last measured time.
+  """
+  def __init__(self, engine_name=None):
+    self.exponent = cost_exponents.get(engine_name, 3)
+    self.times = {}
+    self.sizes = []
+    self.clustering = None
+    self.measured = 0.
+    self.estimated = 0.
+
+  def set_fragments(self, sizes, clustering):
+    # fragment indices change with re-clustering, calibration is kept
+    if(clustering != self.clustering):
+      self.times = {}
+      self.clustering = clustering
+    self.sizes = sizes
+
+  def estimate(self, index):
+    t = self.times.get(index)
+    if(t is not None): return t
+    cost = float(self.sizes[index])**self.exponent
+    if(self.estimated > 0): cost *= self.measured/self.estimated
+    return cost
+
+  def get_order(self):
+    costs = [self.estimate(i) for i in range(len(self.sizes))]
+    return sorted(range(len(costs)), key=lambda i: -costs[i])
+
+  def update(self, index, seconds):
+    self.times[index] = seconds
+    self.measured += seconds
+    self.estimated += float(self.sizes[index])**self.exponent
+
+def _terminate_pools(pools):
+  for pool in pools:
+    pool.terminate()
+    pool.join()
+
+class worker_pool(object):
+  """
+  Long-lived pool of forked workers evaluating fragments. Only fragment
+  indices are sent to the workers, the current coordinates are passed
+  through shared memory. With pinned=True each fragment is always evaluated
+  by the same worker (balanced by estimated cost once per clustering, not
+  at each step), so QM engines keeping the SCF state of a fragment in
+  memory find it again at the next step, also after re-clustering if the
+  fragment did not change.
+  """
+  def __init__(self, restraints_manager, n_sites, processes, pinned=False):
+    global _pool_restraints_manager, _pool_sites_cart
+    _pool_restraints_manager = restraints_manager
+    _pool_sites_cart = multiprocessing.RawArray('d', 3*n_sites)
+    self.n_sites = n_sites
+    self.pinned = pinned
+    # fragment key -> worker, pinned only
+    self.workers = {}
+    context = multiprocessing.get_context("fork")
+    if(pinned):
+      self.pools = [context.Pool(processes=1) for i in range(processes)]
+    else:
+      self.pools = [context.Pool(processes=processes)]
+    # workers hold a copy of the restraints manager: stop them when the pool
+    # is closed or dropped
+    self.finalizer = weakref.finalize(self, _terminate_pools, self.pools)
+
+  def assign(self, keys, costs):
+    """
+    Fix the worker of each fragment for a clustering. Fragments evaluated
+    before keep their worker, new ones go largest first to the worker with
+    the lowest estimated cost.
+    """
+    loads = [0.]*len(self.pools)
+    workers = {}
+    for key, cost in zip(keys, costs):
+      w = self.workers.get(key)
+      if(w is not None):
+        workers[key] = w
+        loads[w] += cost
+    new = [(cost, key) for key, cost in zip(keys, costs) if key not in workers]
+    for cost, key in sorted(new, key=lambda x: -x[0]):
+      w = loads.index(min(loads))
+      workers[key] = w
+      loads[w] += cost
+    self.workers = workers
+
+  def update(self, fragment_extracts, keep):
+    """
+    Send the fragments of a new clustering to the pinned workers, which
+    drop the SCF states of fragments not in keep.
+    """
+    results = [pool.apply_async(_pool_update, (fragment_extracts, keep))
+               for pool in self.pools]
+    for r in results: r.get()
+
+  def map(self, sites_cart, indices, keys=None):
+    """
+    Evaluate fragments in the order of indices. Unpinned, each worker takes
+    the next fragment once it is free and results come in order of
+    completion; pinned, each worker takes its own fragments (keys[i] for
+    fragment i, see assign()) in that order.
+    """
+    assert sites_cart.size() == self.n_sites
+    _pool_sites_cart[:] = list(sites_cart.as_double())
+    if(not self.pinned):
+      return list(self.pools[0].imap_unordered(_pool_target_and_gradients,
+        indices, chunksize=1))
+    results = [self.pools[self.workers[keys[i]]].apply_async(
+                 _pool_target_and_gradients, (i,))
+               for i in indices]
+    return [r.get() for r in results]
+
+  def close(self):
+    global _pool_restraints_manager
+    self.finalizer()
+    _pool_restraints_manager = None
+
 class from_cluster(object):
-  def __init__(self, restraints_manager, fragment_manager, parallel_params):
+  def __init__(self, restraints_manager, fragment_manager, parallel_params,
+               reuse_threshold=None, reuse_correction=False, log=None):
     adopt_init_args(self, locals())
+    self.pool = None
+    self.pool_clustering = None
+    self.states_clustering = None
+    # last evaluation of each fragment, for fragments that did not move
+    self.reuse = {}
+    self.reuse_clustering = None
+    self.cctbx_fragments = None
+    self.scheduler = fragment_scheduler(
+      engine_name = getattr(restraints_manager, "qm_engine_name", None))
+
+  def use_pool(self):
+    return (getattr(self.parallel_params, "persistent_pool", True) and
+            self.parallel_params.method == "multiprocessing" and
+            get_processes(self.parallel_params.nproc) > 1)
+
+  def pin_fragments(self):
+    # engines keeping SCF states of fragments in memory need the same worker
+    engine = getattr(self.restraints_manager, "qm_engine", None)
+    return (hasattr(engine, "states") and
+            (getattr(engine, "in_process", False) or
+             getattr(engine, "warm_start", False)))
+
+  def reset_states(self):
+    """
+    After re-clustering, drop the SCF states the QM engine keeps for
+    fragments that no longer exist. States follow the fragment identity, so
+    fragments kept by incremental re-clustering keep theirs.
+    """
+    n_clusterings = self.fragment_manager.n_clusterings
+    if(self.states_clustering == n_clusterings): return
+    if(hasattr(self.restraints_manager, "reset_states")):
+      self.restraints_manager.reset_states(keep=set(
+        self.fragment_manager.fragment_index.fragment_keys()))
+    self.states_clustering = n_clusterings
+
+  def get_pool(self, n_sites):
+    n_clusterings = self.fragment_manager.n_clusterings
+    keys = self.fragment_manager.fragment_index.fragment_keys()
+    if(self.pool is not None and self.pool.n_sites != n_sites):
+      self.close()
+    if(self.pool is not None and self.pool_clustering != n_clusterings):
+      if(self.pool.pinned):
+        # keep the workers and the SCF states of unchanged fragments
+        self.pool.update(
+          fragment_extracts = self.restraints_manager.fragment_extracts,
+          keep              = set(keys))
+      else:
+        # workers hold a copy of the fragments: start new ones
+        self.close()
+    if(self.pool is None):
+      # load the monomer library once, workers inherit it
+      hierarchy_utils.get_mon_lib_server()
+      hierarchy_utils.get_ener_lib()
+      self.pool = worker_pool(
+        restraints_manager = self.restraints_manager,
+        n_sites            = n_sites,
+        processes          = get_processes(self.parallel_params.nproc),
+        pinned             = self.pin_fragments())
+      self.pool_clustering = None
+    if(self.pool.pinned and self.pool_clustering != n_clusterings):
+      # workload of each worker from the estimated cost of its fragments
+      self.pool.assign(keys=keys,
+        costs=[self.scheduler.estimate(i) for i in range(len(keys))])
+    self.pool_clustering = n_clusterings
+    return self.pool
+
+  def close(self):
+    if(self.pool is not None):
+      self.pool.close()
+      self.pool = None
+
+  def get_fragment_sizes(self):
+    fm = self.fragment_manager
+    capped = getattr(fm, "fragment_capped_initial", None)
+    if(capped is not None and len(capped) == fm.fragment_index.size()):
+      return [ph.atoms_size() for ph in capped]
+    return [fm.fragment_index.super_iselection(i).size()
+            for i in range(fm.fragment_index.size())]
+
+  def get_cctbx_target_and_gradients(self, sites_cart, index):
+    if(self.cctbx_fragments is None):
+      self.cctbx_fragments = from_cctbx(restraints_manager=None)
+    fm = self.fragment_manager
+    self.cctbx_fragments.fragment_extracts = group_args(
+      fragment_index      = fm.fragment_index,
+      fragment_restraints = fm.fragment_restraints,
+      pdb_hierarchy_super = fm.pdb_hierarchy_super,
+      super_sphere_geometry_restraints_manager = \
+        fm.expansion.super_sphere_geometry_restraints_manager)
+    return self.cctbx_fragments.target_and_gradients(
+      sites_cart = sites_cart,
+      selection  = fm.fragment_index.fragment_iselection(index),
+      index      = index)
+
+  def get_reused(self, sites_cart):
+    """
+    Results of fragments that moved by less than reuse_threshold since they
+    were last computed, with optional first-order correction from the
+    change of their cctbx target and gradients.
+    """
+    result = {}
+    if(self.reuse_threshold is None): return result
+    if(self.reuse_clustering != self.fragment_manager.n_clusterings):
+      self.reuse = {}
+      self.reuse_clustering = self.fragment_manager.n_clusterings
+    fragment_index = self.fragment_manager.fragment_index
+    for index, r in self.reuse.items():
+      xyz = sites_cart.select(fragment_index.super_iselection(index))
+      if(flex.max((xyz - r.sites_cart).norms()) >= self.reuse_threshold):
+        continue
+      t, g = r.target_and_gradients
+      if(r.cctbx is not None):
+        t_new, g_new = self.get_cctbx_target_and_gradients(sites_cart, index)
+        t = t + (t_new - r.cctbx[0])
+        g = g + (g_new - r.cctbx[1])
+      result[index] = (t, g)
+    return result
+
+  def store(self, sites_cart, index, target_and_gradients):
+    if(self.reuse_threshold is None): return
+    cctbx = None
+    if(self.reuse_correction):
+      cctbx = self.get_cctbx_target_and_gradients(sites_cart, index)
+    self.reuse[index] = group_args(
+      sites_cart           = sites_cart.select(
+        self.fragment_manager.fragment_index.super_iselection(index)),
+      target_and_gradients = target_and_gradients,
+      cctbx                = cctbx)
 
   def energies_sites(self, sites_cart, compute_gradients=True):
     tg = self.target_and_gradients(sites_cart=sites_cart)
@@ -41,15 +344,19 @@ class from_cluster(object):
     system_size = sites_cart.size()
     self.fragment_manager.update_xyz(sites_cart)
     sites_cart = self.fragment_manager.pdb_hierarchy_super.atoms().extract_xyz()
-    #
-    self.fragment_manager.pdb_hierarchy_super.write_pdb_file(
-      file_name=self.restraints_manager.file_name,
-      crystal_symmetry=self.fragment_manager.expansion.cs_box)
     fragment_extracts_obj = self.fragment_manager.get_fragment_extracts()
+    write_pdb_file(
+      fragment_extracts = fragment_extracts_obj,
+      hierarchy         = self.fragment_manager.pdb_hierarchy_super,
+      file_name         = self.restraints_manager.file_name)
     # super_sphere_geometry_restraints_manager will cause qusb submits
     # a single job instead of batch jobs
     if(isinstance(self.restraints_manager, from_qm)):
       fragment_extracts_obj.super_sphere_geometry_restraints_manager=None
+    elif(isinstance(self.restraints_manager, from_cctbx)):
+      # select fragment restraints before workers are forked
+      for index in range(self.fragment_manager.fragment_index.size()):
+        get_fragment_restraints(fragment_extracts_obj, index)
     self.restraints_manager.fragment_extracts = fragment_extracts_obj
     selection_and_sites_cart=[]
 
@@ -63,9 +370,10 @@ class from_cluster(object):
     #write_cluster_and_fragments_pdbs(fragments=fragment_extracts_obj,directory='frag_pdbs')
     #
 
-    for index, selection_fragment in enumerate(
-                       self.fragment_manager.fragment_selections):
-      selection_and_sites_cart.append([selection_fragment, sites_cart,index])
+    fragment_index = self.fragment_manager.fragment_index
+    for index in range(fragment_index.size()):
+      selection_and_sites_cart.append(
+        [fragment_index.fragment_iselection(index), sites_cart, index])
        ## DEBUG begin
        #try:
        #  super_selection = self.restraints_manager.\
@@ -85,18 +393,39 @@ class from_cluster(object):
        ## DEBUG end
     if(self.parallel_params.nproc is None):
       self.parallel_params.nproc = Auto
+    self.scheduler.set_fragments(
+      sizes      = self.get_fragment_sizes(),
+      clustering = self.fragment_manager.n_clusterings)
+    self.reset_states()
+    reused = self.get_reused(sites_cart=sites_cart)
+    order = [i for i in self.scheduler.get_order() if i not in reused]
     ncount=0
     energy_gradients=None
     while(ncount<5 and energy_gradients is None):
       try:
-        energy_gradients = parallel_map(
-          func                       = self.restraints_manager,
-          iterable                   = selection_and_sites_cart,
-          method                     = self.parallel_params.method,
-          preserve_exception_message = True,
-          processes                  = self.parallel_params.nproc,
-          qsub_command               = self.parallel_params.qsub_command,
-          use_manager                = True)
+        if(self.use_pool()):
+          results = self.get_pool(n_sites=sites_cart.size()).map(
+            sites_cart = sites_cart,
+            indices    = order,
+            keys       = fragment_index.fragment_keys())
+        else:
+          results = parallel_map(
+            func                       = timed_call(self.restraints_manager),
+            iterable                   = [selection_and_sites_cart[i]
+                                          for i in order],
+            method                     = self.parallel_params.method,
+            preserve_exception_message = True,
+            processes                  = self.parallel_params.nproc,
+            qsub_command               = self.parallel_params.qsub_command,
+            use_manager                = True)
+        energy_gradients = [None]*len(selection_and_sites_cart)
+        for index, result in reused.items():
+          energy_gradients[index] = result
+        for index, result, seconds in results:
+          energy_gradients[index] = result
+          self.scheduler.update(index, seconds)
+          self.store(sites_cart=sites_cart, index=index,
+            target_and_gradients=result)
       except Exception as e:
         import sys, traceback
         import shutil
@@ -133,28 +462,22 @@ class from_cluster(object):
         raise Sorry('process finished with error: %s' % e)
     target=0
     gradients=flex.vec3_double(system_size)
-
+    # fragment gradients follow fragment_iselection, only cluster atoms count
     for index, item in enumerate(energy_gradients):
-      t = item[0]
-      g = item[1]
-      selection_fragment = self.fragment_manager.fragment_selections[index]
-      selection_buffer =  self.fragment_manager.buffer_selections[index]
-      gradients_i = flex.vec3_double(system_size)
-      gradients_i = gradients_i.set_selected(selection_fragment, g)
-      gradients_i = gradients_i.set_selected(selection_buffer,[0,0,0])
-      gradients += gradients_i
-      target += t
+      gradients.add_selected(fragment_index.cluster_iselection(index),
+        item[1].select(fragment_index.cluster_positions_in_fragment(index)))
+      target += item[0]
+    if(self.reuse_threshold is not None):
+      print("fragments: computed %d reused %d" % (len(order), len(reused)),
+        file=self.log)
     ### for debugging parallel_map, remove later.
     if(0):
-      for selection_fragment, selection_buffer in zip(
-                                      self.fragment_manager.fragment_selections,
-                                      self.fragment_manager.buffer_selections):
+      for index in range(fragment_index.size()):
         t, g =  self.restraints_manager.target_and_gradients(
-                           sites_cart=sites_cart, selection=selection_fragment)
-        # XXX INEFFICIENT, MOVE TO C++
-        gradients_i = flex.vec3_double(system_size)
-        gradients_i = gradients_i.set_selected(selection_fragment, g)
-        gradients_i = gradients_i.set_selected(selection_buffer,[0,0,0])
-        gradients += gradients_i
+          sites_cart = sites_cart,
+          selection  = fragment_index.fragment_iselection(index),
+          index      = index)
+        gradients.add_selected(fragment_index.cluster_iselection(index),
+          g.select(fragment_index.cluster_positions_in_fragment(index)))
         target += t
     return target, gradients
@@ -117,7 +117,7 @@ def run(pdb_file, log):
     # use parallel_map
     #
     #indices = range(len(fq.clusters))
-    indices = range(len(fq_ext.fragment_selections))
+    indices = range(fq_ext.fragment_index.size())
     rc = run_all(qm_engine,
                  fq_ext,
                  indices,
@@ -132,7 +132,7 @@ def run(pdb_file, log):
     nproc=6
     argss = []
     results = []
-    for i in range(len(fq_ext.fragment_selections)):
+    for i in range(fq_ext.fragment_index.size()):
       argss.append([qm_engine, fq_ext, i])
     for args, res, err_str in easy_mp.multi_core_run(get_qm_energy,
                                                       argss,
@@ -152,7 +152,7 @@ def run(pdb_file, log):
     #
     # serial
     #
-    for i in range(len(fq_ext.fragment_selections)):
+    for i in range(fq_ext.fragment_index.size()):
       # add capping for the cluster and buffer
       print("capping frag:", i, file=log)
       energy = get_qm_energy(qm_engine, fq_ext, i)
@@ -3,12 +3,10 @@ from __future__ import absolute_import
 import sys
 
 import iotbx
-from mmtbx.monomer_library import server
 from libtbx.utils import Sorry
 
 from iotbx.pdb import amino_acid_codes as aac
 
-mon_lib_server = server.server()
 get_class = iotbx.pdb.common_residue_names_get_class
 
 from qrefine.utils import hierarchy_utils
@@ -259,7 +257,7 @@ def complete_pdb_hierarchy(hierarchy,
     from mmtbx.building import extend_sidechains
     n_changed = extend_sidechains.extend_protein_model(
       ppf.all_chain_proxies.pdb_hierarchy,
-      mon_lib_server,
+      hierarchy_utils.get_mon_lib_server(),
       add_hydrogens=False,
     )
 
@@ -0,0 +1,99 @@
+"""Residue contact graph built with a cell list.
+
+Two residues interact if any pair of their atoms is closer than cutoff. All
+atom pairs are found in one pass over a grid of cells of size cutoff, so the
+graph costs O(N) to build. Buffer queries for any number of clusters are then
+answered from the graph, with the same return values as
+mmtbx.pair_interaction.pair_interaction.run(ph, core). Residue and atom
+indices are 1-based, residues are numbered in hierarchy order.
+"""
+from __future__ import division
+from __future__ import absolute_import
+
+import math
+from scitbx.array_family import flex
+
+class contact_graph(object):
+  def __init__(self, pdb_hierarchy, cutoff=3.0):
+    self.cutoff = cutoff
+    residue_of_atom = self.set_residues(pdb_hierarchy)
+    sites_cart = pdb_hierarchy.atoms().extract_xyz()
+    assert sites_cart.size() == residue_of_atom.size()
+    if(sites_cart.size()>0):
+      self._build(sites_cart=sites_cart, residue_of_atom=residue_of_atom)
+
+  def set_residues(self, pdb_hierarchy):
+    """
+    Atom offsets of the residues, no contacts yet. Returns the residue index
+    of each atom.
+    """
+    self.offsets = [0]
+    residue_of_atom = flex.size_t()
+    for i_residue, rg in enumerate(pdb_hierarchy.residue_groups()):
+      residue_of_atom.extend(flex.size_t(rg.atoms_size(), i_residue))
+      self.offsets.append(self.offsets[-1] + rg.atoms_size())
+    self.n_residues = len(self.offsets)-1
+    self.neighbors = [set() for i in range(self.n_residues)]
+    return residue_of_atom
+
+  def add_interactions(self, interactions):
+    """
+    Add interacting residue pairs (1-based).
+    """
+    for i, j in interactions:
+      if(i == j): continue
+      self.neighbors[i-1].add(j-1)
+      self.neighbors[j-1].add(i-1)
+
+  def _build(self, sites_cart, residue_of_atom):
+    c = self.cutoff
+    x0, y0, z0 = sites_cart.min()
+    cells = {}
+    for i, (x, y, z) in enumerate(sites_cart):
+      key = (int(math.floor((x-x0)/c)), int(math.floor((y-y0)/c)),
+             int(math.floor((z-z0)/c)))
+      cells.setdefault(key, []).append(i)
+    for key in cells.keys():
+      cells[key] = flex.size_t(cells[key])
+    shifts = [(i,j,k) for i in (-1,0,1) for j in (-1,0,1) for k in (-1,0,1)]
+    for (a, b, d), members in cells.items():
+      candidates = flex.size_t()
+      for i, j, k in shifts:
+        cell = cells.get((a+i, b+j, d+k))
+        if(cell is not None): candidates.extend(cell)
+      candidate_sites = sites_cart.select(candidates)
+      candidate_residues = residue_of_atom.select(candidates)
+      for i_seq in members:
+        r = residue_of_atom[i_seq]
+        close = (candidate_sites - sites_cart[i_seq]).norms() < c
+        for s in set(candidate_residues.select(close)):
+          if(s != r):
+            self.neighbors[r].add(s)
+            self.neighbors[s].add(r)
+
+  def interaction_list(self):
+    """
+    Interacting residue pairs (i, j), i < j.
+    """
+    result = []
+    for i, neighbors in enumerate(self.neighbors):
+      for j in sorted(neighbors):
+        if(j > i): result.append((i+1, j+1))
+    return result
+
+  def atoms(self, residues):
+    result = []
+    for r in residues:
+      result.extend(range(self.offsets[r-1]+1, self.offsets[r]+1))
+    return result
+
+  def run(self, core):
+    """
+    Atoms of the core residues, atoms and residues of the core plus the
+    residues interacting with it.
+    """
+    molecules = set(core)
+    for r in core:
+      molecules.update([s+1 for s in self.neighbors[r-1]])
+    molecules = sorted(molecules)
+    return self.atoms(sorted(core)), self.atoms(molecules), molecules
@@ -178,7 +178,7 @@ class clustering_update(object):
     print(rmsd_diff, self.rmsd_tolerance)
     if(rmsd_diff > self.rmsd_tolerance):
       print(" rmsd_diff: ", rmsd_diff, "--> need to redo clustering", file=self.log)
-      calculator.restraints_manager.fragment_manager.set_up_cluster_qm()
+      calculator.restraints_manager.fragment_manager.update_clusters(log=self.log)
       self.pre_sites_cart = sites_cart
 
 class minimizer_ase(object):
@@ -246,6 +246,17 @@ class minimizer_ase(object):
       v = self.step()
       if(not v): return
 
+def show_qm_cache(calculator):
+  """
+  Statistics of the QM result cache, kept by from_qm directly or behind
+  from_cluster.
+  """
+  rm = getattr(calculator, "restraints_manager", None)
+  rm = getattr(rm, "restraints_manager", rm)
+  qm_cache = getattr(rm, "qm_cache", None)
+  if(qm_cache is not None):
+    qm_cache.show(log=log)
+
 def run_minimize(calculator, params, geometry_rmsd_manager, mode):
   minimized = None
   if  (mode == "weight"):
@@ -451,6 +462,7 @@ def refine(fmodel,
     if(minimized is None): continue
     monitor.update(fmodel = fmodel)
     monitor.show(prefix="%d:"%refine_cycle, suffix="n_fev: %d"%n_fev)
+    show_qm_cache(calculator)
     monitor.write_pdb_file(
       output_folder_name = params.output_folder_name,
       output_file_name   = str(refine_cycle)+"_refine_cycle.pdb")
@@ -498,6 +510,7 @@ def opt(model, params, monitor, calculator):
 
     monitor.update(model = model)
     monitor.show(prefix="cycle %d: "%micro_cycle)
+    show_qm_cache(calculator)
     monitor.write_pdb_file(
       output_folder_name = params.output_folder_name,
       output_file_name   = str(micro_cycle)+"_opt_cycle.pdb")
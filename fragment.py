@@ -2,6 +2,8 @@ from __future__ import print_function
 from __future__ import absolute_import
 import os
 import copy
+import shutil
+import hashlib
 import itertools
 import libtbx.load_env
 from libtbx.utils import Sorry
@@ -11,9 +13,15 @@ from libtbx import group_args
 from qrefine.super_cell import expand
 #import qrefine.completion as model_completion
 from . import completion
+from . import capping
 from .charges import charges_class
+from .charges import default_ion_charges, get_mon_lib_server
+from .charges import get_partial_point_charges, write_point_charges
+from .charges import match_positions, get_formal_charge
 from mmtbx.pair_interaction import pair_interaction
+from .contact_graph import contact_graph
 from functools import cmp_to_key
+from collections import Counter
 
 qrefine = libtbx.env.find_in_repositories("qrefine")
 
@@ -40,8 +48,150 @@ def check_selection_integrity(atoms, indices, verbose=False):
 def check_hierarchy(hierarchy, verbose=False):
   check_atoms_integrity(hierarchy.atoms(), verbose=verbose)
 
+def selected_atom_indices_in_entire_ph(selected_atom_indices_in_sub_ph, sub_ph):
+  selected = set(selected_atom_indices_in_sub_ph)
+  selected_atom_indices_in_entire_ph = []
+  for index, number in enumerate(sub_ph.atoms().extract_serial()):
+    if(index+1 in selected):
+      selected_atom_indices_in_entire_ph.append(int(number))
+  return selected_atom_indices_in_entire_ph
+
+class fragment_index(object):
+  """
+  Array-backed (CSR) index of clusters and fragments. For fragment i:
+    super[super_offsets[i]:super_offsets[i+1]]        fragment atoms in the
+      super-sphere (QM part), sorted, so atoms of the model come first
+    cluster[cluster_offsets[i]:cluster_offsets[i+1]]  cluster atoms
+    cluster_positions[...same offsets...]             positions of the cluster
+      atoms in the fragment (and in its gradients)
+    buffer[buffer_offsets[i]:buffer_offsets[i+1]]     buffer atoms of the model
+    scales[scale_offsets[i]:scale_offsets[i+1]]       gradient scales of the
+      fragment atoms of the model
+  Atom indices are 0-based i_seqs, the first system_size atoms of the
+  super-sphere are the model.
+  """
+  def __init__(self, system_size):
+    self.system_size     = system_size
+    self.super           = flex.size_t()
+    self.super_offsets   = flex.size_t([0])
+    self.cluster         = flex.size_t()
+    self.cluster_offsets = flex.size_t([0])
+    self.cluster_positions = flex.size_t()
+    self.buffer          = flex.size_t()
+    self.buffer_offsets  = flex.size_t([0])
+    self.scales          = flex.double()
+    self.scale_offsets   = flex.size_t([0])
+    self.keys            = {}
+
+  @classmethod
+  def from_serials(cls, system_size, cluster_atoms, fragment_super_atoms,
+                   fragment_scales):
+    """
+    From lists of 1-based serials; fragment_scales[i] follows the order of the
+    model atoms in fragment_super_atoms[i].
+    """
+    result = cls(system_size=system_size)
+    for c, f, s in zip(cluster_atoms, fragment_super_atoms, fragment_scales):
+      result.append(
+        cluster_iselection = flex.size_t([i-1 for i in c]),
+        super_iselection   = flex.size_t([i-1 for i in f]),
+        scales             = flex.double(s))
+    return result
+
+  def append(self, cluster_iselection, super_iselection, scales):
+    center = super_iselection < self.system_size
+    assert center.count(True) == scales.size()
+    all_scales = flex.double(super_iselection.size(), 0)
+    all_scales = all_scales.set_selected(center.iselection(), scales)
+    order = flex.sort_permutation(super_iselection)
+    super_iselection = super_iselection.select(order)
+    n_center = scales.size()
+    fragment = super_iselection[:n_center]
+    buffer_iselection = flex.size_t(sorted(
+      set(fragment).difference(set(cluster_iselection))))
+    cluster_iselection = flex.size_t(sorted(cluster_iselection))
+    position = dict([(i_seq, i) for i, i_seq in enumerate(fragment)])
+    self.super.extend(super_iselection)
+    self.super_offsets.append(self.super.size())
+    self.cluster.extend(cluster_iselection)
+    self.cluster_positions.extend(
+      flex.size_t([position[i_seq] for i_seq in cluster_iselection]))
+    self.cluster_offsets.append(self.cluster.size())
+    self.buffer.extend(buffer_iselection)
+    self.buffer_offsets.append(self.buffer.size())
+    self.scales.extend(all_scales.select(order)[:n_center])
+    self.scale_offsets.append(self.scales.size())
+
+  def size(self):
+    return self.super_offsets.size()-1
+
+  def fragment_size(self, i):
+    """
+    Number of model atoms in fragment i.
+    """
+    return self.scale_offsets[i+1]-self.scale_offsets[i]
+
+  def super_iselection(self, i):
+    return self.super[self.super_offsets[i]:self.super_offsets[i+1]]
+
+  def fragment_iselection(self, i):
+    start = self.super_offsets[i]
+    return self.super[start:start+self.fragment_size(i)]
+
+  def cluster_iselection(self, i):
+    return self.cluster[self.cluster_offsets[i]:self.cluster_offsets[i+1]]
+
+  def cluster_positions_in_fragment(self, i):
+    return self.cluster_positions[
+      self.cluster_offsets[i]:self.cluster_offsets[i+1]]
+
+  def buffer_iselection(self, i):
+    return self.buffer[self.buffer_offsets[i]:self.buffer_offsets[i+1]]
+
+  def fragment_scales(self, i):
+    return self.scales[self.scale_offsets[i]:self.scale_offsets[i+1]]
+
+  def fragment_key(self, i):
+    """
+    Identity of fragment i that does not depend on its index: hash of its
+    cluster and super-sphere atoms.
+    """
+    if(i not in self.keys):
+      h = hashlib.sha1()
+      for isel in [self.cluster_iselection(i), self.super_iselection(i)]:
+        h.update(",".join([str(i_seq) for i_seq in isel]).encode())
+        h.update(b";")
+      self.keys[i] = h.hexdigest()
+    return self.keys[i]
+
+  def fragment_keys(self):
+    return [self.fragment_key(i) for i in range(self.size())]
+
+class pair_interaction_graph(contact_graph):
+  """
+  Density based interaction graph (mmtbx.pair_interaction), same interface as
+  contact_graph. The interactions of all residues are computed once, buffer
+  queries for clusters are answered from them.
+  """
+  def __init__(self, pdb_hierarchy):
+    self.set_residues(pdb_hierarchy)
+    self.interactions = pair_interaction.run(
+      copy.deepcopy(pdb_hierarchy))  ##deepcopy
+    self.add_interactions(self.interactions)
+
+  def interaction_list(self):
+    return list(self.interactions)
+
 class fragments(object):
 
+  # per-fragment data, the lists are parallel to the fragment index
+  fragment_hierarchy_data_names = [
+    "fragment_charges",
+    "fragment_capped_initial",
+    "capping_templates",
+    "embedding_iselections",
+    "embedding_charges"]
+
   def __init__(self,
       working_folder             = "ase",
       make_working_folder        = True, # A way to not make it if not needed
@@ -60,8 +210,19 @@ class fragments(object):
       save_clusters              = False,
       select_within_radius       = 10.0,
       clusters_only              = False,
-      bond_with_altloc_flag      = True):
+      bond_with_altloc_flag      = True,
+      incremental_reclustering   = False,
+      residue_shift_threshold    = 0.3,
+      interaction_method         = "pair_interaction",
+      contact_cutoff             = 3.0,
+      validate_fragment_charges  = False):
     #
+    assert interaction_method in ["pair_interaction", "contact_graph"]
+    self.interaction_method = interaction_method
+    self.contact_cutoff = contact_cutoff
+    self.validate_fragment_charges = validate_fragment_charges
+    self.incremental_reclustering = incremental_reclustering
+    self.residue_shift_threshold = residue_shift_threshold
     self.bond_with_altloc_flag = bond_with_altloc_flag
     self.select_within_radius = select_within_radius
     self.charge_embedding = charge_embedding
@@ -84,12 +245,28 @@ class fragments(object):
     self.clusters = None
     self.clusters_only = clusters_only
     self.charge_service = None
+    self.point_charges = None
+    self.capper = capping.capper()
+    self.bond_table = None
+    # fragment index -> cctbx restraints of the fragment, see
+    # get_fragment_restraints()
+    self.fragment_restraints = {}
+    self.n_clusterings = 0
+    self.clustering_sites_cart = None
+    self.fragment_index = None
     #
     if(os.path.exists(self.working_folder) is not True):
       if(make_working_folder):
         os.mkdir(self.working_folder)
     self.backbone_connections = fragment_utils.get_backbone_connections(
       self.pdb_hierarchy)
+    # atom indices of each residue, in the residue order of pair_interaction
+    self.residue_iselections = []
+    start = 0
+    for rg in self.pdb_hierarchy.residue_groups():
+      self.residue_iselections.append(
+        flex.size_t(range(start, start+rg.atoms_size())))
+      start += rg.atoms_size()
     self.altloc_atoms = [atom for atom in list(pdb_hierarchy.atoms())
                            if atom.pdb_label_columns()[4]!=" "]
     self._expand()
@@ -111,14 +288,30 @@ class fragments(object):
     self.pdb_hierarchy_super = self.expansion.ph_super_sphere
 
   def set_up_cluster_qm(self):
+    self.n_clusterings += 1
+    self.bond_table = None
+    self.fragment_restraints = {}
     self.get_clusters()
     if not self.clusters_only:
       self.get_fragments()
       self.get_fragment_hierarchies_and_charges()
+    self.clustering_sites_cart = \
+      self.pdb_hierarchy_super.atoms().extract_xyz().deep_copy()
 
   def get_clusters(self):
+    self.pair_interactions = self.get_interaction_graph(
+      self.pdb_hierarchy).interaction_list()
+    self.cluster_interactions()
+
+  def get_interaction_graph(self, pdb_hierarchy):
+    if(self.interaction_method == "contact_graph"):
+      return contact_graph(pdb_hierarchy=pdb_hierarchy,
+        cutoff=self.contact_cutoff)
+    return pair_interaction_graph(pdb_hierarchy=pdb_hierarchy)
+
+  def cluster_interactions(self):
     n_residues=len(list(self.pdb_hierarchy.residue_groups()))
-    self.interaction_list = pair_interaction.run(copy.deepcopy(self.pdb_hierarchy))  ##deepcopy
+    self.interaction_list = list(self.pair_interactions)
     self.interaction_list += self.backbone_connections # XXX WHY IS THIS?
     ## isolate altloc molecules
     from . import clustering
@@ -130,15 +323,152 @@ class fragments(object):
     self.clusters=sorted(clusters,
       key=cmp_to_key(lambda x, y: 1 if len(x) < len(y) else -1 if len(x) > len(y) else 0))
 
-  def get_fragments(self):
+  def update_clusters(self, radius=5.0, log=None):
+    """
+    Re-cluster after the model moved. In incremental mode only pair
+    interactions of residues that moved by more than residue_shift_threshold
+    are recomputed, and only fragments whose cluster changed or that have a
+    moved atom within radius of their cluster or buffer (within charge_cutoff
+    with charge embedding) are rebuilt. Other fragments keep their capping,
+    charges and QM scratch folder. Models with altlocs and two buffers are
+    always re-clustered from scratch.
+    """
+    if(not self.incremental_reclustering or self.clusters_only or
+       self.two_buffers or self.clustering_sites_cart is None or
+       self.pdb_hierarchy_super.altloc_indices().size()>1):
+      self.set_up_cluster_qm()
+      return
+    sites_cart_super = self.pdb_hierarchy_super.atoms().extract_xyz()
+    moved = (sites_cart_super - self.clustering_sites_cart).norms() > \
+      self.residue_shift_threshold
+    if(moved.count(True)==0): return
+    self.n_clusterings += 1
+    self.bond_table = None
+    self.fragment_restraints = {}
+    moved_center = moved[:self.system_size]
+    moved_residues = [i+1 for i, isel in enumerate(self.residue_iselections)
+                      if moved_center.select(isel).count(True)>0]
+    if(len(moved_residues)>0):
+      self.update_pair_interactions(residues=moved_residues, radius=radius)
+    old_clusters = self.clusters
+    old_entries = [self.get_fragment_entry(i) for i in range(len(old_clusters))]
+    self.cluster_interactions()
+    xrs_super = self.pdb_hierarchy_super.extract_xray_structure(
+      crystal_symmetry=self.expansion.cs_box)
+    # moved atoms near the fragment change its buffer, capping or embedding
+    if(self.charge_embedding and self.charge_cutoff is not None):
+      radius = max(radius, self.charge_cutoff)
+    affected = xrs_super.selection_within(radius=radius, selection=moved)
+    old_index = {}
+    for i, cluster in enumerate(old_clusters):
+      old_index[frozenset(cluster)] = i
+    entries = [None]*len(old_entries)
+    rebuilt = []
+    for cluster in self.clusters:
+      i = old_index.get(frozenset(cluster))
+      if(i is not None and
+         affected.select(old_entries[i].super_iselection).count(True)==0):
+        entries[i] = old_entries[i]
+      else:
+        rebuilt.append(cluster)
+    free = [i for i, e in enumerate(entries) if e is None]
+    self.pdb_hierarchy_super.atoms_reset_serial()
+    if(len(rebuilt)>0):
+      graph = self.get_interaction_graph(self.pdb_hierarchy_super)
+    for cluster in rebuilt:
+      entry = self.get_new_fragment_entry(cluster=cluster, graph=graph)
+      if(len(free)>0):
+        i = free.pop(0)
+        entries[i] = entry
+      else:
+        i = len(entries)
+        entries.append(entry)
+      self.clear_scratch(i)
+    # fill the holes left by fragments that disappeared
+    while(len(entries)>0 and entries[-1] is None): entries.pop()
+    for i in range(len(entries)):
+      if(i >= len(entries)): break
+      if(entries[i] is None):
+        self.move_scratch(len(entries)-1, i)
+        entries[i] = entries.pop()
+        while(len(entries)>0 and entries[-1] is None): entries.pop()
+    self.clusters = [e.cluster for e in entries]
+    self.fragment_index = fragment_index(system_size=self.system_size)
+    for e in entries:
+      self.fragment_index.append(
+        cluster_iselection = e.cluster_iselection,
+        super_iselection   = e.super_iselection,
+        scales             = e.scales)
+    for name in self.fragment_hierarchy_data_names:
+      setattr(self, name, [getattr(e, name) for e in entries])
+    self.clustering_sites_cart = self.clustering_sites_cart.set_selected(
+      moved, sites_cart_super.select(moved))
+    print("re-clustering: %d fragments kept, %d rebuilt"%(
+      len(entries)-len(rebuilt), len(rebuilt)), file=log)
+
+  def update_pair_interactions(self, residues, radius):
+    """
+    Recompute the pair interactions of residues (1-based indices) using the
+    residues within radius of them.
+    """
+    residues = set(residues)
+    selection = flex.bool(self.system_size, False)
+    for r in residues:
+      selection.set_selected(self.residue_iselections[r-1], True)
+    xrs = self.pdb_hierarchy.extract_xray_structure(
+      crystal_symmetry=self.expansion.cs_box)
+    within = xrs.selection_within(radius=radius, selection=selection)
+    sub_residues = [i+1 for i, isel in enumerate(self.residue_iselections)
+                    if within.select(isel).count(True)>0]
+    sub_selection = flex.bool(self.system_size, False)
+    for r in sub_residues:
+      sub_selection.set_selected(self.residue_iselections[r-1], True)
+    pairs = self.get_interaction_graph(
+      self.pdb_hierarchy.select(sub_selection)).interaction_list()
+    pairs = [(sub_residues[i-1], sub_residues[j-1]) for i, j in pairs]
+    self.pair_interactions = [p for p in self.pair_interactions
+      if not (p[0] in residues or p[1] in residues)]
+    self.pair_interactions += [p for p in pairs
+      if (p[0] in residues or p[1] in residues)]
 
-    def selected_atom_indices_in_entire_ph(selected_atom_indices_in_sub_ph, sub_ph):
-      selected_atom_indices_in_entire_ph = []
-      for index, number in enumerate(sub_ph.atoms().extract_serial()):
-        if(index+1 in selected_atom_indices_in_sub_ph):
-          selected_atom_indices_in_entire_ph.append(int(number))
-      return selected_atom_indices_in_entire_ph
+  def get_fragment_entry(self, i):
+    entry = group_args(
+      cluster            = self.clusters[i],
+      cluster_iselection = self.fragment_index.cluster_iselection(i),
+      super_iselection   = self.fragment_index.super_iselection(i),
+      scales             = self.fragment_index.fragment_scales(i))
+    for name in self.fragment_hierarchy_data_names:
+      setattr(entry, name, getattr(self, name)[i])
+    return entry
 
+  def get_new_fragment_entry(self, cluster, graph):
+    ph = self.pdb_hierarchy_super
+    atoms_in_one_cluster, atoms_in_one_fragment, _ = graph.run(cluster)
+    cluster_atoms = selected_atom_indices_in_entire_ph(atoms_in_one_cluster, ph)
+    fragment_super_atoms = selected_atom_indices_in_entire_ph(
+      atoms_in_one_fragment, ph)
+    check_selection_integrity(ph.atoms(), cluster_atoms)
+    super_iselection = flex.size_t(sorted([i-1 for i in fragment_super_atoms]))
+    entry = self.get_fragment_hierarchy_and_charge(
+      super_iselection = super_iselection)
+    entry.cluster = cluster
+    entry.cluster_iselection = flex.size_t([i-1 for i in cluster_atoms])
+    entry.super_iselection = super_iselection
+    entry.scales = flex.double(
+      (super_iselection < self.system_size).count(True), 1.0)
+    return entry
+
+  def clear_scratch(self, index):
+    folder = os.path.join(self.working_folder, str(index))
+    if(os.path.isdir(folder)): shutil.rmtree(folder)
+
+  def move_scratch(self, index_from, index_to):
+    self.clear_scratch(index_to)
+    folder = os.path.join(self.working_folder, str(index_from))
+    if(os.path.isdir(folder)):
+      os.rename(folder, os.path.join(self.working_folder, str(index_to)))
+
+  def get_fragments(self):
     self.pdb_hierarchy_super.atoms_reset_serial()
     phs = [self.pdb_hierarchy_super]
     altloc_size = self.pdb_hierarchy_super.altloc_indices().size()
@@ -161,13 +491,15 @@ class fragments(object):
     ##fragment consists of cluster and buffer
     ##all pdb_hierarchies have the same clusters at molecular level
     for ph in phs:
+      # one graph per hierarchy answers the buffer queries of all clusters
+      graph = self.get_interaction_graph(ph)
       cluster_atoms_in_ph = []
       fragment_super_atoms_in_ph = []
       molecules_in_fragments = []
       for i in range(len(clusters)):
         # print 'processing cluster', i
         atoms_in_one_cluster, atoms_in_one_fragment, molecules_in_one_fragment = \
-          pair_interaction.run(copy.deepcopy(ph), clusters[i])  ##deepcopy
+          graph.run(clusters[i])
         # print("clusters[i]",clusters[i])
         # print("molecules_in_one_fragment:", molecules_in_one_fragment)
         # print("atoms_in_one_fragment",atoms_in_one_fragment)
@@ -187,7 +519,7 @@ class fragments(object):
         # print "adding second layer"
         fragment_super_atoms_in_ph = []
         for molecules in molecules_in_fragments:
-          junk1,atoms_in_one_fragment,junk2 = pair_interaction.run(copy.deepcopy(ph),molecules)
+          junk1,atoms_in_one_fragment,junk2 = graph.run(molecules)
           atoms_in_one_fragment = selected_atom_indices_in_entire_ph(
                                                      atoms_in_one_fragment, ph)
           fragment_super_atoms_in_ph.append(atoms_in_one_fragment)
@@ -195,11 +527,12 @@ class fragments(object):
       fragment_super_atoms_in_phs.append(fragment_super_atoms_in_ph)
     #
     ##always collect the clustering result from phs[0]
-    self.cluster_atoms = []
-    self.fragment_super_atoms = []
-    self.fragment_scales = []
+    result = group_args(
+      cluster_atoms        = [],
+      fragment_super_atoms = [],
+      fragment_scales      = [])
     for i_cluster in range(len(clusters)):
-      self.collect_cluster_and_fragment(cluster_atoms_in_phs,
+      self.collect_cluster_and_fragment(result, cluster_atoms_in_phs,
                                     fragment_super_atoms_in_phs, i_cluster, 0)
     ##check alternative locations and get all clusters and fragments
     overlap_clusters={}
@@ -217,7 +550,7 @@ class fragments(object):
           empty_overlap_cluster = (len(overlap_atoms_in_one_cluster)==0)
           #substract the contribution from overlap
           if(self.altloc_method=="subtract"):
-            self.collect_cluster_and_fragment(cluster_atoms_in_phs,
+            self.collect_cluster_and_fragment(result, cluster_atoms_in_phs,
                               fragment_super_atoms_in_phs, i_cluster, j_ph)
             # different fragments for different altloc clusters
             if(empty_overlap_cluster):continue
@@ -233,16 +566,16 @@ class fragments(object):
                                   i_cluster,
                                   j_ph)
               check_selection_integrity(atoms, overlap_atoms_in_one_fragment)
-              self.cluster_atoms.append(list(overlap_atoms_in_one_cluster))
-              self.fragment_super_atoms.append(list(overlap_atoms_in_one_fragment))
+              result.cluster_atoms.append(list(overlap_atoms_in_one_cluster))
+              result.fragment_super_atoms.append(list(overlap_atoms_in_one_fragment))
               scale_list = [-1.0]*sum(i <= self.system_size
                                       for i in overlap_atoms_in_one_fragment)
-              self.fragment_scales.append(scale_list)
+              result.fragment_scales.append(scale_list)
           ##average the contributions from overlap
           elif(self.altloc_method=="average"):
             # different fragments for different altloc clusters
             if(empty_overlap_cluster):
-              self.collect_cluster_and_fragment(cluster_atoms_in_phs,
+              self.collect_cluster_and_fragment(result, cluster_atoms_in_phs,
                               fragment_super_atoms_in_phs, i_cluster, j_ph)
             else:
             # two same non-altloc clusters, the overlap is a cluster
@@ -262,29 +595,36 @@ class fragments(object):
     overlap_atoms = []
     for i_cluster, overlap_cluster in overlap_clusters.items():
       overlap_atoms = overlap_atoms+list(itertools.chain.from_iterable(
-        overlap_cluster +[self.cluster_atoms[i_cluster]]))#[atom_index, atom_index]
-    frequency_overlap_atoms =  {x:overlap_atoms.count(x) for x in overlap_atoms}#{atom_index,frequency}
+        overlap_cluster +[result.cluster_atoms[i_cluster]]))#[atom_index, atom_index]
+    frequency_overlap_atoms = Counter(overlap_atoms)#{atom_index,frequency}
     for i_cluster, clusters in overlap_clusters.items():
       ## reset the fragment scale for the ith fragment in ph[0]
-      for index, atom in enumerate([i for i in self.fragment_super_atoms[i_cluster]
+      cluster_atoms = set(result.cluster_atoms[i_cluster])
+      for index, atom in enumerate([i for i in result.fragment_super_atoms[i_cluster]
                                        if i <= self.system_size]):
-          if(atom in self.cluster_atoms[i_cluster] and
-             atom in frequency_overlap_atoms.keys() and
+          if(atom in cluster_atoms and
+             atom in frequency_overlap_atoms and
                not self.bond_with_altloc(atom, self.bond_with_altloc_flag)):
-              self.fragment_scales[i_cluster][index] = \
+              result.fragment_scales[i_cluster][index] = \
                 1.0/frequency_overlap_atoms[atom]
       ## add overlap clusters and fragments
       for index, fragment_super in  enumerate(overlap_fragments_super[i_cluster]):
          scale_list = []
+         cluster_atoms = set(clusters[index])
          for atom in [i for i in fragment_super if i <= self.system_size]:
-           if(atom in clusters[index] and atom in frequency_overlap_atoms.keys()
+           if(atom in cluster_atoms and atom in frequency_overlap_atoms
               and not self.bond_with_altloc(atom, self.bond_with_altloc_flag)):
 
              scale_list.append(1.0/frequency_overlap_atoms[atom])
            else: scale_list.append(1.0)
-         self.cluster_atoms.append(clusters[index])
-         self.fragment_super_atoms.append(fragment_super)
-         self.fragment_scales.append(scale_list)
+         result.cluster_atoms.append(clusters[index])
+         result.fragment_super_atoms.append(fragment_super)
+         result.fragment_scales.append(scale_list)
+    self.fragment_index = fragment_index.from_serials(
+      system_size          = self.system_size,
+      cluster_atoms        = result.cluster_atoms,
+      fragment_super_atoms = result.fragment_super_atoms,
+      fragment_scales      = result.fragment_scales)
 
   def bond_with_altloc(self, atom_index, bond_with_altloc_flag):
     if(not bond_with_altloc_flag): return False
@@ -305,187 +645,293 @@ class fragments(object):
                                    set(cluster_atoms_in_phs[j_ph][i_cluster])
     return overlap_atoms_in_one_cluster
 
-  def collect_cluster_and_fragment(self, cluster_atoms_in_phs,
+  def collect_cluster_and_fragment(self, result, cluster_atoms_in_phs,
                                 fragment_super_atoms_in_phs, i_cluster, j_ph):
-    self.cluster_atoms.append(cluster_atoms_in_phs[j_ph][i_cluster])
-    self.fragment_super_atoms.append(fragment_super_atoms_in_phs[j_ph][i_cluster])
+    result.cluster_atoms.append(cluster_atoms_in_phs[j_ph][i_cluster])
+    result.fragment_super_atoms.append(fragment_super_atoms_in_phs[j_ph][i_cluster])
     scale_list = [1.0]*sum(i <= self.system_size
                           for i in fragment_super_atoms_in_phs[j_ph][i_cluster])
-    self.fragment_scales.append(scale_list)
+    result.fragment_scales.append(scale_list)
 
   def get_fragment_hierarchies_and_charges(self):
+    for name in self.fragment_hierarchy_data_names:
+      setattr(self, name, [])
+    for i in range(self.fragment_index.size()):
+      entry = self.get_fragment_hierarchy_and_charge(
+        super_iselection = self.fragment_index.super_iselection(i))
+      for name in self.fragment_hierarchy_data_names:
+        getattr(self, name).append(getattr(entry, name))
+
+  def get_bond_table(self):
+    # bonds of the super sphere, found once per clustering for all fragments
+    if(self.bond_table is None):
+      self.bond_table = capping.bond_table(self.pdb_hierarchy_super)
+    return self.bond_table
 
-    def pdb_hierarchy_select(atoms_size, selection):
-      selection_array = flex.bool(atoms_size, False)
-      for item in selection:
-        if(item<=atoms_size):
-          selection_array[item-1] = True
-      return selection_array
-
-    self.fragment_selections = []
-    self.fragment_super_selections = []
-    self.fragment_charges = []
-    self.cluster_selections = []
-    self.buffer_selections = []
-    self.cluster_selections = []
-    self.fragment_capped_initial = []
-    for i in range(len(self.fragment_super_atoms)):
-      fragment_selection = pdb_hierarchy_select(
-          self.pdb_hierarchy.atoms_size(),
-          self.fragment_super_atoms[i])
-      ## QM part is fragment_super
-      fragment_super_selection = pdb_hierarchy_select(
-        self.pdb_hierarchy_super.atoms_size(),
-        self.fragment_super_atoms[i])
-      fragment_super_hierarchy = self.pdb_hierarchy_super.select(
-        fragment_super_selection)
+  def get_fragment_hierarchy_and_charge(self, super_iselection):
+    ## QM part is fragment_super
+    fragment_super_hierarchy = self.pdb_hierarchy_super.select(
+      super_iselection)
+    bonds = self.get_bond_table().select(super_iselection)
+    charge_hierarchy = self.capper.cap(fragment_super_hierarchy, bonds=bonds)
+    if(charge_hierarchy is None):
       charge_hierarchy = completion.run(pdb_hierarchy=fragment_super_hierarchy,
                       crystal_symmetry=self.expansion.cs_box,
                       model_completion=False,
                       original_pdb_filename=self.expansion_file)
-      self.fragment_capped_initial.append(charge_hierarchy)
-      raw_records = charge_hierarchy.as_pdb_string(
-        crystal_symmetry=self.expansion.cs_box)
+      self.capper.harvest(fragment_super_hierarchy, charge_hierarchy,
+        bonds=bonds)
+    capping_template = capping.get_template(
+      hierarchy        = fragment_super_hierarchy,
+      capped_hierarchy = charge_hierarchy,
+      neighbors        = bonds.neighbors)
+    fragment_charge = self.get_fragment_charge(charge_hierarchy)
+    check_hierarchy(fragment_super_hierarchy)
+    embedding = group_args(iselection = None, charges = None)
+    if(self.charge_embedding):
+      embedding = self.get_embedding(super_iselection = super_iselection)
+    return group_args(
+      fragment_charges          = fragment_charge,
+      fragment_capped_initial   = charge_hierarchy,
+      capping_templates         = capping_template,
+      embedding_iselections     = embedding.iselection,
+      embedding_charges         = embedding.charges)
 
+  def get_fragment_charge(self, capped_hierarchy):
+    """
+    Sum of memoized residue charges; electron counting on the whole capped
+    fragment for other residues (e.g. ligands), if that fails (e.g. altlocs)
+    or to validate it.
+    """
+    charge = None
+    try:
+      charge = get_formal_charge(capped_hierarchy)
+    except (Sorry, AssertionError) as e:
+      if(self.debug): print("residue charges failed:", str(e))
+    if(charge is None or self.validate_fragment_charges):
       self.charge_service = charges_class(
-        pdb_hierarchy=charge_hierarchy,
+        pdb_hierarchy=capped_hierarchy,
         crystal_symmetry=self.expansion.cs_box).get_total_charge()
-      self.fragment_super_selections.append(fragment_super_selection)
-      #
-      self.fragment_selections.append(fragment_selection)
-      self.fragment_charges.append(self.charge_service)
-      cluster_selection = pdb_hierarchy_select(
-        self.pdb_hierarchy.atoms_size(), self.cluster_atoms[i])
-      self.cluster_selections.append(cluster_selection)
-      s = fragment_selection==cluster_selection
-      buffer_selection = fragment_selection.deep_copy().set_selected(s, False)
-      self.buffer_selections.append(buffer_selection)
-      check_hierarchy(fragment_super_hierarchy)
+      if(charge is not None and charge != self.charge_service):
+        print("Fragment charge from residues %d differs from electron count %d"%(
+          charge, self.charge_service))
+      charge = self.charge_service
+    return charge
+
+  def get_point_charges(self, iselection):
+    """
+    Partial charges of the super-sphere atoms in iselection. Residues are
+    charged the first time one of their atoms is embedded; the composition
+    of the super-sphere does not change with coordinates. Raises only for
+    atoms in iselection.
+    """
+    ph = self.pdb_hierarchy_super
+    if(self.point_charges is None):
+      self.point_charges = group_args(
+        charges = flex.double(ph.atoms_size(), 0),
+        is_set  = flex.bool(ph.atoms_size(), False))
+    pc = self.point_charges
+    missing = flex.bool(ph.atoms_size(), iselection) & ~pc.is_set
+    if(missing.count(True) > 0):
+      mon_lib_server = get_mon_lib_server()
+      start = 0
+      for rg in ph.residue_groups():
+        end = start + rg.atoms_size()
+        if(missing[start:end].count(True) > 0):
+          items = get_partial_point_charges(rg, mon_lib_server,
+            hetero_charges=default_ion_charges)
+          for i, (item, atom) in enumerate(zip(items, rg.atoms())):
+            if(item[0] is not None):
+              pc.charges[start+i] = item[0]
+              pc.is_set[start+i] = True
+            elif(missing[start+i]):
+              raise Sorry("point charge is not set for %s" % atom.quote())
+        start = end
+      assert start == ph.atoms_size()
+    return pc.charges.select(iselection)
+
+  def get_embedding(self, super_iselection):
+    """
+    Point-charge environment of a fragment: super-sphere atoms within
+    charge_cutoff of it (same conformer) and their partial charges, zero at
+    the backbone atoms next to the chain breaks made by the fragment.
+    """
+    ph = self.pdb_hierarchy_super
+    fragment_selection = flex.bool(ph.atoms_size(), super_iselection)
+    if(self.charge_cutoff is not None):
+      xrs = ph.extract_xray_structure(crystal_symmetry=self.expansion.cs_box)
+      selection = xrs.selection_within(
+        radius    = self.charge_cutoff,
+        selection = fragment_selection)
+      selection = selection & ~fragment_selection
+    else:
+      selection = ~fragment_selection
+    atom_altlocs = [a.parent().altloc.strip() for a in ph.atoms()]
+    if(len(set(atom_altlocs))>1):
+      fragment_altlocs = sorted(set([atom_altlocs[i] for i in super_iselection]))
+      if(len(fragment_altlocs)==2): keep = fragment_altlocs[1]
+      else:                         keep = fragment_altlocs[0]
+      conformer = flex.bool([a in ["", keep] for a in atom_altlocs])
+      selection = selection & conformer
+      ph = ph.select(conformer)
+    iselection = selection.iselection()
+    charges = self.get_point_charges(iselection)
+    non_fragment_hierarchy = self.pdb_hierarchy_super.select(iselection)
+    edge_positions = fragment_utils.get_edge_atom_positions(
+      ph, non_fragment_hierarchy, charge_embed=True)
+    charges = charges.set_selected(flex.size_t(match_positions(
+      non_fragment_hierarchy.atoms().extract_xyz(), list(edge_positions))), 0)
+    return group_args(iselection = iselection, charges = charges)
+
+  # Selections as full-size flex.bool arrays, built from the fragment index
+  # on request (convenience for scripts and tests).
+
+  def _selections(self, get_iselection, size):
+    return [flex.bool(size, get_iselection(i))
+            for i in range(self.fragment_index.size())]
+
+  @property
+  def fragment_selections(self):
+    return self._selections(self.fragment_index.fragment_iselection,
+      self.system_size)
+
+  @property
+  def fragment_super_selections(self):
+    return self._selections(self.fragment_index.super_iselection,
+      self.pdb_hierarchy_super.atoms_size())
+
+  @property
+  def cluster_selections(self):
+    return self._selections(self.fragment_index.cluster_iselection,
+      self.system_size)
+
+  @property
+  def buffer_selections(self):
+    return self._selections(self.fragment_index.buffer_iselection,
+      self.system_size)
 
   def get_fragment_extracts(self):
     return group_args(
-      cluster_selections        = self.cluster_selections,
+      fragment_index            = self.fragment_index,
       fragment_charges          = self.fragment_charges,
-      fragment_selections       = self.fragment_selections,
-      fragment_super_selections = self.fragment_super_selections,
       fragment_capped_initial   = self.fragment_capped_initial,
+      capping_templates         = self.capping_templates,
+      capper                    = self.capper,
       working_folder            = self.working_folder,
-      fragment_super_atoms      = self.fragment_super_atoms,
-      cluster_atoms             = self.cluster_atoms,
       qm_engine_name            = self.qm_engine_name,
       charge_embedding          = self.charge_embedding,
       crystal_symmetry          = self.crystal_symmetry,
       pdb_hierarchy             = self.pdb_hierarchy,
       pdb_hierarchy_super       = self.pdb_hierarchy_super,
       expansion_cs              = self.expansion.cs_box,
-      buffer_selections         = self.buffer_selections,
-      fragment_scales           = self.fragment_scales,
       debug                     = self.debug,
-      charge_service            = self.charge_service,
+      embedding_iselections     = self.embedding_iselections,
+      embedding_charges         = self.embedding_charges,
       charge_cutoff             = self.charge_cutoff,
       expansion_file            = self.expansion_file,
       save_clusters             = self.save_clusters,
+      n_clusterings             = self.n_clusterings,
+      fragment_restraints       = self.fragment_restraints,
       super_sphere_geometry_restraints_manager = \
         self.expansion.super_sphere_geometry_restraints_manager)
 
+# file name -> clustering it was last written for, in this process
+_written_files = {}
+
+def write_pdb_file(fragment_extracts, hierarchy, file_name):
+  """
+  Engines get fragment coordinates in memory; PDB files are for inspection
+  only. Write them at every step with debug, once per clustering with
+  save_clusters, otherwise not at all.
+  """
+  if(not fragment_extracts.debug):
+    if(not fragment_extracts.save_clusters): return
+    if(_written_files.get(file_name) == fragment_extracts.n_clusterings):
+      return
+  hierarchy.write_pdb_file(
+    file_name        = file_name,
+    crystal_symmetry = fragment_extracts.expansion_cs)
+  _written_files[file_name] = fragment_extracts.n_clusterings
+
 def get_qm_file_name_and_pdb_hierarchy(fragment_extracts, index):
-  fragment_selection = fragment_extracts.fragment_super_selections[index]
   fragment_hierarchy = fragment_extracts.pdb_hierarchy_super.select(
-    fragment_selection)
+    fragment_extracts.fragment_index.super_iselection(index))
   sub_working_folder = fragment_extracts.working_folder + "/"+ str(index) + "/"
   if (not os.path.isdir(sub_working_folder)):
     os.mkdir(sub_working_folder)
   qm_pdb_file = sub_working_folder + str(index) + ".pdb"
   complete_qm_pdb_file = qm_pdb_file[:-4] + "_capping.pdb"
-  # if(fragment_extracts.debug):
-  if(1): # at least for now
-    fragment_hierarchy.write_pdb_file(
-      file_name=qm_pdb_file,
-      crystal_symmetry=fragment_extracts.expansion_cs)
-  # re-capping because geometry of the fragment has changed.
-  ph = completion.run(pdb_hierarchy=fragment_hierarchy,
-                      crystal_symmetry=fragment_extracts.expansion_cs,
-                      model_completion=False,
-                      original_pdb_filename=fragment_extracts.expansion_file)
-  # we now want this file by default
-  ph.write_pdb_file(file_name=complete_qm_pdb_file,
-                    crystal_symmetry=fragment_extracts.expansion_cs)
+  write_pdb_file(fragment_extracts=fragment_extracts,
+    hierarchy=fragment_hierarchy, file_name=qm_pdb_file)
+  # re-capping because geometry of the fragment has changed: re-place the caps
+  # using the template, then the capper, fall back to full capping.
+  ph = None
+  template = fragment_extracts.capping_templates[index]
+  if(template is not None):
+    ph = template.rebuild(fragment_hierarchy.atoms().extract_xyz())
+  if(ph is None):
+    ph = fragment_extracts.capper.cap(fragment_hierarchy)
+  if(ph is None):
+    ph = completion.run(pdb_hierarchy=fragment_hierarchy,
+                        crystal_symmetry=fragment_extracts.expansion_cs,
+                        model_completion=False,
+                        original_pdb_filename=fragment_extracts.expansion_file)
+  write_pdb_file(fragment_extracts=fragment_extracts, hierarchy=ph,
+    file_name=complete_qm_pdb_file)
   return os.path.abspath(complete_qm_pdb_file), ph
 
+def get_fragment_restraints(fragment_extracts, index):
+  """
+  cctbx restraints manager of the super selection of fragment index and the
+  gradient scales of its model atoms. Selected once per clustering and kept
+  in fragment_extracts.fragment_restraints.
+  """
+  result = fragment_extracts.fragment_restraints.get(index)
+  if(result is None):
+    fi = fragment_extracts.fragment_index
+    grm = fragment_extracts.super_sphere_geometry_restraints_manager
+    super_selection = flex.bool(
+      fragment_extracts.pdb_hierarchy_super.atoms_size(),
+      fi.super_iselection(index))
+    result = group_args(
+      restraints_manager = grm.select(super_selection),
+      super_iselection   = fi.super_iselection(index).deep_copy(),
+      fragment_size      = fi.fragment_size(index),
+      scales             = fi.fragment_scales(index).deep_copy())
+    fragment_extracts.fragment_restraints[index] = result
+  return result
+
 def charge(fragment_extracts, index):
   return fragment_extracts.fragment_charges[index]
 
 def write_mm_charge_file(fragment_extracts, index):
-  fragment_selection = fragment_extracts.fragment_super_selections[index]
+  # the environment is set up with the clustering, only coordinates change
   file_name = None
   if (fragment_extracts.charge_embedding is True):
-    altlocs = fragment_extracts.pdb_hierarchy_super.altloc_indices().keys()
-    altlocs.sort()
-    if(fragment_extracts.charge_cutoff is not None):
-      if(fragment_extracts.debug):
-        print("charge_cutoff: ",fragment_extracts.charge_cutoff)
-      xrs_super = fragment_extracts.pdb_hierarchy_super.extract_xray_structure()
-      non_fragment_selection_super = xrs_super.selection_within(
-        radius=fragment_extracts.charge_cutoff,
-        selection=fragment_selection)
-      non_fragment_selection_super = non_fragment_selection_super&~fragment_selection
-      non_fragment_hierarchy_super = fragment_extracts.pdb_hierarchy_super.\
-                       select(non_fragment_selection_super)
-    else:
-      non_fragment_hierarchy_super = fragment_extracts.pdb_hierarchy_super.\
-                       select(~fragment_selection)
-    # the pdb has no altlocs
-    if (len(altlocs)==1):
-      non_fragment_hierarchy = non_fragment_hierarchy_super
-      ph = fragment_extracts.pdb_hierarchy_super
-    # the pdb has  altlocs
-    else:
-      fragment_altlocs = fragment_extracts.pdb_hierarchy_super.\
-                        select(fragment_selection).altloc_indices().keys()
-      fragment_altlocs.sort()
-      asc_ph = fragment_extracts.pdb_hierarchy_super.atom_selection_cache()
-      asc_non_fragment = non_fragment_hierarchy_super.atom_selection_cache()
-      # the fragment has  altlocs
-      if (len(fragment_altlocs)==2):
-        sel_non_fragment = asc_non_fragment.\
-          selection("altloc '%s' or altloc '' or altloc ' '"%fragment_altlocs[1])
-        sel_ph = asc_ph.selection("altloc '%s' or altloc '' or altloc ' '"%fragment_altlocs[1])
-      # the fragment has no altlocs
-      else:
-        sel_non_fragment = asc_non_fragment.\
-          selection("altloc '%s' or altloc '' or altloc ' '"%fragment_altlocs[0])
-        sel_ph = asc_ph.selection("altloc '%s' or altloc '' or altloc ' '"%fragment_altlocs[0])
-      non_fragment_hierarchy = non_fragment_hierarchy_super.select(sel_non_fragment)
-      ph = fragment_extracts.pdb_hierarchy_super.select(sel_ph)
+    iselection = fragment_extracts.embedding_iselections[index]
     sub_working_folder = fragment_extracts.working_folder + "/" + str(index) + "/"
     if (not os.path.isdir(sub_working_folder)):
       os.mkdir(sub_working_folder)
     if(fragment_extracts.debug): print("write mm pdb file:", index)
     non_fragment_pdb_file = sub_working_folder + str(index) + "_mm.pdb"
-    non_fragment_hierarchy.write_pdb_file(
-      file_name=non_fragment_pdb_file,
-      crystal_symmetry=fragment_extracts.expansion_cs)
-    non_qm_edge_positions = fragment_utils.get_edge_atom_positions(
-      ph, non_fragment_hierarchy, charge_embed=True)
-    charge_scaling_positions = non_qm_edge_positions
-    fragment_extracts.charge_service.update_pdb_hierarchy(
-      non_fragment_hierarchy,
-      fragment_extracts.expansion_cs,
-    )
+    write_pdb_file(fragment_extracts=fragment_extracts,
+      hierarchy=fragment_extracts.pdb_hierarchy_super.select(iselection),
+      file_name=non_fragment_pdb_file)
+    qxyz_order = None
     if(fragment_extracts.qm_engine_name == "turbomole"):
       file_name = sub_working_folder + str(index) + "_xyzq_cctbx.dat"
-      fragment_extracts.charge_service.write_pdb_hierarchy_xyzq_file(
-        file_name=file_name,
-        exclude_water=False,
-        charge_scaling_positions=charge_scaling_positions)
+      qxyz_order = "xyzq"
     if(fragment_extracts.qm_engine_name in ["terachem","xtb",'mopac']):
       file_name = sub_working_folder + str(index) + "_qxyz_cctbx.dat"
-      fragment_extracts.charge_service.write_pdb_hierarchy_qxyz_file(
-        file_name=file_name,
-        exclude_water=False,
-        charge_scaling_positions=charge_scaling_positions)
+      qxyz_order = "qxyz"
     if(file_name is None):
       raise Sorry("There is no point charge file")
+    write_point_charges(
+      file_name  = file_name,
+      charges    = fragment_extracts.embedding_charges[index],
+      sites_cart = fragment_extracts.pdb_hierarchy_super.atoms().\
+                     extract_xyz().select(iselection),
+      qxyz_order = qxyz_order)
     file_name = os.path.abspath(file_name)
   return file_name
 
@@ -503,11 +949,10 @@ def write_cluster_and_fragments_pdbs(fragments,directory):
     rmtree(frag_dir)
   os.mkdir(frag_dir)
   os.chdir(frag_dir)
-  for index, selection_fragment in enumerate(F.fragment_selections):
-    cluster_selection = F.cluster_selections[index]
-    frag_selection = F.fragment_super_selections[index]
-    index_cluster = F.pdb_hierarchy.select(cluster_selection)
-    index_frag = F.pdb_hierarchy_super.select(frag_selection)
+  FI = F.fragment_index
+  for index in range(FI.size()):
+    index_cluster = F.pdb_hierarchy.select(FI.cluster_iselection(index))
+    index_frag = F.pdb_hierarchy_super.select(FI.super_iselection(index))
     filename_cluster = "%s_cluster.pdb" %(index)
     filename_frag = "%s_frag.pdb" %(index)
     filename_capped = "%s_capped0.pdb" %(index)
@@ -526,9 +971,11 @@ def write_cluster_and_fragments_pdbs(fragments,directory):
               crystal_symmetry=F.expansion_cs)
 
   log=open('fragment_info.txt','w')
-  print('~  # clusters  : ',len(F.cluster_atoms), file=log)
+  print('~  # clusters  : ',FI.size(), file=log)
   print('~  list of atoms per cluster:', file=log)
-  print('~   ',[len(x) for x in F.cluster_atoms], file=log)
+  print('~   ',[FI.cluster_iselection(i).size() for i in range(FI.size())],
+    file=log)
   print('~  list of atoms per fragment:', file=log)
-  print('~   ',[len(x) for x in F.fragment_super_atoms], file=log)
+  print('~   ',[FI.super_iselection(i).size() for i in range(FI.size())],
+    file=log)
   os.chdir(cwd)
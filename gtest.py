@@ -95,9 +95,11 @@ def run_g_test(params, model, weights, start_fmodel, log):
         frags=fragment_manager
         print('~  # clusters  : ',len(frags.clusters), file=log)
         print('~  list of atoms per cluster:', file=log)
-        print('~   ',[len(x) for x in frags.cluster_atoms], file=log)
+        print('~   ',[frags.fragment_index.cluster_iselection(i).size()
+              for i in range(frags.fragment_index.size())], file=log)
         print('~  list of atoms per fragment:', file=log)
-        print('~   ',[len(x) for x in frags.fragment_super_atoms], file=log)
+        print('~   ',[frags.fragment_index.super_iselection(i).size()
+              for i in range(frags.fragment_index.size())], file=log)
 
         # save fragment data. below works
         # better way is to make a single PDB file with chain IDs
@@ -11,6 +11,8 @@ See accompanying license files for details.
 from __future__ import print_function
 import os
 import string
+import ctypes
+import ctypes.util
 import numpy as np
 import platform
 
@@ -22,6 +24,82 @@ int_keys = ['restart', 'spin', 'charge']
 bool_keys = ['OPT']
 float_keys = ['RELSCF']
 
+#
+# MOPAC shared library API (mopac.h, MOPAC 22.1 and later)
+#
+default_job_type = ' 1SCF  GRADIENTS AUX(0,PRECISION=9) '
+# semiempirical models of mopac_system.model
+api_models = {'PM7': 0, 'PM6-D3H4': 1, 'PM6-ORG': 2, 'PM6': 3, 'AM1': 4,
+              'RM1': 5}
+
+class mopac_system(ctypes.Structure):
+    _fields_ = [('natom', ctypes.c_int),
+                ('natom_move', ctypes.c_int),
+                ('charge', ctypes.c_int),
+                ('spin', ctypes.c_int),
+                ('model', ctypes.c_int),
+                ('epsilon', ctypes.c_double),
+                ('atom', ctypes.POINTER(ctypes.c_int)),
+                ('coord', ctypes.POINTER(ctypes.c_double)),
+                ('nlattice', ctypes.c_int),
+                ('nlattice_move', ctypes.c_int),
+                ('pressure', ctypes.c_double),
+                ('lattice', ctypes.POINTER(ctypes.c_double)),
+                ('tolerance', ctypes.c_double),
+                ('max_time', ctypes.c_int)]
+
+class mopac_properties(ctypes.Structure):
+    _fields_ = [('heat', ctypes.c_double),
+                ('dipole', ctypes.c_double * 3),
+                ('charge', ctypes.POINTER(ctypes.c_double)),
+                ('coord_update', ctypes.POINTER(ctypes.c_double)),
+                ('coord_deriv', ctypes.POINTER(ctypes.c_double)),
+                ('freq', ctypes.POINTER(ctypes.c_double)),
+                ('disp', ctypes.POINTER(ctypes.c_double)),
+                ('bond_index', ctypes.POINTER(ctypes.c_int)),
+                ('bond_atom', ctypes.POINTER(ctypes.c_int)),
+                ('bond_order', ctypes.POINTER(ctypes.c_double)),
+                ('lattice_update', ctypes.POINTER(ctypes.c_double)),
+                ('lattice_deriv', ctypes.POINTER(ctypes.c_double)),
+                ('stress', ctypes.c_double * 6),
+                ('nerror', ctypes.c_int),
+                ('error_msg', ctypes.POINTER(ctypes.c_char_p))]
+
+class mopac_state(ctypes.Structure):
+    _fields_ = [('mpack', ctypes.c_int),
+                ('uhf', ctypes.c_int),
+                ('pa', ctypes.POINTER(ctypes.c_double)),
+                ('pb', ctypes.POINTER(ctypes.c_double))]
+
+_libmopac = None
+
+def get_libmopac():
+    """
+    MOPAC shared library from $MOPAC_LIBRARY or the library path, None if
+    not available.
+    """
+    global _libmopac
+    if _libmopac is None:
+        _libmopac = False
+        path = os.environ.get('MOPAC_LIBRARY', ctypes.util.find_library('mopac'))
+        if path is not None:
+            try:
+                lib = ctypes.CDLL(path)
+                lib.mopac_scf.argtypes = [ctypes.POINTER(mopac_system),
+                                          ctypes.POINTER(mopac_state),
+                                          ctypes.POINTER(mopac_properties)]
+                lib.mopac_scf.restype = None
+                lib.destroy_mopac_properties.argtypes = [
+                    ctypes.POINTER(mopac_properties)]
+                lib.destroy_mopac_properties.restype = None
+                lib.destroy_mopac_state.argtypes = [
+                    ctypes.POINTER(mopac_state)]
+                lib.destroy_mopac_state.restype = None
+                _libmopac = lib
+            except (OSError, AttributeError):
+                pass
+    return _libmopac or None
+
 
 class Mopac(Calculator):
     name = 'MOPAC'
@@ -52,7 +130,7 @@ class Mopac(Calculator):
                  spin=0,
                  OPT=False,
                  functional=functional,
-                 job_type=' 1SCF  GRADIENTS AUX(0,PRECISION=9) ',
+                 job_type=default_job_type,
                  RELSCF= None)
         # set user values
         self.set(**kwargs)
@@ -71,6 +149,15 @@ class Mopac(Calculator):
         self.calc_dir = None
         # initialize the results
         self.occupations = None
+        # restart the SCF from the density of the previous run of the label
+        self.warm_start = False
+        # run through the MOPAC library: state key (fragment identity, else
+        # label) -> (density key, mopac_state)
+        self.in_process = False
+        self.states = {}
+        self.state_key = None
+        # the fallback to the MOPAC program is reported once
+        self.fallback_reported = False
 
         # command
         self.command = self.get_command()
@@ -98,7 +185,7 @@ class Mopac(Calculator):
     def initialize(self, atoms):
         pass
 
-    def write_input(self, fname, atoms):
+    def write_input(self, fname, atoms, oldens=False):
         """
         Writes the files that have to be written each timestep
         """
@@ -113,6 +200,12 @@ class Mopac(Calculator):
         if self.float_params['RELSCF'] != None:
             mopac_input += 'RELSCF=' + str(self.float_params['RELSCF']) + ' '
 
+        # keep the density, start from the previous one
+        if self.warm_start:
+            mopac_input += 'DENOUT '
+            if oldens:
+                mopac_input += 'OLDENS '
+
         #write charge/
         # charge = sum(atoms.get_initial_charges())
         #if charge != 0:
@@ -196,6 +289,27 @@ class Mopac(Calculator):
             raise RuntimeError(error)
         return 0
 
+    def get_density_key(self, atoms):
+        """
+        Composition the density of a run is valid for: method, charge, spin
+        and atoms.
+        """
+        return ' '.join([str(self.str_params['functional']).strip(),
+                         str(self.int_params['charge']),
+                         str(self.int_params['spin'])] +
+                        atoms.get_chemical_symbols())
+
+    def density_matches(self, atoms):
+        """
+        True if label.den was written by a run of the same composition,
+        recorded in label.den.key.
+        """
+        fkey = self.label + '.den.key'
+        if not (os.path.exists(self.label + '.den') and os.path.exists(fkey)):
+            return False
+        with open(fkey) as f:
+            return f.read() == self.get_density_key(atoms)
+
     def run(self):
         import subprocess, shlex
         from threading import Timer
@@ -220,10 +334,27 @@ class Mopac(Calculator):
         Runs MOPAC
         Reads Version, Energy and Forces
         """
+        if self.in_process:
+            lib = get_libmopac()
+            model = self.get_api_model(self.atoms)
+            if lib is not None and model is not None:
+                try:
+                    self.run_api(lib, model)
+                    return
+                except RuntimeError as e:
+                    if not self.fallback_reported:
+                        self.fallback_reported = True
+                        print('MOPAC library failed (%s), running MOPAC' % (
+                            str(e)))
+
         # set the input file name
         finput = self.label + '.mop'
         foutput = self.label + '.out'
-        self.write_input(finput, self.atoms)
+        oldens = self.warm_start and self.density_matches(self.atoms)
+        # the key is written again once the new density is complete
+        if os.path.exists(self.label + '.den.key'):
+            os.remove(self.label + '.den.key')
+        self.write_input(finput, self.atoms, oldens=oldens)
 
          # directory
         self.calc_dir = os.getcwd()
@@ -232,7 +363,7 @@ class Mopac(Calculator):
         if command is None:
           raise RuntimeError('MOPAC_COMMAND is not specified')
 
-        # Conda based Mopac does not need this anymore. 
+        # Conda based Mopac does not need this anymore. 
         #WhatOS=platform.system()
         #if "Linux" in WhatOS:
         #    if ('MOPAC_DIR' in os.environ):
@@ -244,17 +375,90 @@ class Mopac(Calculator):
         command_exc= "  ".join([command , finput])
 
         # run_timeout(command_exc ,72000)# 20hours
-        self.run_command(command_exc)
+        try:
+            self.run_command(command_exc)
+            energy = self.read_energy(foutput)
+        except RuntimeError:
+            if not oldens: raise
+            # cold start if the old density does not work
+            self.write_input(finput, self.atoms, oldens=False)
+            self.run_command(command_exc)
+            energy = self.read_energy(foutput)
 #        exitcode = os.system('%s %s' % (command, finput)+ '  > /dev/null 2>&1    ')
 
 #        if exitcode != 0:
 #            raise RuntimeError('MOPAC exited with error code')
 
         self.version = self.read_version(foutput)
-        energy = self.read_energy(foutput)
         self.energy_zero = energy
         self.energy_free = energy
         self.forces = self.read_forces(foutput)
+        if self.warm_start:
+            with open(self.label + '.den.key', 'w') as f:
+                f.write(self.get_density_key(self.atoms))
+
+    def get_api_model(self, atoms):
+        """
+        mopac_system.model for the current settings, None if they need the
+        MOPAC program (other keywords, RELSCF or periodic systems).
+        """
+        if self.str_params['job_type'] != default_job_type:
+            return None
+        if self.float_params['RELSCF'] is not None or atoms.pbc.any():
+            return None
+        return api_models.get(str(self.str_params['functional']).strip().upper())
+
+    def run_api(self, lib, model):
+        """
+        Single point through mopac_scf(), same settings as the MOPAC input
+        written by write_input(). With warm_start the density of each label
+        is kept in memory and reused while the composition does not change.
+        """
+        atoms = self.atoms
+        natom = len(atoms)
+        numbers = (ctypes.c_int * natom)(*atoms.get_atomic_numbers())
+        coord = (ctypes.c_double * (3 * natom))(
+            *atoms.get_positions().flatten())
+        system = mopac_system(
+            natom=natom, natom_move=natom,
+            charge=int(self.int_params['charge']),
+            # number of spin excitations: 1 for TRIPLET
+            spin=1 if self.int_params['spin'] == 2 else 0,
+            model=model, epsilon=78.4, atom=numbers, coord=coord,
+            nlattice=0, nlattice_move=0, pressure=0., lattice=None,
+            tolerance=1., max_time=172800)
+        key = self.get_density_key(atoms)
+        old = self.states.pop(self.get_state_key(), None)
+        state = mopac_state()
+        if old is not None:
+            if self.warm_start and old[0] == key:
+                state = old[1]
+            else:
+                lib.destroy_mopac_state(ctypes.byref(old[1]))
+        properties = mopac_properties()
+        lib.mopac_scf(ctypes.byref(system), ctypes.byref(state),
+                      ctypes.byref(properties))
+        try:
+            if properties.nerror > 0:
+                raise RuntimeError('; '.join([
+                    properties.error_msg[i].decode().strip()
+                    for i in range(properties.nerror)]))
+            gradients = np.array(
+                [properties.coord_deriv[i] for i in range(3 * natom)])
+            energy = properties.heat * (kcal / mol)
+        except RuntimeError:
+            lib.destroy_mopac_state(ctypes.byref(state))
+            raise
+        finally:
+            lib.destroy_mopac_properties(ctypes.byref(properties))
+        if self.warm_start:
+            self.states[self.get_state_key()] = (key, state)
+        else:
+            lib.destroy_mopac_state(ctypes.byref(state))
+        self.version = 'library'
+        self.energy_zero = energy
+        self.energy_free = energy
+        self.forces = -gradients.reshape((natom, 3)) * (kcal / mol)
 
     def read_version(self, fname):
         """
@@ -389,3 +593,21 @@ class Mopac(Calculator):
 
     def set_nproc(self, nproc):
       self.int_params['nproc'] = int(nproc)
+
+    def set_warm_start(self, warm_start):
+      self.warm_start = warm_start
+
+    def set_in_process(self, in_process):
+      self.in_process = in_process
+
+    def set_state_key(self, state_key):
+      self.state_key = state_key
+
+    def get_state_key(self):
+      return self.label if self.state_key is None else self.state_key
+
+    def reset_states(self, keep=None):
+      for k in list(self.states.keys()):
+          if keep is not None and k in keep: continue
+          key, state = self.states.pop(k)
+          get_libmopac().destroy_mopac_state(ctypes.byref(state))
@@ -69,10 +69,12 @@ class Orca(Calculator):
         self.energy_free = None
         self.forces = None
         self.stress = None
+        # start the SCF from the orbitals of the previous run of the label
+        self.warm_start = False
 
         self.command = self.get_command()
 
-    def write_input(self, fname, atoms):
+    def write_input(self, fname, atoms, moread=False):
         key_parameters = self.key_parameters
         if self.orca_file == True:
             pass
@@ -85,6 +87,10 @@ class Orca(Calculator):
             finput = open(fname, "w")
             #XY
             finput.write("! " + self.key_parameters['method'] + " " + self.key_parameters['basis']+ " EnGrad" + "\n" )
+            if moread:
+              finput.write("! MORead\n")
+              finput.write('%%moinp "%s"\n' % os.path.basename(
+                self.get_guess_file()))
             if 'memory' in self.key_parameters:
               finput.write('%%MaxCore %s\n' % self.key_parameters['memory'])
             finput.write(" \n")
@@ -117,6 +123,30 @@ class Orca(Calculator):
           command = os.environ['Orca_COMMAND']
         return command
 
+    def get_guess_file(self):
+        return self.label + '_guess.gbw'
+
+    def get_guess_key(self, atoms):
+        """
+        Composition the orbitals of a run are valid for: method, basis,
+        charge and atoms.
+        """
+        return ' '.join([str(self.key_parameters['method']),
+                         str(self.key_parameters['basis']),
+                         str(self.key_parameters['charge'])] +
+                        atoms.get_chemical_symbols())
+
+    def guess_matches(self, atoms):
+        """
+        True if the guess orbitals come from a run of the same composition,
+        recorded in label_guess.gbw.key.
+        """
+        fkey = self.get_guess_file() + '.key'
+        if not (os.path.exists(self.get_guess_file()) and os.path.exists(fkey)):
+            return False
+        with open(fkey) as f:
+            return f.read() == self.get_guess_key(atoms)
+
     def run_qr(self,
                atoms,
                define_str,
@@ -125,10 +155,12 @@ class Orca(Calculator):
                pointcharges,
         ):
         import subprocess
+        import shutil
+        import shlex
         """
-        Writes input in label.mop
-        Runs ORCA
-        Reads Version, Energy and Forces
+        Writes input in label.inp
+        Runs ORCA in the folder of label
+        Reads Energy and Forces from label.engrad
         """
         # set the input file name
         self.atoms = atoms
@@ -136,10 +168,10 @@ class Orca(Calculator):
         self.key_parameters['charge'] = charge
         finput = self.label + '.inp'
         foutput = self.label + '.out'
-        self.write_input(finput, self.atoms)
+        moread = self.warm_start and self.guess_matches(self.atoms)
+        self.write_input(finput, self.atoms, moread=moread)
 
         working_dir = os.path.dirname(finput)
-        key_parameters["scrdir"] = working_dir + "/scr"
         command = self.command
         if command is None:
             raise RuntimeError('Orca command not specified')
@@ -148,15 +180,48 @@ class Orca(Calculator):
         # dry_run
         if 0: assert 0
 
-        exitcode = os.system('%s %s' % (command, finput) + '  >     ' + foutput + '  2>&1')
-        if exitcode != 0:
-            raise RuntimeError('Orca exited with error code')
-
-        energy = self.read_energy(foutput)
+        def run_orca():
+            if os.path.exists(self.label + '.engrad'):
+                os.remove(self.label + '.engrad')
+            with open(foutput, 'w') as f:
+                exitcode = subprocess.call(
+                    shlex.split(command) + [os.path.basename(finput)],
+                    cwd=working_dir or None, stdout=f, stderr=subprocess.STDOUT)
+            if exitcode != 0:
+                raise RuntimeError('Orca exited with error code')
+            return self.read_engrad(self.label + '.engrad', foutput, atoms)
+        try:
+            energy, self.forces = run_orca()
+        except RuntimeError:
+            if not moread: raise
+            # cold start if the old orbitals do not work
+            self.write_input(finput, self.atoms, moread=False)
+            energy, self.forces = run_orca()
         self.energy_zero = energy
         self.energy_free = energy
+        # keep the orbitals as guess for the next run of this label
+        if self.warm_start and os.path.exists(self.label + '.gbw'):
+            shutil.copyfile(self.label + '.gbw', self.get_guess_file())
+            with open(self.get_guess_file() + '.key', 'w') as f:
+                f.write(self.get_guess_key(self.atoms))
 
-        self.forces = self.read_forces(foutput,atoms)
+    def read_engrad(self, fname, foutput, atoms):
+        """
+        Reads energy and forces from the .engrad file, from the output file if
+        there is no .engrad file. Raises RuntimeError if they are missing.
+        """
+        if not os.path.exists(fname):
+            return self.read_energy(foutput), self.read_forces(foutput, atoms)
+        with open(fname) as f:
+            values = [line.split()[0] for line in f
+                      if line.strip() and not line.startswith('#')]
+        nats = len(atoms)
+        if len(values) < 2 + 3 * nats or int(values[0]) != nats:
+            raise RuntimeError('ORCA: could not read %s' % fname)
+        energy = float(values[1]) * (Hartree) / (kcal / mol)
+        forces = np.array([float(v) for v in values[2:2 + 3 * nats]])
+        forces = forces.reshape((nats, 3)) * (-(Hartree / Bohr) / (kcal / mol))
+        return energy, forces
 
     def read_energy(self, fname):
         """
@@ -262,3 +327,6 @@ class Orca(Calculator):
     def set_memory(self, memory):
       self.key_parameters['memory'] = memory
 
+    def set_warm_start(self, warm_start):
+      self.warm_start = warm_start
+
@@ -17,16 +17,18 @@ except:
 
 class Pyscf(Calculator):
     def __init__(self, label='ase',basis='631g',charge=0,spin=0,method="hf", **kwargs):
-        mol = pyscf.gto.Mole()
-        mol.charge = charge
-        mol.spin = spin
-        mol.output = None#label+'.out'
-        mol.chkfile = label+'.chk'
-        mol.verbose = 1
-        self.mol = mol
+        self.basis = basis
+        self.charge = charge
+        self.spin = spin
         self.method = method
         self.command = None
-        self.label = None
+        self.label = label
+        # state key (fragment identity, else label) -> Mole and SCF objects of
+        # the fragment and its density, the SCF always starts from the
+        # previous density
+        self.states = {}
+        self.state_key = None
+        self.warm_start = True
         # set user values
         self.set(**kwargs)
 
@@ -37,13 +39,13 @@ class Pyscf(Calculator):
         """
         for key in kwargs:
             if key == "charge":
-                self.mol.charge = kwargs[key]
+                self.charge = kwargs[key]
             if key == "spin":
-                self.mol.spin = kwargs[key]
+                self.spin = kwargs[key]
             if key == "method":
                 self.method = kwargs[key]
             if key == "basis":
-                self.mol.basis = kwargs[key]
+                self.basis = kwargs[key]
 
     def get_version(self):
         return self.version
@@ -51,30 +53,65 @@ class Pyscf(Calculator):
     def initialize(self, atoms):
         pass
 
+    def get_state(self, atoms):
+        """
+        Mole and SCF objects of the current label. They are kept while atoms,
+        charge, spin, basis and method do not change, only the geometry is
+        updated.
+        """
+        method = str(self.method).strip().lower()
+        key = (tuple(atoms.get_chemical_symbols()), self.charge, self.spin,
+               str(self.basis), method)
+        state = self.states.get(self.get_state_key())
+        if state is not None and state['key'] == key:
+            state['mol'].set_geom_(atoms.get_positions(), unit='Angstrom')
+            state['scf'].reset(state['mol'])
+            return state
+        mol = pyscf.gto.Mole()
+        mol.atom = [[atom.symbol, atom.position] for atom in atoms]
+        mol.unit = 'Angstrom'
+        mol.basis = self.basis
+        mol.charge = self.charge
+        mol.spin = self.spin
+        mol.output = None
+        mol.verbose = 1
+        mol.build()
+        if method in ['hf', 'rhf']:
+            mscf = pyscf.scf.RHF(mol)
+        else:
+            # 'dft' is BP86, otherwise method is the functional
+            mscf = pyscf.dft.RKS(mol)
+            mscf.xc = 'bp86' if method == 'dft' else method
+        mscf.max_cycle = 200
+        mscf.max_memory = 1000
+        mscf.conv_tol = 1e-8
+        mscf.conv_tol_grad = 1e-12
+        state = {'key': key, 'mol': mol, 'scf': mscf, 'dm': None}
+        self.states[self.get_state_key()] = state
+        return state
+
     def run_qr(self,atoms, coordinates, charge=None, pointcharges=None, define_str=None):
-            mol = self.mol
-            self.atoms = None
+            """
+            One SCF per call, started from the density of the previous call
+            for the same label; energy and gradients are taken from it.
+            """
+            if charge is not None:
+                self.charge = charge
             self.atoms = atoms
-            mol.atom = [[atom.symbol, atom.position] for atom in self.atoms]
-            mol.build()
-            if self.method == 'hf':
-                mscf = pyscf.scf.RHF(mol)
-                mscf.max_cycle=200
-                mscf.max_memory=1000
-                self.command = mscf.run(conv_tol=1e-8,conv_tol_grad=1e-12).apply(pyscf.grad.RHF)
-            if self.method == 'dft':
-                mdft =  pyscf.dft.RKS(mol)
-                mdft.max_cycle=200
-                mdft.max_memory=1000
-                self.command = mdft.run(conv_tol=1e-8,conv_tol_grad=1e-12,xc='bp86').apply(pyscf.grad.RKS)
-
-
-            self.energy = mscf.scf()*((Hartree)/(kcal / unit_mol))
-
+            state = self.get_state(atoms)
+            mscf = state['scf']
+            energy = mscf.kernel(dm0=state['dm'])
+            if not mscf.converged:
+                state['dm'] = None
+                raise RuntimeError('PySCF: SCF did not converge for %s' % (
+                    self.label))
+            state['dm'] = mscf.make_rdm1()
+            self.command = mscf.nuc_grad_method()
+            grad = np.array(self.command.kernel())
+
+            self.energy = energy*((Hartree)/(kcal / unit_mol))
             self.energy_zero = self.energy
             self.energy_free = self.energy
-            result = self.command.run()
-            grad = np.array(result.grad())
             self.forces = grad*(-(Hartree/Bohr)/(kcal / unit_mol))
 
             if 0:
@@ -93,6 +130,26 @@ class Pyscf(Calculator):
     def set_label(self, label):
         self.label = label
 
+    # Q|R requirements
+    def set_charge(self, charge):
+        self.charge = charge
+
+    def set_method(self, method):
+        self.method = method
+
+    def set_basis(self, basis):
+        self.basis = basis
+
+    def set_state_key(self, state_key):
+        self.state_key = state_key
+
+    def get_state_key(self):
+        return self.label if self.state_key is None else self.state_key
+
+    def reset_states(self, keep=None):
+        self.states = dict([(k, v) for k, v in self.states.items()
+                            if keep is not None and k in keep])
+
     def atoms_are_equal(self, atoms_new):
         ''' (adopted from jacapo.py)
         comparison of atoms to self.atoms using tolerances to account
@@ -19,6 +19,41 @@ key_parameters = {
                   'pointcharges': None,
                   }
 
+# GFN versions of the xtb command line (--gfn) as xtb-python parameters
+xtb_params = {'0': 'GFN0xTB', '1': 'GFN1xTB', '2': 'GFN2xTB', 'ff': 'GFNFF'}
+
+def parse_method(method):
+    """
+    Settings of the xtb command line options in method for the in-process
+    engine: GFN version, electronic temperature, accuracy and GBSA solvent.
+    None if method has options the in-process engine does not support.
+    """
+    result = {'gfn': '2', 'etemp': None, 'acc': None, 'solvent': None}
+    keys = {'gfn': 'gfn', 'etemp': 'etemp', 'acc': 'acc',
+            'gbsa': 'solvent', 'g': 'solvent'}
+    tokens = str(method).split()
+    i = 0
+    while i < len(tokens):
+        token = tokens[i].lstrip('-').lower()
+        if token.startswith('gfn') and len(token) > 3:
+            result['gfn'] = token[3:]
+        elif token in keys and i+1 < len(tokens):
+            i += 1
+            result[keys[token]] = tokens[i]
+        elif token != 'grad':
+            return None
+        i += 1
+    if result['gfn'] not in xtb_params:
+        return None
+    return result
+
+def has_xtb_python():
+    try:
+        import xtb.interface
+    except ImportError:
+        return False
+    return True
+
 class GFNxTB(Calculator):
     name = 'gfn-xtb'
 
@@ -50,8 +85,15 @@ class GFNxTB(Calculator):
         self.energy_free = None
         self.forces = None
         self.stress = None
-        self.command = self.get_command()
+        self.command = None
         self.calc_dir = None
+        # in-process engine: state key (fragment identity, else label) ->
+        # calculator and last results
+        self.in_process = False
+        self.states = {}
+        self.state_key = None
+        # the fallback to the xtb program is reported once
+        self.fallback_reported = False
 
 
     def run_command(self,command):
@@ -119,6 +161,17 @@ class GFNxTB(Calculator):
         # method=self.key_parameters['method']
         self.coordinates = coordinates
         self.key_parameters['charge'] = charge
+        if self.in_process and pointcharges is None:
+            settings = parse_method(self.key_parameters['method'])
+            if settings is not None and has_xtb_python():
+                try:
+                    self.run_in_process(settings)
+                    return
+                except Exception as e:
+                    self.states.pop(self.get_state_key(), None)
+                    if not self.fallback_reported:
+                        self.fallback_reported = True
+                        print('xtb-python failed (%s), running xtb' % str(e))
         foutput = self.label + '.out'
 
         # directory
@@ -141,6 +194,8 @@ class GFNxTB(Calculator):
           self.set_pointcharges()
 
 
+        if self.command is None:
+            self.command = self.get_command()
         binary = self.command
         if (self.key_parameters['nproc'] > 1):
             nproc=self.key_parameters['nproc']
@@ -174,6 +229,46 @@ class GFNxTB(Calculator):
         self.energy_zero= self.energy_free
         os.chdir(working_dir)
 
+    def run_in_process(self, settings):
+        """
+        Single point with xtb-python. The calculator and results of each
+        label are kept, so the next step of the same fragment starts from its
+        converged wavefunction. The calculator is set up again when atoms,
+        charge or method change.
+        """
+        from xtb.interface import Calculator as XTBCalculator, Param
+        from xtb.libxtb import VERBOSITY_MUTED
+        from xtb.utils import get_solvent
+        numbers = self.atoms.get_atomic_numbers()
+        positions = self.atoms.get_positions() / Bohr
+        charge = float(self.key_parameters['charge'])
+        key = (tuple(numbers), charge, self.key_parameters['method'])
+        state = self.states.get(self.get_state_key())
+        if state is None or state['key'] != key:
+            calc = XTBCalculator(getattr(Param, xtb_params[settings['gfn']]),
+                                 numbers, positions, charge=charge)
+            calc.set_verbosity(VERBOSITY_MUTED)
+            if settings['etemp'] is not None:
+                calc.set_electronic_temperature(float(settings['etemp']))
+            if settings['acc'] is not None:
+                calc.set_accuracy(float(settings['acc']))
+            if settings['solvent'] is not None:
+                calc.set_solvent(get_solvent(settings['solvent']))
+            state = {'key': key, 'calc': calc, 'results': None}
+            self.states[self.get_state_key()] = state
+        else:
+            state['calc'].update(positions)
+        if state['results'] is None:
+            state['results'] = state['calc'].singlepoint()
+        else:
+            state['results'] = state['calc'].singlepoint(state['results'])
+        self.e_au = state['results'].get_energy()
+        self.e_total = self.e_au * Hartree/(kcal / mol)
+        self.energy_free = self.e_total
+        self.energy_zero = self.energy_free
+        self.forces = -state['results'].get_gradient() * \
+            (Hartree / Bohr)/(kcal / mol)
+
     def check_scf_conv(self):
         text = open('energy', 'r').read().lower()
         lines = iter(text.split('\n'))
@@ -277,3 +372,16 @@ class GFNxTB(Calculator):
 
     def set_nproc(self, nproc):
       self.key_parameters['nproc'] = int(nproc)
+
+    def set_in_process(self, in_process):
+      self.in_process = in_process
+
+    def set_state_key(self, state_key):
+      self.state_key = state_key
+
+    def get_state_key(self):
+      return self.label if self.state_key is None else self.state_key
+
+    def reset_states(self, keep=None):
+      self.states = dict([(k, v) for k, v in self.states.items()
+                          if keep is not None and k in keep])
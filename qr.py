@@ -58,6 +58,18 @@ cluster{
   clustering_method = gnc  *bcc
     .type = choice(multi=False)
     .help = type of clustering algorithm
+  interaction_method = *pair_interaction contact_graph
+    .type = choice(multi=False)
+    .help = residue interaction graph used for clustering and buffers: \
+            density based pair_interaction or a distance based contact graph \
+            (cell list, scales linearly with model size)
+  contact_cutoff = 3.0
+    .type = float
+    .help = interatomic distance defining a residue contact (contact_graph)
+  validate_fragment_charges = False
+    .type = bool
+    .help = Check fragment charges summed from residue charges against \
+            electron counting of the whole fragment
   altloc_method = average *subtract
     .type = choice(multi=False)
     .help = two strategies on how to join energies from multiple energy and \
@@ -73,6 +85,23 @@ cluster{
     .type = float
     .help = Re-calculate clusters once the model shifted by more than \
             re_calculate_rmsd_tolerance from initial
+  incremental_reclustering = False
+    .type = bool
+    .help = Re-calculate only interactions of moved residues and only the \
+            fragments affected by them (models without altlocs)
+  residue_shift_threshold = 0.3
+    .type = float
+    .help = Atom shift since the last clustering above which a residue is \
+            considered moved in incremental re-clustering
+  reuse_threshold = None
+    .type = float
+    .help = Re-use the last energy and gradients of fragments whose atoms \
+            all moved by less than reuse_threshold (A) since they were last \
+            computed. None: compute all fragments at every step
+  reuse_correction = False
+    .type = bool
+    .help = Correct re-used fragment energies and gradients to first order \
+            by the change of their cctbx restraints energy and gradients
 }
 
 restraints = cctbx *qm
@@ -109,6 +138,34 @@ quantum {
   qm_addon_method = None
     .type = str
     .help = specifies flags for the qm_addon. See manual for details.
+  cache = False
+    .type = bool
+    .help = Store QM energies and gradients on disk and reuse them for \
+            identical calculations (same settings, coordinates and point charges)
+  cache_file_name = qm_cache.sqlite
+    .type = str
+    .help = file of the QM result cache
+  cache_max_size = 512
+    .type = int
+    .help = maximum size of the QM result cache (MB), least recently used \
+            entries are removed first
+  in_process = False
+    .type = bool
+    .help = Run the QM engine inside the Q|R process through its library \
+            interface: xtb-python for xtb, keeping the wavefunction of each \
+            fragment between steps, and the MOPAC shared library for mopac \
+            (found through $MOPAC_LIBRARY or the library path). Falls back \
+            to the external program. States kept in memory are only reused \
+            with nproc=1 or the persistent pool, which pins each fragment to \
+            one worker; re-clustering drops the states of rebuilt fragments.
+  warm_start = False
+    .type = bool
+    .help = Start the SCF of each fragment from its density of the previous \
+            step while its atoms do not change (mopac: DENOUT/OLDENS, kept \
+            in memory with in_process=True; orca: MORead of the previous \
+            .gbw; pyscf always starts from the previous density). Restarts \
+            from memory only apply with nproc=1 or the persistent pool, \
+            which pins each fragment to one worker.
 }
 
 refine {
@@ -234,6 +291,13 @@ parallel {
   qsub_command = None
     .type = str
     .help = Specific command to use on the queue system
+  persistent_pool = True
+    .type = bool
+    .help = Keep fragment worker processes alive between gradient calls \
+            (method=multiprocessing and nproc>1 only). With QM engines \
+            keeping SCF states in memory each fragment stays on one worker; \
+            workers are balanced by estimated fragment cost once per \
+            clustering instead of taking the next fragment when free.
 }
 
 output_file_name_prefix = None
@@ -93,9 +93,14 @@ def create_fragment_manager(
     charge_cutoff              = params.cluster.charge_cutoff,
     save_clusters              = params.cluster.save_clusters,
     select_within_radius       = params.cluster.select_within_radius,
-    bond_with_altloc_flag      = params.cluster.bond_with_altloc)
+    bond_with_altloc_flag      = params.cluster.bond_with_altloc,
+    incremental_reclustering   = params.cluster.incremental_reclustering,
+    residue_shift_threshold    = params.cluster.residue_shift_threshold,
+    interaction_method         = params.cluster.interaction_method,
+    contact_cutoff             = params.cluster.contact_cutoff,
+    validate_fragment_charges  = params.cluster.validate_fragment_charges)
 
-def create_restraints_manager(params, model):
+def create_restraints_manager(params, model, log=None):
   restraints_source = restraints.restraints(params = params, model = model)
   if(model.altlocs_present()):
     return restraints.from_altlocs2(
@@ -140,7 +145,10 @@ def create_restraints_manager(params, model):
       return cluster_restraints.from_cluster(
         restraints_manager = restraints_source.restraints_manager,
         fragment_manager   = fragment_manager,
-        parallel_params    = params.parallel)
+        parallel_params    = params.parallel,
+        reuse_threshold    = params.cluster.reuse_threshold,
+        reuse_correction   = params.cluster.reuse_correction,
+        log                = log)
     else:
       # restraints=cctbx clustering=false expansion=false
       return restraints_source.restraints_manager
@@ -254,7 +262,7 @@ def run(model, fmodel, map_data, params, rst_file, prefix, log):
   start_fmodel = fmodel
   start_ph = None # is it used anywhere? I don't see where it is used!
 
-  restraints_manager = create_restraints_manager(params, model)
+  restraints_manager = create_restraints_manager(params, model, log=log)
 
   if(map_data is not None and params.refine.mode == "refine"):
     model.geometry_statistics(use_hydrogens=False).show()
@@ -276,7 +284,11 @@ def run(model, fmodel, map_data, params, rst_file, prefix, log):
       restraints_manager    = restraints_manager,
       max_iterations        = params.refine.max_iterations_refine,
       log                   = log)
-    model = O.run()
+    try:
+      model = O.run()
+    finally:
+      if(hasattr(restraints_manager, "close")):
+        restraints_manager.close()
     of = open("real_space_refined.pdb", "w")
     print(model.model_as_pdb(output_cs=True), file=of)
     of.close()
@@ -292,30 +304,35 @@ def run(model, fmodel, map_data, params, rst_file, prefix, log):
       model=model,
       params=params,
       restraints_manager=restraints_manager)
-    if(params.refine.mode == "refine"):
-      #
-      # Optimize H
-      #
-      if fmodel.f_obs().d_min()<1.2:
-        import mmtbx.hydrogens
-        print("Optimize H with d.o.f.", file=log)
-        print ("  start: r_work=%6.4f r_free=%6.4f"%(fmodel.r_work(), fmodel.r_free()))
-        mmtbx.hydrogens.fit_rotatable2(model=model, fmodel=fmodel)
-        print ("  final: r_work=%6.4f r_free=%6.4f"%(fmodel.r_work(), fmodel.r_free()))
-        monitor.update(fmodel = fmodel, model = model)
-      #
-      driver.refine(
-        params                = params,
-        fmodel                = fmodel,
-        geometry_rmsd_manager = geometry_rmsd_manager,
-        calculator            = calculator_manager,
-        monitor               = monitor)
-    else:
-      driver.opt(
-        params     = params,
-        model      = model,
-        calculator = calculator_manager,
-        monitor    = monitor)
+    try:
+      if(params.refine.mode == "refine"):
+        #
+        # Optimize H
+        #
+        if fmodel.f_obs().d_min()<1.2:
+          import mmtbx.hydrogens
+          print("Optimize H with d.o.f.", file=log)
+          print ("  start: r_work=%6.4f r_free=%6.4f"%(fmodel.r_work(), fmodel.r_free()))
+          mmtbx.hydrogens.fit_rotatable2(model=model, fmodel=fmodel)
+          print ("  final: r_work=%6.4f r_free=%6.4f"%(fmodel.r_work(), fmodel.r_free()))
+          monitor.update(fmodel = fmodel, model = model)
+        #
+        driver.refine(
+          params                = params,
+          fmodel                = fmodel,
+          geometry_rmsd_manager = geometry_rmsd_manager,
+          calculator            = calculator_manager,
+          monitor               = monitor)
+      else:
+        driver.opt(
+          params     = params,
+          model      = model,
+          calculator = calculator_manager,
+          monitor    = monitor)
+    finally:
+      # stop the fragment workers of from_cluster
+      if(hasattr(restraints_manager, "close")):
+        restraints_manager.close()
     monitor.finalize(
       input_file_name_prefix  = prefix,
       output_file_name_prefix = params.output_file_name_prefix,
@@ -2,6 +2,7 @@ from __future__ import division
 from __future__ import absolute_import
 
 import os
+import multiprocessing
 import ase.units as ase_units
 import mmtbx.restraints
 from libtbx.utils import Sorry
@@ -16,6 +17,7 @@ from .plugin.ase.gaussian_qr import Gaussian
 from .plugin.ase.xtb_qr import GFNxTB
 from .plugin.ase.server_qr import RestAPICalculator
 from .plugin.tools import qr_tools
+from .utils.qm_cache import qm_cache
 from libtbx import group_args
 import math
 from qrefine.super_cell import expand
@@ -26,6 +28,7 @@ from collections import OrderedDict
 from libtbx import adopt_init_args
 import time
 from libtbx import easy_pickle
+from libtbx.easy_mp import get_processes
 
 def model_from_hierarchy(pdb_hierarchy, crystal_symmetry, cif_objects=None):
   params = mmtbx.model.manager.get_default_pdb_interpretation_params()
@@ -47,9 +50,10 @@ class restraints(object):
   """
   Create CCTBX or QM restraints manager.
   """
-  def __init__(self, params, model):
+  def __init__(self, params, model, file_name="./ase/tmp_ase.pdb"):
     self.params = params
     self.model = model
+    self.file_name = file_name
     self.cif_objects      = model.get_restraint_objects()
     self.pdb_hierarchy    = model.get_hierarchy()
     self.crystal_symmetry = model.crystal_symmetry()
@@ -100,7 +104,14 @@ class restraints(object):
           nproc            = self.params.quantum.nproc,
           url              = self.params.quantum.server_url,
           crystal_symmetry = crystal_symmetry,
-          clustering       = self.params.cluster.clustering)
+          clustering       = self.params.cluster.clustering,
+          debug            = self.params.debug,
+          cache_file_name  = self.params.quantum.cache_file_name \
+                             if self.params.quantum.cache else None,
+          cache_max_size   = self.params.quantum.cache_max_size,
+          in_process       = self.params.quantum.in_process,
+          warm_start       = self.params.quantum.warm_start,
+          file_name        = self.file_name)
     return self.restraints_manager
 
 def h_diff_sel(h1, h2):
@@ -224,6 +235,15 @@ def get_cctbx_gradients(ph, cs, rm_only=False):
         sites_cart=sites_cart, compute_gradients=True).gradients
     return get_g
 
+# Conformers of the from_altlocs2 being evaluated, inherited by the forked
+# workers of from_altlocs2.evaluate so that they are not pickled.
+_altlocs2_conformers = None
+
+def _conformer_target_and_gradients(ci_and_sites_cart):
+  ci, sites_cart = ci_and_sites_cart
+  return ci, _altlocs2_conformers[ci].target_and_gradients(
+    sites_cart = sites_cart)
+
 class from_altlocs2(object):
   def __init__(self, model, method, params=None):
     adopt_init_args(self, locals())
@@ -238,7 +258,7 @@ class from_altlocs2(object):
       model_conformer = self.model.select(sel)
       ph_conformer = model_conformer.get_hierarchy()
       ci_ph_conformer = ph_conformer.get_conformer_indices().conformer_indices
-      rm = self._setup_restraints_managers(model = model_conformer)
+      rm = self._setup_restraints_managers(model = model_conformer, ci = ci)
       self.d[ci] = group_args(
         c_selection          = sel,
         c_zero               = ci_ph_conformer == 0,
@@ -248,32 +268,63 @@ class from_altlocs2(object):
     self.sel_W_empty = \
       True if not 0 in self.d.keys() else self.d[0].c_selection.count(True) == 0
 
-  def _setup_restraints_managers(self, model):
+  def _setup_restraints_managers(self, model, ci):
+    # each conformer has its own QM files so they can run at the same time
     restraints_source = restraints(
-      params = self.params, model = model)
+      params = self.params, model = model,
+      file_name = "./ase/tmp_ase_%d.pdb"%ci)
     return from_expansion(
         params            = self.params,
         restraints_source = restraints_source,
         pdb_hierarchy     = model.get_hierarchy(),
         crystal_symmetry  = model.crystal_symmetry()).target_and_gradients
 
+  def n_processes(self, n_jobs):
+    if(self.params is None or self.params.parallel.method != "multiprocessing"):
+      return 1
+    return min(n_jobs, get_processes(self.params.parallel.nproc))
+
+  def evaluate(self, sites_cart, conformers):
+    """
+    Target and gradients of the conformers, all at once with
+    parallel.method=multiprocessing and nproc>1.
+    """
+    jobs = [(ci, sites_cart.select(self.d[ci].c_selection))
+            for ci in conformers]
+    processes = self.n_processes(n_jobs=len(jobs))
+    if(processes < 2):
+      return dict([(ci, self.d[ci].target_and_gradients(sites_cart = xyz))
+                   for ci, xyz in jobs])
+    global _altlocs2_conformers
+    _altlocs2_conformers = self.d
+    # fork explicitly: spawned workers would not inherit the conformers
+    pool = multiprocessing.get_context("fork").Pool(processes=processes)
+    try:
+      results = pool.map(_conformer_target_and_gradients, jobs, chunksize=1)
+    finally:
+      pool.terminate()
+      pool.join()
+      _altlocs2_conformers = None
+    return dict(results)
+
   def target_and_gradients(self, sites_cart):
     self.model.set_sites_cart(sites_cart=sites_cart)
+    conformers = [ci for ci in self.d.keys() if ci != 0]
+    if(self.method=="subtract" and not self.sel_W_empty): conformers.append(0)
+    results = self.evaluate(sites_cart=sites_cart, conformers=conformers)
     g_result  = flex.vec3_double(self.conf_ind.size(), [0,0,0])
     if not self.sel_W_empty:
       g_blanks  = flex.vec3_double(self.d[0].c_selection.count(True))
     for ci, v in zip(self.d.keys(), self.d.values()):
       if ci==0: continue
-      _, g_ci_blank_ = v.target_and_gradients(
-        sites_cart = sites_cart.select(v.c_selection))
+      _, g_ci_blank_ = results[ci]
       g_ci = g_ci_blank_.select(v.c_one)
       g_result = g_result.set_selected(v.sel_ci, g_ci)
       if not self.sel_W_empty: g_blanks += g_ci_blank_.select(v.c_zero)
     if self.method=="subtract":
       if not self.sel_W_empty:
         W = self.d[0]
-        _, g_blank = W.target_and_gradients(
-          sites_cart = sites_cart.select(W.c_selection))
+        _, g_blank = results[0]
         result = g_result.set_selected(
           W.c_selection, g_blanks-((self.n_altlocs-1)*g_blank))
       else: result = g_result
@@ -292,48 +343,82 @@ class from_altlocs2(object):
 
     return energy, result
 
+class cctbx_altlocs(object):
+  """
+  cctbx gradients of a model with altlocs from the gradients of its
+  conformers. Conformer selections and restraints managers are set up once,
+  gradients() then only evaluates them at new coordinates.
+  """
+  def __init__(self, ph, cs, method="subtract", option=2):
+    assert method in ["subtract", "average"]
+    self.method = method
+    self.option = option
+    self.size = ph.atoms().size()
+    conf_ind = ph.get_conformer_indices().conformer_indices
+    self.n_altlocs = flex.max(conf_ind)
+    self.sel_W = conf_ind == 0
+    self.sel_W_empty = self.sel_W.count(True) == 0
+    self.conformers = []
+    for ci in range(1, self.n_altlocs+1):
+      sel_ci = conf_ind == ci
+      selection = sel_ci | self.sel_W
+      ph_conformer = ph.select(selection)
+      ci_ph_conformer = ph_conformer.get_conformer_indices().conformer_indices
+      self.conformers.append(group_args(
+        sel_ci    = sel_ci,
+        selection = selection,
+        c_zero    = ci_ph_conformer == 0,
+        c_one     = ci_ph_conformer == 1,
+        get_g     = get_cctbx_gradients(ph=ph_conformer, cs=cs, rm_only=True)))
+    self.get_g_blank = None
+    if(method=="subtract"):
+      """
+      Not suitable for QM as this needs to calculate gradients using the whole model
+      """
+      if(option==1 and not self.sel_W_empty):
+        self.get_g_blank = get_cctbx_gradients(
+          ph=ph.select(self.sel_W), cs=cs, rm_only=True)
+      if(option==2):
+        self.get_g_blank = get_cctbx_gradients(ph=ph, cs=cs, rm_only=True)
+
+  def gradients(self, sites_cart):
+    assert sites_cart.size() == self.size
+    sel_W = self.sel_W
+    g_result = flex.vec3_double(self.size, [0,0,0])
+    g_blanks = flex.vec3_double(sel_W.count(True))
+    for c in self.conformers:
+      _, g_ci_blank_ = c.get_g(sites_cart.select(c.selection))
+      g_ci = g_ci_blank_.select(c.c_one)
+      g_result = g_result.set_selected(c.sel_ci, g_ci)
+      g_blanks += g_ci_blank_.select(c.c_zero)
+    if(self.method=="subtract"):
+      # Option 1
+      if(self.option==1):
+        if(not self.sel_W_empty):
+          _, g_blank = self.get_g_blank(sites_cart.select(sel_W))
+          result = g_result.set_selected(sel_W,
+            g_blanks-((self.n_altlocs-1)*g_blank))
+        else:
+          # Both are exwctly equivalent
+          #result = get_cctbx_gradients(ph=ph, cs=cs).gradients
+          result = g_result
+      # Option 2
+      if(self.option==2):
+        _, g_blank = self.get_g_blank(sites_cart)
+        result = g_result.set_selected(sel_W, g_blank.select(sel_W))
+      #
+      # Options 1 and 2 are identical. Disabled for performance and because it
+      # expectedly crashes when altloc is ' '.
+      # assert approx_equal(g_result_1, g_result_2)
+    elif(self.method=="average"):
+      result = g_result.set_selected(sel_W, g_blanks*(1/self.n_altlocs))
+      # DEBUG ph.select(sel_W).write_pdb_file("sel_W.pdb")
+    else: assert 0
+    return result
+
 def from_cctbx_altlocs(ph, cs, method="subtract", option=2):
-  assert method in ["subtract", "average"]
-  g_result = flex.vec3_double(ph.atoms().size(), [0,0,0])
-  conf_ind = ph.get_conformer_indices().conformer_indices
-  n_altlocs = flex.max(conf_ind)
-  sel_W = conf_ind == 0
-  sel_W_empty = sel_W.count(True) == 0
-  g_blanks = flex.vec3_double(sel_W.count(True))
-  for ci in range(1, n_altlocs+1):
-    sel_ci = conf_ind == ci
-    ph_conformer = ph.select((conf_ind == ci) | sel_W)
-    ci_ph_conformer = ph_conformer.get_conformer_indices().conformer_indices
-    g_ci_blank_ = get_cctbx_gradients(ph=ph_conformer, cs=cs).gradients
-    g_ci = g_ci_blank_.select(ci_ph_conformer == 1)
-    g_result = g_result.set_selected(sel_ci, g_ci)
-    g_blanks += g_ci_blank_.select(ci_ph_conformer == 0)
-  if(method=="subtract"):
-    """
-    Not suitable for QM as this needs to calculate gradients using the whole model
-    """
-    # Option 1
-    if(option==1):
-      if(not sel_W_empty):
-        g_blank = get_cctbx_gradients(ph=ph.select(sel_W), cs=cs).gradients
-        result = g_result.set_selected(sel_W, g_blanks-((n_altlocs-1)*g_blank))
-      else:
-        # Both are exwctly equivalent
-        #result = get_cctbx_gradients(ph=ph, cs=cs).gradients
-        result = g_result
-    # Option 2
-    if(option==2):
-      g_blank = get_cctbx_gradients(ph=ph, cs=cs).gradients.select(sel_W)
-      result = g_result.set_selected(sel_W, g_blank)
-    #
-    # Options 1 and 2 are identical. Disabled for performance and because it
-    # expectedly crashes when altloc is ' '.
-    # assert approx_equal(g_result_1, g_result_2)
-  elif(method=="average"):
-    result = g_result.set_selected(sel_W, g_blanks*(1/n_altlocs))
-    # DEBUG ph.select(sel_W).write_pdb_file("sel_W.pdb")
-  else: assert 0
-  return result
+  return cctbx_altlocs(ph=ph, cs=cs, method=method, option=option).gradients(
+    sites_cart = ph.atoms().extract_xyz())
 
 class from_altlocs(object):
   def __init__(self, restraints_source, pdb_hierarchy, crystal_symmetry,
@@ -343,6 +428,8 @@ class from_altlocs(object):
     self.pdb_hierarchy      = pdb_hierarchy
     self.crystal_symmetry   = crystal_symmetry
     self.method             = method
+    self.altlocs = cctbx_altlocs(
+      ph=self.pdb_hierarchy, cs=self.crystal_symmetry, method=self.method)
 
   def __call__(self, selection_and_sites_cart):
     return self.target_and_gradients(
@@ -351,8 +438,11 @@ class from_altlocs(object):
       index      = selection_and_sites_cart[2])
 
   def target_and_gradients(self, sites_cart, selection=None, index=None):
-    gradient = from_cctbx_altlocs(
-      ph=self.pdb_hierarchy, cs=self.crystal_symmetry, method=self.method)
+    if(sites_cart is None):
+      sites_cart = self.pdb_hierarchy.atoms().extract_xyz()
+    else:
+      self.pdb_hierarchy.atoms().set_xyz(sites_cart)
+    gradient = self.altlocs.gradients(sites_cart=sites_cart)
     energy=None # undefined!
     return energy, gradient
 
@@ -386,18 +476,14 @@ class from_cctbx(object):
   def target_and_gradients(self, sites_cart, selection=None, index=None):
 
     if(selection is not None): ### clustering
-      super_selection = self.fragment_extracts.fragment_super_selections[index]
-      grm = self.fragment_extracts.super_sphere_geometry_restraints_manager
-
-      #es = grm.energies_sites(
-      #  sites_cart=sites_cart, compute_gradients=True)
-      #es.gradients = es.gradients.select(super_selection)[:selection.count(True)]
-      # Is this the same?
-      es = grm.select(super_selection).energies_sites(
-        sites_cart=sites_cart.select(super_selection), compute_gradients=True)
-      es.gradients = es.gradients[:selection.count(True)]
-      es.gradients = es.gradients * flex.double(
-            self.fragment_extracts.fragment_scales[index])
+      from .fragment import get_fragment_restraints
+      fr = get_fragment_restraints(
+        fragment_extracts = self.fragment_extracts,
+        index             = index)
+      es = fr.restraints_manager.energies_sites(
+        sites_cart=sites_cart.select(fr.super_iselection),
+        compute_gradients=True)
+      es.gradients = es.gradients[:fr.fragment_size] * fr.scales
     else:
       es = self.geometry_restraints_manager.energies_sites(
         sites_cart=sites_cart, compute_gradients=True)
@@ -420,7 +506,12 @@ class from_qm(object):
       basis                      = "sto-3g",
       memory                     = None,
       nproc                      = 1,
-      url                        = None
+      url                        = None,
+      cache_file_name            = None,
+      cache_max_size             = 512,
+      debug                      = False,
+      in_process                 = False,
+      warm_start                 = False
   ):
     self.fragment_extracts  = fragment_extracts
     self.method = method
@@ -430,6 +521,9 @@ class from_qm(object):
     self.qm_addon = qm_addon
     self.qm_addon_method = qm_addon_method
     self.url = url
+    self.debug = debug
+    self.in_process = in_process
+    self.warm_start = warm_start
 
     self.crystal_symmetry = crystal_symmetry
     self.pdb_hierarchy = pdb_hierarchy
@@ -448,6 +542,11 @@ class from_qm(object):
     self.clustering = clustering
     self.qm_engine = self.create_qm_engine()
     self.system_size = self.pdb_hierarchy.atoms_size()
+    self.qm_cache = None
+    if(cache_file_name is not None):
+      self.qm_cache = qm_cache(
+        file_name = cache_file_name,
+        max_size  = cache_max_size)
 
   def create_qm_engine(self):
     if(self.qm_engine_name == "turbomole"):
@@ -491,6 +590,8 @@ class from_qm(object):
                  'method',
                  'memory',
                  'nproc',
+                 'in_process',
+                 'warm_start',
                  ]:
       value = getattr(self, attr, None)
       func = getattr(calculator, 'set_%s' % attr, None)
@@ -512,38 +613,22 @@ class from_qm(object):
       selection  = fragment_selection_and_sites_cart[0],
       index      = fragment_selection_and_sites_cart[2])
 
+  def reset_states(self, keep=None):
+    """
+    Drop the SCF states of the QM engine, except those of fragments with
+    identity in keep.
+    """
+    if(hasattr(self.qm_engine, "reset_states")):
+      self.qm_engine.reset_states(keep=keep)
+
   def energies_sites(self, sites_cart, compute_gradients=True):
     tg = self.target_and_gradients(sites_cart=sites_cart)
     return group_args(
       target    = tg[0],
       gradients = tg[1])
 
-  def target_and_gradients(self,sites_cart, selection=None, index=None):
-    if(self.clustering):
-      from .fragment import get_qm_file_name_and_pdb_hierarchy
-      from .fragment import charge
-      from .fragment import write_mm_charge_file
-      #
-      qm_pdb_file, ph = get_qm_file_name_and_pdb_hierarchy(
-                          fragment_extracts=self.fragment_extracts,
-                          index=index)
-      #
-      qm_charge = charge(fragment_extracts=self.fragment_extracts,
-                                      index=index)
-      charge_file =  write_mm_charge_file(fragment_extracts=self.fragment_extracts,
-                                      index=index)
-      gradients_scale = self.fragment_extracts.fragment_scales[index]
-    else:
-      self.pdb_hierarchy.atoms().set_xyz(sites_cart)
-      self.pdb_hierarchy.write_pdb_file(file_name=self.file_name)
-      ph = self.pdb_hierarchy## return pdb_hierarchy
-      qm_pdb_file = self.file_name
-      qm_charge = self.charge
-      charge_file = None
-      selection =flex.bool(self.system_size, True)
-      gradients_scale = [1.0]*self.system_size
+  def _run_qm(self, atoms, qm_pdb_file, qm_charge, charge_file):
     define_str=''
-    atoms = ase_atoms_from_pdb_hierarchy(ph, self.crystal_symmetry, self.qm_engine_name)
     unit_convert = ase_units.mol/ase_units.kcal # ~ 23.06
     self.qm_engine.set_label(qm_pdb_file[:-4])
     cwd = os.getcwd()
@@ -579,12 +664,65 @@ class from_qm(object):
     else:
       energy = self.qm_engine.energy_free*unit_convert
       ase_gradients = (-1.0) * self.qm_engine.forces*unit_convert
+    return energy, ase_gradients
+
+  def target_and_gradients(self,sites_cart, selection=None, index=None):
+    if(self.clustering):
+      from .fragment import get_qm_file_name_and_pdb_hierarchy
+      from .fragment import charge
+      from .fragment import write_mm_charge_file
+      #
+      qm_pdb_file, ph = get_qm_file_name_and_pdb_hierarchy(
+                          fragment_extracts=self.fragment_extracts,
+                          index=index)
+      #
+      qm_charge = charge(fragment_extracts=self.fragment_extracts,
+                                      index=index)
+      charge_file =  write_mm_charge_file(fragment_extracts=self.fragment_extracts,
+                                      index=index)
+      n_fragment = self.fragment_extracts.fragment_index.fragment_size(index)
+      # SCF states follow the fragment, not its index
+      if(hasattr(self.qm_engine, "set_state_key")):
+        self.qm_engine.set_state_key(
+          self.fragment_extracts.fragment_index.fragment_key(index))
+      gradients_scale = self.fragment_extracts.fragment_index.fragment_scales(
+        index)
+    else:
+      self.pdb_hierarchy.atoms().set_xyz(sites_cart)
+      # engines get the coordinates as ASE atoms, the file is for inspection
+      if(self.debug):
+        self.pdb_hierarchy.write_pdb_file(file_name=self.file_name)
+      ph = self.pdb_hierarchy## return pdb_hierarchy
+      qm_pdb_file = self.file_name
+      qm_charge = self.charge
+      charge_file = None
+      n_fragment = self.system_size
+      gradients_scale = flex.double(self.system_size, 1.0)
+    atoms = ase_atoms_from_pdb_hierarchy(ph, self.crystal_symmetry, self.qm_engine_name)
+    result = None
+    if(self.qm_cache is not None):
+      cache_key = self.qm_cache.get_key(
+        atoms           = atoms,
+        pointcharges    = charge_file,
+        engine          = self.qm_engine_name,
+        method          = self.method,
+        basis           = self.basis,
+        charge          = qm_charge,
+        qm_addon        = self.qm_addon,
+        qm_addon_method = self.qm_addon_method)
+      result = self.qm_cache.get(cache_key)
+    if(result is None):
+      result = self._run_qm(atoms=atoms, qm_pdb_file=qm_pdb_file,
+        qm_charge=qm_charge, charge_file=charge_file)
+      if(self.qm_cache is not None):
+        self.qm_cache.put(cache_key, *result)
+    energy, ase_gradients = result
     # remove capping and neigbouring buffer
-    gradients = ase_gradients[:selection.count(True)]
+    gradients = ase_gradients[:n_fragment]
     gradients =  flex.vec3_double(gradients)
     ## TODO
     ## unchange the altloc gradient, averagely scale the non-altloc gradient
-    gradients = gradients*flex.double(gradients_scale)
+    gradients = gradients*gradients_scale
     return energy, gradients
 
 from ase import Atoms
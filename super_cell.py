@@ -12,10 +12,7 @@ from libtbx import group_args
 import math
 import iotbx.pdb.utils
 from cctbx.crystal import super_cell as cctbx_super_cell
-
-mon_lib_srv = mmtbx.monomer_library.server.server()
-ener_lib    = mmtbx.monomer_library.server.ener_lib(
-  use_neutron_distances = True)
+from qrefine.utils import hierarchy_utils
 
 class expand(object):
   def __init__(self, pdb_hierarchy, crystal_symmetry, select_within_radius=15,
@@ -66,8 +63,9 @@ class expand(object):
     params.restraints_library.cdl = False
     params.sort_atoms = False
     processed_pdb_file = mmtbx.monomer_library.pdb_interpretation.process(
-      mon_lib_srv              = mon_lib_srv,
-      ener_lib                 = ener_lib,
+      mon_lib_srv              = hierarchy_utils.get_mon_lib_server(),
+      ener_lib                 = hierarchy_utils.get_ener_lib(
+                                   use_neutron_distances = True),
       params                   = params,
       pdb_hierarchy            = self.ph_super_sphere,
       strict_conflict_handling = False,
@@ -0,0 +1,51 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+import libtbx.load_env
+from scitbx.array_family import flex
+from libtbx.test_utils import approx_equal
+from qrefine.fragment import fragments
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests = os.path.join(qrefine, "tests","unit")
+
+def run(prefix):
+  """
+  Exercise capping templates: caps re-placed from a template match the caps
+  from completion, and follow a rigid-body shift of the fragment.
+  """
+  file_name = os.path.join(qr_unit_tests,"data_files","helix.pdb")
+  pdb_inp = iotbx.pdb.input(file_name=file_name)
+  h = pdb_inp.construct_hierarchy()
+  fm = fragments(
+    working_folder             = "ase",
+    maxnum_residues_in_cluster = 2,
+    pdb_hierarchy              = h,
+    qm_engine_name             = "mopac",
+    crystal_symmetry           = pdb_inp.crystal_symmetry())
+  n_caps = 0
+  for i, selection in enumerate(fm.fragment_super_selections):
+    fragment_hierarchy = fm.pdb_hierarchy_super.select(selection)
+    capped = fm.fragment_capped_initial[i]
+    template = fm.capping_templates[i]
+    assert template is not None
+    n_caps += template.cap_to.size()
+    xyz = fragment_hierarchy.atoms().extract_xyz()
+    ph = template.rebuild(xyz)
+    assert ph.atoms_size() == capped.atoms_size()
+    assert approx_equal(ph.atoms().extract_xyz(),
+      capped.atoms().extract_xyz(), 1.e-6)
+    shift = flex.vec3_double(xyz.size(), (1.5, -2.0, 0.5))
+    ph = template.rebuild(xyz + shift)
+    shift = flex.vec3_double(ph.atoms_size(), (1.5, -2.0, 0.5))
+    assert approx_equal(ph.atoms().extract_xyz(),
+      capped.atoms().extract_xyz() + shift, 1.e-6)
+  assert n_caps > 0
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,60 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from ase import Atoms
+from scitbx.array_family import flex
+from libtbx.test_utils import approx_equal
+from qrefine.utils.qm_cache import qm_cache
+from qrefine.tests.unit import run_tests
+
+def run(prefix):
+  """
+  Exercise QM result cache: keys, hits/misses of this run and size-based
+  eviction.
+  """
+  file_name = "%s.sqlite"%prefix
+  if(os.path.exists(file_name)): os.remove(file_name)
+  cache = qm_cache(file_name=file_name, max_size=1)
+  atoms = Atoms(symbols=["O","H","H"],
+    positions=[[0,0,0],[0.96,0,0],[-0.24,0.93,0]])
+  key = cache.get_key(atoms=atoms, engine="mopac", method="PM7", charge=0)
+  # tiny coordinate noise is rounded away, a different charge is not
+  atoms_noise = atoms.copy()
+  atoms_noise.positions[0][0] += 1.e-8
+  assert key == cache.get_key(atoms=atoms_noise, engine="mopac",
+    method="PM7", charge=0)
+  assert key != cache.get_key(atoms=atoms, engine="mopac", method="PM7",
+    charge=1)
+  assert cache.get(key) is None
+  gradients = flex.vec3_double([(1,2,3),(4,5,6),(7,8,9)])
+  cache.put(key, -10.5, gradients)
+  energy, g = cache.get(key)
+  assert approx_equal(energy, -10.5)
+  assert approx_equal(g, gradients)
+  s = cache.get_statistics()
+  assert s["hits"] == 1 and s["misses"] == 1 and s["entries"] == 1
+  # a new cache object on the same file sees the stored results, counters
+  # start from zero
+  cache = qm_cache(file_name=file_name, max_size=1)
+  s = cache.get_statistics()
+  assert s["hits"] == 0 and s["misses"] == 0 and s["entries"] == 1
+  assert cache.get(key) is not None
+  assert cache.get_statistics()["hits"] == 1
+  # eviction of least recently used entries
+  big = flex.vec3_double(20000, (1,1,1))
+  for i in range(4):
+    cache.put("key_%d"%i, i, big)
+  s = cache.get_statistics()
+  assert s["size"] <= 1024*1024
+  assert s["evictions"] > 0
+  # running total matches the stored results
+  con = cache.connection()
+  assert s["size"] == con.execute("select sum(size) from results").fetchone()[0]
+  assert cache.get("key_3") is not None
+  cache.show()
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
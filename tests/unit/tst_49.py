@@ -0,0 +1,55 @@
+from __future__ import division
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+import libtbx.load_env
+from scitbx.array_family import flex
+from qrefine.contact_graph import contact_graph
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests = os.path.join(qrefine, "tests","unit")
+
+def brute_force_interaction_list(ph, cutoff):
+  rgs = list(ph.residue_groups())
+  result = []
+  for i in range(len(rgs)):
+    xyz_i = rgs[i].atoms().extract_xyz()
+    for j in range(i+1, len(rgs)):
+      xyz_j = rgs[j].atoms().extract_xyz()
+      for site in xyz_i:
+        if(flex.min((xyz_j - site).norms()) < cutoff):
+          result.append((i+1, j+1))
+          break
+  return result
+
+def run(prefix):
+  """
+  Exercise cell-list residue contact graph.
+  """
+  pdb_inp = iotbx.pdb.input(file_name= os.path.join(
+    qr_unit_tests,"data_files","2lvr.pdb"))
+  ph = pdb_inp.construct_hierarchy()
+  for cutoff in [2.0, 3.0, 4.5]:
+    graph = contact_graph(pdb_hierarchy=ph, cutoff=cutoff)
+    assert graph.interaction_list() == brute_force_interaction_list(ph, cutoff)
+  graph = contact_graph(pdb_hierarchy=ph, cutoff=3.0)
+  pairs = graph.interaction_list()
+  # peptide bonds are contacts
+  assert (1, 2) in pairs and (2, 3) in pairs
+  core = [3, 4]
+  atoms_in_cluster, atoms_in_fragment, molecules = graph.run(core)
+  rgs = list(ph.residue_groups())
+  assert len(atoms_in_cluster) == rgs[2].atoms_size()+rgs[3].atoms_size()
+  assert set(atoms_in_cluster).issubset(set(atoms_in_fragment))
+  expected = set(core)
+  for i, j in pairs:
+    if(i in core): expected.add(j)
+    if(j in core): expected.add(i)
+  assert molecules == sorted(expected)
+  assert len(atoms_in_fragment) == sum([rgs[m-1].atoms_size() for m in molecules])
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
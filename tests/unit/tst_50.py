@@ -0,0 +1,65 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+import libtbx.load_env
+from scitbx.array_family import flex
+from libtbx.test_utils import approx_equal
+from qrefine.fragment import fragments, fragment_index
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests = os.path.join(qrefine, "tests","unit")
+
+def run(prefix):
+  """
+  Exercise the array-backed fragment index: slices of the flat arrays give the
+  cluster, fragment, buffer and super-sphere selections of each fragment.
+  """
+  fi = fragment_index.from_serials(
+    system_size          = 6,
+    cluster_atoms        = [[1,2], [5,6]],
+    fragment_super_atoms = [[8,3,1,2], [6,4,5,7]],
+    fragment_scales      = [[0.5,1.0,0.25], [1.0,2.0,3.0]])
+  assert fi.size() == 2
+  assert list(fi.super_iselection(0)) == [0,1,2,7]
+  assert list(fi.fragment_iselection(0)) == [0,1,2]
+  assert list(fi.cluster_iselection(0)) == [0,1]
+  assert list(fi.buffer_iselection(0)) == [2]
+  # scales follow the model atoms of the fragment, re-ordered with them
+  assert approx_equal(fi.fragment_scales(0), [1.0,0.25,0.5])
+  assert approx_equal(fi.fragment_scales(1), [2.0,3.0,1.0])
+  assert fi.fragment_size(1) == 3
+  assert list(fi.buffer_iselection(1)) == [3]
+  assert list(fi.super_iselection(1)) == [3,4,5,6]
+  assert list(fi.cluster_positions_in_fragment(1)) == [1,2]
+  # fragment manager
+  file_name = os.path.join(qr_unit_tests,"data_files","helix.pdb")
+  pdb_inp = iotbx.pdb.input(file_name=file_name)
+  h = pdb_inp.construct_hierarchy()
+  fm = fragments(
+    working_folder             = "ase",
+    maxnum_residues_in_cluster = 2,
+    pdb_hierarchy              = h,
+    qm_engine_name             = "mopac",
+    crystal_symmetry           = pdb_inp.crystal_symmetry())
+  fi = fm.fragment_index
+  assert fi.size() == len(fm.clusters)
+  covered = flex.bool(h.atoms_size(), False)
+  for i in range(fi.size()):
+    cluster = fi.cluster_iselection(i)
+    fragment = fi.fragment_iselection(i)
+    assert fi.fragment_scales(i).size() == fragment.size()
+    assert flex.bool(h.atoms_size(), fragment).select(cluster).all_eq(True)
+    assert fragment.size() == cluster.size() + fi.buffer_iselection(i).size()
+    assert list(fragment.select(fi.cluster_positions_in_fragment(i))) == \
+      list(cluster)
+    assert covered.select(cluster).count(True) == 0
+    covered.set_selected(cluster, True)
+  assert covered.all_eq(True)
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
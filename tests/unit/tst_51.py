@@ -0,0 +1,33 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from libtbx.test_utils import approx_equal
+from qrefine.cluster_restraints import fragment_scheduler
+from qrefine.tests.unit import run_tests
+
+def run(prefix):
+  """
+  Exercise the fragment scheduler: largest-first order from fragment sizes,
+  then from measured times; calibration survives re-clustering.
+  """
+  s = fragment_scheduler(engine_name="orca")
+  assert s.exponent == 3
+  s.set_fragments(sizes=[10, 40, 20, 30], clustering=1)
+  assert s.get_order() == [1, 3, 2, 0]
+  # fragment 1 turns out to be fast
+  for index, seconds in [(0, 1.), (1, 2.), (2, 8.), (3, 27.)]:
+    s.update(index, seconds)
+  assert s.get_order() == [3, 2, 1, 0]
+  # new clustering: sizes again, scaled by measured/estimated
+  s.set_fragments(sizes=[20, 10], clustering=2)
+  assert s.get_order() == [0, 1]
+  ratio = 38./(10**3+40**3+20**3+30**3)
+  assert approx_equal(s.estimate(1), 10**3*ratio)
+  assert fragment_scheduler(engine_name="torchani").exponent == 1
+  assert fragment_scheduler(engine_name="mopac").exponent == 2
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,39 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from scitbx.array_family import flex
+from libtbx.test_utils import approx_equal
+from qrefine.charges import match_positions, scale_partial_point_charges
+from qrefine.charges import write_point_charges
+from qrefine.tests.unit import run_tests
+
+def run(prefix):
+  """
+  Exercise point-charge helpers: matching of scaling positions and writing
+  of qxyz/xyzq files.
+  """
+  sites = [(0,0,0), (1.0004,2,3), (5,5,5), (-1.0005,0,0.0009), (7,7,7)]
+  positions = [[1,2,3], [-1,0,0], [7,7,7.002]]
+  assert match_positions(sites, positions) == [1,3]
+  assert match_positions(sites, []) == []
+  qxyz = [[0.5]+list(s) for s in sites]
+  scale_partial_point_charges(qxyz, positions, scale=0)
+  assert approx_equal([q[0] for q in qxyz], [0.5,0,0.5,0,0.5])
+  charges = flex.double([0.5,-0.25])
+  sites_cart = flex.vec3_double([(1,2,3),(4,5,6)])
+  file_name = "%s_qxyz.dat"%prefix
+  write_point_charges(file_name, charges, sites_cart, qxyz_order="qxyz")
+  lines = open(file_name).read().splitlines()
+  assert len(lines) == 4 and int(lines[0]) == 2
+  assert approx_equal([float(x) for x in lines[3].split()], [-0.25,4,5,6])
+  file_name = "%s_xyzq.dat"%prefix
+  write_point_charges(file_name, charges, sites_cart, qxyz_order="xyzq")
+  lines = open(file_name).read().splitlines()
+  assert len(lines) == 2
+  assert approx_equal([float(x) for x in lines[0].split()], [1,2,3,0.5])
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
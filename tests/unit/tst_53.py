@@ -0,0 +1,54 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+import libtbx.load_env
+from qrefine.fragment import fragments
+from qrefine.charges import charges_class, get_formal_charge, residue_charges
+from qrefine.charges import get_covalent_i_seqs
+from qrefine.tests.unit import run_tests
+
+pdb_str = """
+ATOM      1  NE2 HIS A   1       0.000   0.000   0.000  1.00 10.00           N
+ATOM      2  OD1 ASP A   2       3.000   0.000   1.000  1.00 10.00           O
+HETATM    3 ZN    ZN A   3       2.000   0.000   0.000  1.00 10.00          ZN
+ATOM      4  SG  CYS A   4       0.000   5.000   0.000  1.00 10.00           S
+ATOM      5  SG  CYS A   5       2.040   5.000   0.000  1.00 10.00           S
+HETATM    6  C1  LIG A   6       9.000   9.000   9.000  1.00 10.00           C
+"""
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests = os.path.join(qrefine, "tests","unit")
+
+def run(prefix):
+  """
+  Exercise fragment charges from memoized residue charges against electron
+  counting of the whole capped fragment, covalent bonds between residues.
+  """
+  file_name = os.path.join(qr_unit_tests,"data_files","m00_good.pdb")
+  pdb_inp = iotbx.pdb.input(file_name=file_name)
+  h = pdb_inp.construct_hierarchy()
+  fm = fragments(
+    working_folder             = "ase",
+    maxnum_residues_in_cluster = 2,
+    pdb_hierarchy              = h,
+    qm_engine_name             = "mopac",
+    crystal_symmetry           = pdb_inp.crystal_symmetry(),
+    validate_fragment_charges  = True)
+  assert len(residue_charges) > 0
+  # zinc coordination is not a covalent bond, S-S is
+  h = iotbx.pdb.input(source_info=None, lines=pdb_str).construct_hierarchy()
+  h.atoms().reset_i_seq()
+  assert sorted(get_covalent_i_seqs(h)) == [3, 4]
+  # ligands are left to electron counting
+  assert get_formal_charge(h) is None
+  for capped, charge in zip(fm.fragment_capped_initial, fm.fragment_charges):
+    assert get_formal_charge(capped) == charge
+    assert charges_class(pdb_hierarchy=capped,
+      crystal_symmetry=fm.expansion.cs_box).get_total_charge() == charge
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
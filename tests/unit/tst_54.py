@@ -0,0 +1,65 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+import libtbx.load_env
+from scitbx.array_family import flex
+from qrefine import completion
+from qrefine.capping import capper, bond_table, get_neighbors
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests = os.path.join(qrefine, "tests","unit")
+
+def run(prefix):
+  """
+  Exercise direct capping: caps learnt from completion on some fragments of a
+  helix are placed on the other fragments as completion would place them,
+  also with bonds sliced from a bond table of the whole model.
+  """
+  file_name = os.path.join(qr_unit_tests,"data_files","helix.pdb")
+  pdb_inp = iotbx.pdb.input(file_name=file_name)
+  h = pdb_inp.construct_hierarchy()
+  cs = pdb_inp.crystal_symmetry()
+  asc = h.atom_selection_cache()
+  def complete(fragment):
+    return completion.run(pdb_hierarchy=fragment, crystal_symmetry=cs,
+      model_completion=False)
+  c = capper()
+  assert c.cap(h.select(asc.selection("resseq 88:90"))) is None
+  for selection in ["resseq 87:89", "resseq 88:90"]:
+    fragment = h.select(asc.selection(selection))
+    c.harvest(fragment, complete(fragment))
+  assert len(c.sites) > 0
+  for selection in ["resseq 91:93", "resseq 94:97"]:
+    fragment = h.select(asc.selection(selection))
+    expected = complete(fragment)
+    result = c.cap(fragment)
+    assert result is not None
+    assert result.atoms_size() == expected.atoms_size()
+    xyz = {}
+    for atom in expected.atoms(): xyz[atom.id_str()] = atom.xyz
+    for atom in result.atoms():
+      d = flex.vec3_double([atom.xyz]) - flex.vec3_double([xyz[atom.id_str()]])
+      assert d.norms()[0] < 0.2, atom.id_str()
+    assert list(result.atoms().extract_xyz()[:fragment.atoms_size()]) == \
+      list(fragment.atoms().extract_xyz())
+  # bonds sliced from the table of the whole model
+  table = bond_table(h)
+  selection = asc.selection("resseq 91:93")
+  bonds = table.select(selection.iselection())
+  fragment = h.select(selection)
+  assert [sorted(n) for n in get_neighbors(fragment.atoms())] == \
+    [sorted(n) for n in bonds.neighbors]
+  atoms = h.atoms()
+  crossing = sorted([(fragment.atoms()[i].name.strip(), atoms[j].name.strip(),
+    atoms[j].parent().parent().resseq_as_int()) for i, j in bonds.crossing])
+  assert crossing == [("C","N",94), ("N","C",90)], crossing
+  assert c.cap(fragment, bonds=bonds).atoms().extract_xyz().all_eq(
+    c.cap(fragment).atoms().extract_xyz())
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
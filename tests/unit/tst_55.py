@@ -0,0 +1,39 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+from qrefine.utils import hierarchy_utils
+from qrefine.tests.unit import run_tests
+
+pdb_str = """
+ATOM      1  H1  GLY A   1       1.000   1.000   1.000  1.00 10.00           H
+ATOM      2  H2  GLY A   1       2.000   1.000   1.000  1.00 10.00           H
+ATOM      3  H3  GLY A   1       3.000   1.000   1.000  1.00 10.00           H
+ATOM      4  H   GLY B   1       4.000   1.000   1.000  1.00 10.00           H
+"""
+
+def get_chains(names):
+  h = iotbx.pdb.input(source_info=None, lines=pdb_str).construct_hierarchy()
+  for atom in h.atoms():
+    if(atom.name.strip() not in names): atom.parent().remove_atom(atom)
+  return [chain.detached_copy() for chain in h.only_model().chains()]
+
+def run(prefix):
+  """
+  Exercise smart_add_atoms: atoms already added are dropped from new items,
+  keeping the order of the remaining atoms.
+  """
+  result = hierarchy_utils.smart_add_atoms()
+  result.append(get_chains(["H1", "H2"]))
+  result.append(get_chains(["H2", "H3", "H"]))
+  result.append(get_chains(["H1", "H3"]))
+  assert len(result) == 3
+  names = [[[a.name.strip() for a in chain.atoms()] for chain in item]
+           for item in result]
+  assert names == [[["H1","H2"],[]], [["H3"],["H"]], [[],[]]], names
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,53 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+import libtbx.load_env
+from scitbx.array_family import flex
+from libtbx.test_utils import approx_equal
+from qrefine.fragment import fragments, get_fragment_restraints
+from qrefine.restraints import from_cctbx
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests = os.path.join(qrefine, "tests","unit")
+
+def run(prefix):
+  """
+  Exercise per-fragment cctbx restraints: selected once per clustering, same
+  gradients as selecting from the super-sphere restraints at every call.
+  """
+  file_name = os.path.join(qr_unit_tests,"data_files","helix.pdb")
+  pdb_inp = iotbx.pdb.input(file_name=file_name)
+  fm = fragments(
+    working_folder             = "ase",
+    maxnum_residues_in_cluster = 3,
+    pdb_hierarchy              = pdb_inp.construct_hierarchy(),
+    qm_engine_name             = "mopac",
+    crystal_symmetry           = pdb_inp.crystal_symmetry())
+  fe = fm.get_fragment_extracts()
+  fi = fm.fragment_index
+  grm = fe.super_sphere_geometry_restraints_manager
+  sites_cart = fm.pdb_hierarchy_super.atoms().extract_xyz()
+  fc = from_cctbx(restraints_manager=None, fragment_extracts=fe)
+  for index in range(fi.size()):
+    t, g = fc.target_and_gradients(sites_cart=sites_cart,
+      selection=fi.fragment_iselection(index), index=index)
+    fr = get_fragment_restraints(fe, index)
+    assert get_fragment_restraints(fe, index) is fr
+    super_iselection = fi.super_iselection(index)
+    es = grm.select(flex.bool(sites_cart.size(), super_iselection)).\
+      energies_sites(sites_cart=sites_cart.select(super_iselection),
+        compute_gradients=True)
+    assert approx_equal(t, es.target)
+    assert approx_equal(g,
+      es.gradients[:fi.fragment_size(index)] * fi.fragment_scales(index))
+  assert len(fm.fragment_restraints) == fi.size()
+  fm.set_up_cluster_qm()
+  assert len(fm.fragment_restraints) == 0
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
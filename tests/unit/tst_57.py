@@ -0,0 +1,69 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+import libtbx.load_env
+from scitbx.array_family import flex
+from libtbx.test_utils import approx_equal
+from qrefine import restraints
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests = os.path.join(qrefine, "tests","unit")
+
+def gradients_from_scratch(ph, cs, method, option):
+  """
+  Altloc gradients with the restraints of every conformer set up again at
+  the coordinates of ph.
+  """
+  g_result = flex.vec3_double(ph.atoms().size(), [0,0,0])
+  conf_ind = ph.get_conformer_indices().conformer_indices
+  n_altlocs = flex.max(conf_ind)
+  sel_W = conf_ind == 0
+  g_blanks = flex.vec3_double(sel_W.count(True))
+  for ci in range(1, n_altlocs+1):
+    sel_ci = conf_ind == ci
+    ph_conformer = ph.select(sel_ci | sel_W)
+    ci_ph_conformer = ph_conformer.get_conformer_indices().conformer_indices
+    g = restraints.get_cctbx_gradients(ph=ph_conformer, cs=cs).gradients
+    g_result = g_result.set_selected(sel_ci, g.select(ci_ph_conformer == 1))
+    g_blanks += g.select(ci_ph_conformer == 0)
+  if(method == "average"):
+    return g_result.set_selected(sel_W, g_blanks*(1/n_altlocs))
+  if(option == 1):
+    if(sel_W.count(True) == 0): return g_result
+    g_blank = restraints.get_cctbx_gradients(ph=ph.select(sel_W),
+      cs=cs).gradients
+    return g_result.set_selected(sel_W, g_blanks-((n_altlocs-1)*g_blank))
+  g_blank = restraints.get_cctbx_gradients(ph=ph, cs=cs).gradients
+  return g_result.set_selected(sel_W, g_blank.select(sel_W))
+
+def run(prefix):
+  """
+  Exercise cctbx_altlocs: restraints of the conformers are set up once and
+  give the same gradients at new coordinates as setting them up again.
+  """
+  flex.set_random_seed(0)
+  for file_name in ["h_altconf_complete.pdb", "altlocs.pdb"]:
+    file_name = os.path.join(qr_unit_tests,"data_files",file_name)
+    pi = iotbx.pdb.input(file_name = file_name)
+    ph = pi.construct_hierarchy()
+    cs = pi.crystal_symmetry()
+    for method, option in [("subtract", 1), ("subtract", 2), ("average", 2)]:
+      altlocs = restraints.cctbx_altlocs(ph=ph, cs=cs, method=method,
+        option=option)
+      for shake in [0, 0.1]:
+        sites_cart = ph.atoms().extract_xyz() + flex.vec3_double(
+          flex.random_double(ph.atoms().size()*3)*shake)
+        g1 = altlocs.gradients(sites_cart=sites_cart)
+        ph_shaken = ph.deep_copy()
+        ph_shaken.atoms().set_xyz(sites_cart)
+        g2 = gradients_from_scratch(ph=ph_shaken, cs=cs, method=method,
+          option=option)
+        assert approx_equal(g1, g2)
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,58 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import multiprocessing
+import iotbx.pdb
+import libtbx.load_env
+from libtbx.test_utils import approx_equal
+from qrefine import qr
+from qrefine import restraints
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests = os.path.join(qrefine, "tests","unit")
+
+def run(prefix):
+  """
+  Exercise from_altlocs2 with conformers evaluated at the same time: same
+  gradients as evaluating them one after another, whatever the default start
+  method of multiprocessing.
+  """
+  file_name = os.path.join(qr_unit_tests,"data_files","h_altconf_complete.pdb")
+  pi = iotbx.pdb.input(file_name = file_name)
+  for method in ["subtract", "average"]:
+    result = []
+    for nproc in [1, 3]:
+      model = restraints.model_from_hierarchy(
+        pdb_hierarchy    = pi.construct_hierarchy(),
+        crystal_symmetry = pi.crystal_symmetry())
+      params = qr.get_default_params()
+      params.restraints = "cctbx"
+      params.cluster.clustering = False
+      params.parallel.nproc = nproc
+      rm = restraints.from_altlocs2(model = model, method = method,
+        params = params)
+      if(nproc > 1): assert rm.n_processes(n_jobs = 3) > 1
+      _, g = rm.target_and_gradients(sites_cart = model.get_sites_cart())
+      result.append(g)
+    assert approx_equal(result[0], result[1])
+  # workers are forked even if spawn is the default
+  start_method = multiprocessing.get_start_method()
+  multiprocessing.set_start_method("spawn", force=True)
+  try:
+    model = restraints.model_from_hierarchy(
+      pdb_hierarchy    = pi.construct_hierarchy(),
+      crystal_symmetry = pi.crystal_symmetry())
+    params.parallel.nproc = 3
+    rm = restraints.from_altlocs2(model = model, method = "average",
+      params = params)
+    _, g = rm.target_and_gradients(sites_cart = model.get_sites_cart())
+    assert approx_equal(g, result[0])
+  finally:
+    multiprocessing.set_start_method(start_method, force=True)
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
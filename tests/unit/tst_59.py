@@ -0,0 +1,45 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from ase import Atoms
+from libtbx.test_utils import approx_equal
+from qrefine.plugin.ase.xtb_qr import GFNxTB, parse_method, has_xtb_python
+from qrefine.tests.unit import run_tests
+
+def run(prefix):
+  """
+  Exercise the in-process xTB engine: xtb options it supports and warm
+  restarts giving the same results as a cold start.
+  """
+  s = parse_method(" --gfn 2 --etemp 500 --acc 0.1 --gbsa h2o")
+  assert s == {'gfn': '2', 'etemp': '500', 'acc': '0.1', 'solvent': 'h2o'}
+  assert parse_method("-gfn1")['gfn'] == '1'
+  assert parse_method("--gfnff --grad")['gfn'] == 'ff'
+  assert parse_method("--gfn 3") is None
+  assert parse_method("--alpb water") is None
+  assert parse_method("rhf") is None
+  if(not has_xtb_python()):
+    print("xtb-python is not available, skipping.")
+    return
+  water = Atoms("OH2", positions=[(0,0,0), (0.96,0,0), (-0.24,0.93,0)])
+  moved = water.copy()
+  moved.positions[1][0] += 0.01
+  warm = GFNxTB(method="--gfn 2 --acc 0.1")
+  warm.set_in_process(True)
+  warm.set_label(prefix)
+  warm.run_qr(water, coordinates=None, charge=0, pointcharges=None)
+  warm.run_qr(moved, coordinates=None, charge=0, pointcharges=None)
+  assert warm.states[prefix]['results'] is not None
+  cold = GFNxTB(method="--gfn 2 --acc 0.1")
+  cold.set_in_process(True)
+  cold.set_label(prefix)
+  cold.run_qr(moved, coordinates=None, charge=0, pointcharges=None)
+  assert approx_equal(warm.energy_free, cold.energy_free, 1.e-4)
+  assert approx_equal(list(warm.forces.flatten()),
+    list(cold.forces.flatten()), 1.e-3)
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,42 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from ase import Atoms
+from qrefine.plugin.ase.mopac_qr import Mopac
+from qrefine.tests.unit import run_tests
+
+def run(prefix):
+  """
+  Exercise MOPAC warm starts: DENOUT is requested, OLDENS only with a density
+  of a run with the same composition.
+  """
+  water = Atoms("OH2", positions=[(0,0,0), (0.96,0,0), (-0.24,0.93,0)])
+  calculator = Mopac()
+  calculator.set_label(prefix)
+  calculator.set_charge(0)
+  calculator.set_nproc(1)
+  fname = prefix + ".mop"
+  def keywords(oldens):
+    calculator.write_input(fname, water, oldens=oldens)
+    return open(fname).readline().split()
+  assert "DENOUT" not in keywords(oldens=False)
+  calculator.set_warm_start(True)
+  assert "DENOUT" in keywords(oldens=False)
+  assert "OLDENS" not in keywords(oldens=False)
+  assert "OLDENS" in keywords(oldens=True)
+  for f in [prefix + ".den", prefix + ".den.key"]:
+    if(os.path.exists(f)): os.remove(f)
+  assert not calculator.density_matches(water)
+  open(prefix + ".den", "w").write("density")
+  open(prefix + ".den.key", "w").write(calculator.get_density_key(water))
+  assert calculator.density_matches(water)
+  calculator.set_charge(1)
+  assert not calculator.density_matches(water)
+  calculator.set_charge(0)
+  assert not calculator.density_matches(Atoms("OH", positions=water.positions[:2]))
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
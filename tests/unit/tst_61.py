@@ -0,0 +1,50 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from ase import Atoms
+from libtbx.test_utils import approx_equal
+from qrefine.plugin.ase.mopac_qr import Mopac, get_libmopac
+from qrefine.tests.unit import run_tests
+
+def run(prefix):
+  """
+  Exercise the MOPAC library backend: settings it supports and same energy
+  and forces as the MOPAC program.
+  """
+  water = Atoms("OH2", positions=[(0,0,0), (0.96,0,0), (-0.24,0.93,0)])
+  calculator = Mopac()
+  assert calculator.get_api_model(water) == 0
+  calculator.set_method("pm6-d3h4")
+  assert calculator.get_api_model(water) == 1
+  calculator.set_method("PM3")
+  assert calculator.get_api_model(water) is None
+  calculator.set_method("PM7")
+  calculator.set(job_type=" 1SCF GRADIENTS MOZYME ")
+  assert calculator.get_api_model(water) is None
+  if(get_libmopac() is None or calculator.command is None):
+    print("MOPAC library or program is not available, skipping.")
+    return
+  result = []
+  for in_process in [False, True, True]:
+    calculator = Mopac()
+    calculator.set_label(prefix)
+    calculator.set_nproc(1)
+    calculator.set_in_process(in_process)
+    calculator.set_warm_start(True)
+    calculator.run_qr(water, charge=0)
+    if(in_process): assert calculator.version == "library"
+    result.append((calculator.energy_free, calculator.forces))
+  # states of the last clustering are freed
+  assert prefix in calculator.states
+  calculator.reset_states()
+  assert calculator.states == {}
+  for energy, forces in result[1:]:
+    assert approx_equal(energy, result[0][0], 1.e-3)
+    assert approx_equal(list(forces.flatten()),
+      list(result[0][1].flatten()), 1.e-2)
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,53 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from ase import Atoms
+from libtbx.test_utils import approx_equal
+from qrefine.tests.unit import run_tests
+
+def run(prefix):
+  """
+  Exercise the PySCF engine: one SCF per call, warm started from the density
+  of the previous call of the same label, same results as a cold start.
+  """
+  try:
+    import pyscf
+  except ImportError:
+    print("PySCF is not available, skipping.")
+    return
+  from qrefine.plugin.ase.pyscf_qr import Pyscf
+  water = Atoms("OH2", positions=[(0,0,0), (0.96,0,0), (-0.24,0.93,0)])
+  moved = water.copy()
+  moved.positions[1][0] += 0.01
+  warm = Pyscf()
+  warm.set_method("HF")
+  warm.set_basis("sto-3g")
+  warm.set_label(prefix)
+  warm.run_qr(water, coordinates=None, charge=0)
+  state = warm.states[prefix]
+  warm.run_qr(moved, coordinates=None, charge=0)
+  assert warm.states[prefix] is state
+  assert state['dm'] is not None
+  cold = Pyscf(method="hf", basis="sto-3g")
+  cold.set_label(prefix)
+  cold.run_qr(moved, coordinates=None, charge=0)
+  assert approx_equal(warm.energy_free, cold.energy_free, 1.e-5)
+  assert approx_equal(list(warm.forces.flatten()),
+    list(cold.forces.flatten()), 1.e-3)
+  # new composition: new Mole and SCF objects
+  cold.run_qr(Atoms("H2", positions=[(0,0,0), (0.74,0,0)]), coordinates=None,
+    charge=0)
+  assert cold.states[prefix]['key'][0] == ("H", "H")
+  # states of fragments kept by re-clustering are kept
+  cold.set_state_key("fragment")
+  cold.run_qr(water, coordinates=None, charge=0)
+  cold.reset_states(keep=set(["fragment"]))
+  assert list(cold.states.keys()) == ["fragment"]
+  cold.reset_states()
+  assert cold.states == {}
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,67 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+from ase import Atoms
+from ase.units import Hartree, Bohr, kcal, mol
+from libtbx.test_utils import approx_equal
+from qrefine.plugin.ase.orca_qr import Orca
+from qrefine.tests.unit import run_tests
+
+engrad_str = """#
+# Number of atoms
+#
+ 2
+#
+# The current total energy in Eh
+#
+    -1.117506236181
+#
+# The current gradient in Eh/bohr
+#
+       0.000000000000
+       0.000000000000
+      -0.012345678900
+       0.000000000000
+       0.000000000000
+       0.012345678900
+#
+# The atomic numbers and current coordinates in Bohr
+#
+   1     0.0000000    0.0000000   -0.6929756
+   1     0.0000000    0.0000000    0.6929756
+"""
+
+def run(prefix):
+  """
+  Exercise the ORCA engine: energy and forces from .engrad, MORead only with
+  orbitals of a run with the same composition.
+  """
+  h2 = Atoms("H2", positions=[(0,0,0), (0,0,0.74)])
+  calculator = Orca(label=prefix)
+  calculator.set_charge(0)
+  fname = prefix + ".engrad"
+  open(fname, "w").write(engrad_str)
+  energy, forces = calculator.read_engrad(fname, prefix + ".out", h2)
+  assert approx_equal(energy, -1.117506236181*Hartree/(kcal/mol))
+  assert approx_equal(forces[1][2], -0.0123456789*Hartree/Bohr/(kcal/mol))
+  assert approx_equal(forces[0][2], 0.0123456789*Hartree/Bohr/(kcal/mol))
+  # guess orbitals
+  calculator.set_warm_start(True)
+  for f in [calculator.get_guess_file(), calculator.get_guess_file()+".key"]:
+    if(os.path.exists(f)): os.remove(f)
+  assert not calculator.guess_matches(h2)
+  open(calculator.get_guess_file(), "w").write("orbitals")
+  open(calculator.get_guess_file()+".key", "w").write(
+    calculator.get_guess_key(h2))
+  assert calculator.guess_matches(h2)
+  calculator.write_input(prefix + ".inp", h2, moread=True)
+  text = open(prefix + ".inp").read()
+  assert "MORead" in text and prefix + "_guess.gbw" in text
+  calculator.set_charge(1)
+  assert not calculator.guess_matches(h2)
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,61 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import copy
+import iotbx.pdb
+import libtbx.load_env
+from mmtbx import pair_interaction
+from qrefine.fragment import fragments, pair_interaction_graph
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests = os.path.join(qrefine, "tests","unit")
+
+def get_hierarchies(ph):
+  """
+  Hierarchy of each conformer, as in fragments.get_fragments.
+  """
+  altlocs = sorted(ph.altloc_indices().keys())
+  if(len(altlocs) < 2): return [ph]
+  asc = ph.atom_selection_cache()
+  return [ph.select(asc.selection(
+            "altloc '%s' or altloc '' or altloc ' '" % altloc))
+          for altloc in altlocs if altloc != ""]
+
+def exercise(file_name):
+  pdb_inp = iotbx.pdb.input(file_name=file_name)
+  h = pdb_inp.construct_hierarchy()
+  fm = fragments(
+    working_folder             = "ase",
+    maxnum_residues_in_cluster = 3,
+    pdb_hierarchy              = h,
+    qm_engine_name             = "mopac",
+    crystal_symmetry           = pdb_inp.crystal_symmetry(),
+    interaction_method         = "pair_interaction",
+    clusters_only              = True)
+  assert len(fm.clusters) > 1
+  for ph in get_hierarchies(fm.pdb_hierarchy_super):
+    graph = pair_interaction_graph(ph)
+    for cluster in fm.clusters:
+      cluster_atoms, fragment_atoms, molecules = graph.run(cluster)
+      cluster_atoms_ref, fragment_atoms_ref, molecules_ref = \
+        pair_interaction.run(copy.deepcopy(ph), cluster)
+      assert sorted(molecules) == sorted(molecules_ref), file_name
+      assert sorted(cluster_atoms) == sorted(cluster_atoms_ref), file_name
+      assert sorted(fragment_atoms) == sorted(fragment_atoms_ref), file_name
+
+def run(prefix):
+  """
+  Exercise pair_interaction_graph: buffers of all clusters answered from the
+  interactions computed once match pair_interaction run per cluster, for a
+  helix, altlocs, a zinc site and several chains with waters.
+  """
+  for file_name in ["helix.pdb", "h_altconf_complete.pdb", "2lvr.pdb",
+                    "2ona_box_S.pdb"]:
+    exercise(file_name=os.path.join(qr_unit_tests,"data_files",file_name))
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,83 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+from libtbx import group_args
+from scitbx.array_family import flex
+from qrefine.cluster_restraints import worker_pool
+from qrefine.tests.unit import run_tests
+
+pdb_str = """
+ATOM      1  O   HOH A   1       0.000   0.000   0.000  1.00 10.00           O
+ATOM      2  O   HOH A   2       3.000   0.000   0.000  1.00 10.00           O
+"""
+
+class fragment_index(object):
+  def fragment_iselection(self, i):
+    return flex.size_t([i % 2])
+
+class worker_id(object):
+  """
+  Restraints manager returning the process that evaluated the fragment.
+  """
+  def __init__(self, pdb_hierarchy):
+    self.fragment_extracts = group_args(
+      pdb_hierarchy_super = pdb_hierarchy,
+      fragment_index      = fragment_index())
+
+  def target_and_gradients(self, sites_cart, selection, index):
+    return os.getpid(), sites_cart.select(selection)
+
+def run(prefix):
+  """
+  Exercise worker_pool: pinned, every fragment is evaluated by the same
+  worker whatever the order of evaluation, also when it changes index after
+  re-clustering; workers stop when the pool is dropped.
+  """
+  h = iotbx.pdb.input(source_info=None, lines=pdb_str).construct_hierarchy()
+  sites_cart = h.atoms().extract_xyz()
+  pool = worker_pool(
+    restraints_manager = worker_id(pdb_hierarchy=h),
+    n_sites            = sites_cart.size(),
+    processes          = 2,
+    pinned             = True)
+  try:
+    keys = ["k%d"%i for i in range(6)]
+    pool.assign(keys=keys, costs=[1]*len(keys))
+    workers = {}
+    for indices in [range(6), [5,3,1,4,2,0], [2,0,5]]:
+      results = pool.map(sites_cart=sites_cart, indices=list(indices),
+        keys=keys)
+      assert sorted([r[0] for r in results]) == sorted(indices)
+      for index, result, seconds in results:
+        assert workers.setdefault(keys[index], result[0]) == result[0]
+    assert len(set(workers.values())) == 2
+    # re-clustering: kept fragments change index, new ones fill in
+    keys = ["k5", "new0", "k0", "k3", "new1"]
+    pool.assign(keys=keys, costs=[1]*len(keys))
+    results = pool.map(sites_cart=sites_cart, indices=range(5), keys=keys)
+    for index, result, seconds in results:
+      if(keys[index] in workers):
+        assert workers[keys[index]] == result[0]
+    # largest first to the least loaded worker
+    pool.workers = {}
+    pool.assign(keys=["a", "b", "c", "d"], costs=[1, 8, 4, 3])
+    w = pool.workers
+    assert w["a"] == w["c"] == w["d"] != w["b"]
+  finally:
+    pool.close()
+  pool = worker_pool(
+    restraints_manager = worker_id(pdb_hierarchy=h),
+    n_sites            = sites_cart.size(),
+    processes          = 2)
+  assert len(pool.map(sites_cart=sites_cart, indices=[0,1])) == 2
+  processes = list(pool.pools[0]._pool)
+  del pool
+  for p in processes:
+    assert not p.is_alive()
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
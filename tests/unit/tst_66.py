@@ -0,0 +1,55 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+from libtbx.utils import Sorry
+from scitbx.array_family import flex
+from qrefine.fragment import fragments
+from qrefine.tests.unit import run_tests
+
+pdb_str = """
+CRYST1   40.000   40.000   40.000  90.00  90.00  90.00 P 1
+ATOM      1  N   GLY A  87       7.109  12.926   5.576  1.00 80.00           N
+ATOM      2  CA  GLY A  87       7.840  12.041   6.465  1.00 80.00           C
+ATOM      3  C   GLY A  87       8.271  12.731   7.773  1.00 80.00           C
+ATOM      4  O   GLY A  87       8.615  12.020   8.719  1.00 80.00           O
+ATOM      5  H1  GLY A  87       7.550  12.998   4.795  1.00 80.00           H
+ATOM      6  H2  GLY A  87       6.288  12.590   5.426  1.00 80.00           H
+ATOM      7  H3  GLY A  87       7.036  13.739   5.955  1.00 80.00           H
+ATOM      8  HA2 GLY A  87       7.287  11.273   6.677  1.00 80.00           H
+ATOM      9  HA3 GLY A  87       8.627  11.706   6.006  1.00 80.00           H
+HETATM   10 NA    NA A  88      16.000  16.000  16.000  1.00 80.00          NA
+"""
+
+def run(prefix):
+  """
+  Exercise point charges of the super-sphere: only embedded atoms are
+  charged, an atom without charge only fails when it is embedded.
+  """
+  pdb_inp = iotbx.pdb.input(source_info=None, lines=pdb_str)
+  fm = fragments(
+    working_folder             = "ase",
+    pdb_hierarchy              = pdb_inp.construct_hierarchy(),
+    qm_engine_name             = "mopac",
+    crystal_symmetry           = pdb_inp.crystal_symmetry(),
+    charge_embedding           = True,
+    clusters_only              = True)
+  resnames = [a.parent().resname.strip()
+              for a in fm.pdb_hierarchy_super.atoms()]
+  gly = flex.size_t([i for i, r in enumerate(resnames) if r == "GLY"])
+  na = flex.size_t([i for i, r in enumerate(resnames) if r == "NA"])
+  assert gly.size() > 0 and na.size() > 0
+  charges = fm.get_point_charges(gly)
+  assert charges.size() == gly.size()
+  assert fm.point_charges.is_set.count(True) == gly.size()
+  try:
+    fm.get_point_charges(na)
+  except Sorry as e:
+    assert "point charge" in str(e) or "no charge found" in str(e)
+  else: assert 0
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -0,0 +1,66 @@
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import iotbx.pdb
+import libtbx.load_env
+from libtbx.utils import null_out
+from scitbx.array_family import flex
+from qrefine.fragment import fragments
+from qrefine.tests.unit import run_tests
+
+qrefine = libtbx.env.find_in_repositories("qrefine")
+qr_unit_tests = os.path.join(qrefine, "tests","unit")
+
+def is_old(ph, old):
+  return len([o for o in old if o is ph]) > 0
+
+def run(prefix):
+  """
+  Exercise incremental re-clustering: a residue moving in the buffer of a
+  fragment, away from its cluster, rebuilds the fragments containing it.
+  """
+  file_name = os.path.join(qr_unit_tests,"data_files","helix.pdb")
+  pdb_inp = iotbx.pdb.input(file_name=file_name)
+  h = pdb_inp.construct_hierarchy()
+  h.atoms().reset_i_seq()
+  fm = fragments(
+    working_folder             = "ase",
+    maxnum_residues_in_cluster = 2,
+    pdb_hierarchy              = h,
+    qm_engine_name             = "mopac",
+    crystal_symmetry           = pdb_inp.crystal_symmetry(),
+    incremental_reclustering   = True,
+    interaction_method         = "contact_graph")
+  fi = fm.fragment_index
+  assert fi.size() > 2
+  # a buffer residue of fragment 0
+  i_seq = fi.buffer_iselection(0)[0]
+  rg = h.atoms()[i_seq].parent().parent()
+  residue = flex.size_t([a.i_seq for a in rg.atoms()])
+  cluster = sorted(fm.clusters[0])
+  old_capped = list(fm.fragment_capped_initial)
+  sites_cart = h.atoms().extract_xyz().deep_copy()
+  sites_cart = sites_cart.set_selected(residue,
+    sites_cart.select(residue) + (0.5, 0, 0))
+  fm.update_xyz(sites_cart)
+  # moved atoms only affect themselves
+  fm.update_clusters(radius=0.1, log=null_out())
+  rebuilt = [j for j in range(fm.fragment_index.size())
+             if sorted(fm.clusters[j]) == cluster]
+  assert len(rebuilt) == 1
+  assert not is_old(fm.fragment_capped_initial[rebuilt[0]], old_capped)
+  # fragments without the moved residue are kept
+  kept = [j for j in range(fm.fragment_index.size())
+          if is_old(fm.fragment_capped_initial[j], old_capped)]
+  assert len(kept) > 0
+  for j in kept:
+    super_iselection = fm.fragment_index.super_iselection(j)
+    assert flex.bool(h.atoms_size(), residue).select(
+      super_iselection.select(super_iselection < h.atoms_size())).count(
+        True) == 0
+
+if(__name__ == "__main__"):
+  prefix = os.path.basename(__file__).replace(".py","")
+  run_tests.runner(function=run, prefix=prefix, disable=False)
@@ -10,10 +10,45 @@ from mmtbx.monomer_library import pdb_interpretation
 n_terminal_amino_acid_codes = ['FVA']
 c_terminal_amino_acid_codes = []
 
-
-mon_lib_server = server.server()
 get_class = iotbx.pdb.common_residue_names_get_class
 
+# Process-wide monomer and energy libraries. Loading them is slow, so they are
+# created on first use and shared by all of qrefine; forked workers inherit
+# them. Ligand restraints are added to the shared server.
+_mon_lib_server = None
+_ener_libs = {}
+_cif_objects = []
+_cif_file_names = set()
+
+def get_mon_lib_server():
+  global _mon_lib_server
+  if _mon_lib_server is None:
+    _mon_lib_server = server.server()
+  return _mon_lib_server
+
+def get_ener_lib(use_neutron_distances=False):
+  result = _ener_libs.get(use_neutron_distances, None)
+  if result is None:
+    result = server.ener_lib(use_neutron_distances=use_neutron_distances)
+    _ener_libs[use_neutron_distances] = result
+  return result
+
+def add_cif_objects(cif_objects=None, cif_file_names=None):
+  """
+  Add ligand restraints to the shared monomer library server, each object or
+  file only once. cif_objects: (file name, cif object) pairs.
+  """
+  mon_lib_srv = get_mon_lib_server()
+  for cif_object in cif_objects or []:
+    if [o for o in _cif_objects if o is cif_object[1]]: continue
+    mon_lib_srv.process_cif_object(cif_object[1])
+    _cif_objects.append(cif_object[1])
+  for file_name in cif_file_names or []:
+    if file_name in _cif_file_names: continue
+    mon_lib_srv.process_cif(file_name=file_name)
+    _cif_file_names.add(file_name)
+  return mon_lib_srv
+
 def display_residue_group(rg):
   return '  residue_group: resseq="%s" icode="%s"' % (rg.resseq, rg.icode)
 
@@ -66,11 +101,8 @@ def get_processed_pdb(pdb_filename=None,
                       ):
   if params is None:
     params = get_pdb_interpretation_params()
-  mon_lib_srv = monomer_library.server.server()
-  if cif_objects:
-    for cif_object in cif_objects:
-      mon_lib_srv.process_cif_object(cif_object[1])
-  ener_lib = monomer_library.server.ener_lib()
+  mon_lib_srv = add_cif_objects(cif_objects=cif_objects)
+  ener_lib = get_ener_lib()
   ppf = monomer_library.pdb_interpretation.process(
     mon_lib_srv           = mon_lib_srv,
     ener_lib              = ener_lib,
@@ -166,20 +198,24 @@ def remove_atom_from_chain(chain, atom):
           break
 
 class smart_add_atoms(list):
-  def __init__(self): pass
+  """
+  List of lists of chains with added atoms. Atoms of an appended item that
+  are already in the list (same quote()) are removed from the item.
+  """
+  def __init__(self):
+    self.quotes = set()
 
   def append(self, item):
+    quotes = []
     for chain1 in item:
       remove = []
       for atom1 in chain1.atoms():
-        for chain_list in self:
-          for chain2 in chain_list:
-            for atom2 in chain2.atoms():
-              if atom1.quote()==atom2.quote():
-                remove.append(atom1)
-      if remove:
-        for atom in remove:
-          remove_atom_from_chain(chain1, atom)
+        quote = atom1.quote()
+        if quote in self.quotes: remove.append(atom1)
+        else: quotes.append(quote)
+      for atom in remove:
+        atom.parent().remove_atom(atom)
+    self.quotes.update(quotes)
     list.append(self, item)
 
 def is_n_terminal_residue(residue_group):
@@ -6,11 +6,12 @@ import mmtbx.monomer_library.server
 import mmtbx.monomer_library.pdb_interpretation
 from mmtbx import model_statistics
 from libtbx.utils import null_out
+from qrefine.utils import hierarchy_utils
 
 def get_model_stat(pdb_file_name=None, pdb_hierarchy=None,
                    crystal_symmetry=None, show=True):
-  mon_lib_srv = mmtbx.monomer_library.server.server()
-  ener_lib    = mmtbx.monomer_library.server.ener_lib()
+  mon_lib_srv = hierarchy_utils.get_mon_lib_server()
+  ener_lib    = hierarchy_utils.get_ener_lib()
   params = mmtbx.monomer_library.pdb_interpretation.master_params.extract()
   params.use_neutron_distances = True
   params.restraints_library.cdl = False
@@ -0,0 +1,165 @@
+"""Persistent cache of QM energies and gradients.
+
+Results are keyed by a fingerprint of everything that defines a QM
+calculation: engine settings, total charge, atom symbols, coordinates rounded
+to a fixed number of digits and the content of the point-charge file. Entries
+are kept in an SQLite file so they survive restarts and can be shared between
+worker processes. The least recently used entries are evicted once the
+stored results grow over max_size (MB).
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import time
+import sqlite3
+import multiprocessing
+import hashlib
+from array import array
+from scitbx.array_family import flex
+
+# per-run counters of qm_cache, in this order
+counter_names = ["hits", "misses", "evictions"]
+
+class qm_cache(object):
+  """
+  Only results are stored in the file. Hit, miss and eviction counters are
+  kept in memory for this run, shared with the forked workers. last_used of
+  hits is written in batches of flush_size, or with the next put().
+  """
+  def __init__(self, file_name, max_size=512, digits=5, flush_size=64):
+    self.file_name = os.path.abspath(file_name)
+    self.max_size = max_size*1024*1024
+    self.digits = digits
+    self.flush_size = flush_size
+    self._connection = None
+    self._pid = None
+    self._counts = multiprocessing.get_context("fork").Array(
+      'q', len(counter_names))
+    self._used = {}
+
+  def __getstate__(self):
+    # sqlite connections are not picklable and must not cross processes;
+    # unpickled copies count on their own
+    state = self.__dict__.copy()
+    state["_connection"] = None
+    state["_pid"] = None
+    state["_counts"] = list(self._counts[:])
+    state["_used"] = {}
+    return state
+
+  def connection(self):
+    if(self._connection is None or self._pid != os.getpid()):
+      con = sqlite3.connect(self.file_name, timeout=600)
+      con.execute("""create table if not exists results (
+        key text primary key, energy real, gradients blob, size integer,
+        last_used real)""")
+      con.execute("""create index if not exists results_last_used
+        on results (last_used)""")
+      con.execute("""create table if not exists counters (
+        name text primary key, value integer)""")
+      # running total of the result sizes
+      con.execute("""insert or ignore into counters values ('size',
+        (select coalesce(sum(size), 0) from results))""")
+      con.commit()
+      self._connection = con
+      self._pid = os.getpid()
+      self._used = {}
+    return self._connection
+
+  def get_key(self, atoms, pointcharges=None, **kwargs):
+    fmt = "%%.%df" % self.digits
+    h = hashlib.sha1()
+    for key in sorted(kwargs.keys()):
+      h.update(("%s=%s;" % (key, str(kwargs[key]))).encode())
+    h.update(" ".join(atoms.get_chemical_symbols()).encode())
+    h.update(" ".join([fmt % x for x in atoms.get_positions().ravel()]).encode())
+    if(pointcharges is not None):
+      with open(pointcharges, "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+  def _count(self, name, n=1):
+    i = counter_names.index(name)
+    counts = self._counts
+    if(hasattr(counts, "get_lock")):
+      with counts.get_lock():
+        counts[i] += n
+    else:
+      counts[i] += n
+
+  def _flush(self, con):
+    if(len(self._used) == 0): return
+    con.executemany("update results set last_used=? where key=?",
+      [(t, key) for key, t in self._used.items()])
+    self._used = {}
+
+  def get(self, key):
+    """
+    Return (energy, gradients) or None.
+    """
+    con = self.connection()
+    row = con.execute("select energy, gradients from results where key=?",
+      (key,)).fetchone()
+    if(row is None):
+      self._count("misses")
+      return None
+    self._count("hits")
+    self._used[key] = time.time()
+    if(len(self._used) >= self.flush_size):
+      self._flush(con)
+      con.commit()
+    gradients = array('d')
+    gradients.frombytes(row[1])
+    return row[0], flex.vec3_double(flex.double(list(gradients)))
+
+  def put(self, key, energy, gradients):
+    blob = array('d', flex.vec3_double(gradients).as_double()).tobytes()
+    con = self.connection()
+    self._flush(con)
+    row = con.execute("select size from results where key=?",
+      (key,)).fetchone()
+    con.execute("insert or replace into results values (?, ?, ?, ?, ?)",
+      (key, float(energy), sqlite3.Binary(blob), len(blob), time.time()))
+    con.execute("update counters set value=value+? where name='size'",
+      (len(blob) - (row[0] if row is not None else 0),))
+    self._evict(con)
+    con.commit()
+
+  def get_size(self, con):
+    return con.execute(
+      "select value from counters where name='size'").fetchone()[0]
+
+  def _evict(self, con):
+    total = self.get_size(con)
+    if(total <= self.max_size): return
+    rows = con.execute("select key, size from results order by last_used")
+    evicted = []
+    for key, size in rows:
+      if(total <= self.max_size): break
+      evicted.append((key, size))
+      total -= size
+    rows.close()
+    con.executemany("delete from results where key=?",
+      [(key,) for key, size in evicted])
+    con.execute("update counters set value=value-? where name='size'",
+      (sum([size for key, size in evicted]),))
+    self._count("evictions", len(evicted))
+
+  def get_statistics(self):
+    """
+    Counters of this run, entries and size of the whole file.
+    """
+    con = self.connection()
+    result = dict(zip(counter_names, self._counts[:]))
+    result["entries"] = con.execute(
+      "select count(*) from results").fetchone()[0]
+    result["size"] = self.get_size(con)
+    return result
+
+  def show(self, log=None):
+    s = self.get_statistics()
+    print("QM cache: hits %d misses %d evictions %d entries %d (%.1f MB)" % (
+      s["hits"], s["misses"], s["evictions"], s["entries"],
+      s["size"]/1024/1024), file=log)